@@ -19,10 +19,21 @@ class Settings:
     GOOGLE_API_KEY: str = os.getenv("GOOGLE_API_KEY", "")
     MODEL_NAME: str = os.getenv("MODEL_NAME", "gemini-2.0-flash-lite")
     
+    # LLM client pool: หลาย API key และ/หรือหลาย model (คั่นด้วย comma) ใช้ quota ของทุก key
+    GOOGLE_API_KEYS: list = [key.strip() for key in os.getenv("GOOGLE_API_KEYS", "").split(",") if key.strip()]
+    LLM_POOL_MODELS: list = [name.strip() for name in os.getenv("LLM_POOL_MODELS", "").split(",") if name.strip()]
+    LLM_POOL_PARK_SECONDS: float = float(os.getenv("LLM_POOL_PARK_SECONDS", "60"))  # พัก client ที่ติด quota
+    LLM_POOL_SIZE: int = max(1, len(GOOGLE_API_KEYS)) * max(1, len(LLM_POOL_MODELS))
+    
     # Google Sheets
     GOOGLE_SERVICE_ACCOUNT_JSON: str = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON", "")
     SPREADSHEET_ID: str = os.getenv("SPREADSHEET_ID", "")
     
+    # Google Sheets logging: บันทึกลง SQLite ในเครื่องก่อน แล้ว sync ขึ้น sheet ทีละ batch ใน background
+    LOG_WRITE_BEHIND: bool = os.getenv("LOG_WRITE_BEHIND", "true").lower() == "true"
+    LOG_BATCH_SIZE: int = int(os.getenv("LOG_BATCH_SIZE", "50"))
+    LOG_FLUSH_INTERVAL: float = float(os.getenv("LOG_FLUSH_INTERVAL", "2.0"))
+    
     # CORS
     FRONTEND_URL: str = os.getenv("FRONTEND_URL", "")
     ALLOWED_ORIGINS: list = [
@@ -37,12 +48,81 @@ class Settings:
     BASE_DIR: Path = Path(__file__).parent.parent.parent
     DATA_DIR: Path = BASE_DIR / "data"
     LOGS_DIR: Path = BASE_DIR / "logs"
+    CACHE_DIR: Path = BASE_DIR / "cache"
+    RESULTS_DIR: Path = BASE_DIR / "results"
+    # Background jobs ที่จบแล้วเกินเวลานี้จะถูกลบ (ทั้งสถานะและไฟล์ผลลัพธ์)
+    JOB_TTL_SECONDS: int = int(os.getenv("JOB_TTL_SECONDS", str(24 * 3600)))
+    SUBMISSION_DB_PATH: Path = Path(os.getenv("SUBMISSION_DB_PATH", str(DATA_DIR / "submissions.sqlite3")))
+    
+    # Multi-worker mode: uvicorn worker processes (WEB_CONCURRENCY) ใช้ quota, cache และสถานะ job ร่วมกันผ่าน SQLite
+    WORKERS: int = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    SHARED_STATE_PATH: Path = Path(os.getenv("SHARED_STATE_PATH", str(CACHE_DIR / "shared_state.sqlite3")))
+    
+    # LLM call limits (shared by all classification entry points; per client when pooled)
+    MAX_CONCURRENT_REQUESTS: int = int(os.getenv("MAX_CONCURRENT_REQUESTS", "10"))
+    LLM_RPM_LIMIT: int = int(os.getenv("LLM_RPM_LIMIT", "0"))  # 0 = unlimited
+    LLM_TPM_LIMIT: int = int(os.getenv("LLM_TPM_LIMIT", "0"))  # 0 = unlimited
+    
+    # Deterministic flow engine (ประเมินจาก flowchart โดยไม่เรียก LLM เมื่อทำได้)
+    USE_FLOW_ENGINE: bool = os.getenv("USE_FLOW_ENGINE", "true").lower() == "true"
+    
+    # /classify-all-flows: รวมทุก flow ไว้ใน LLM call เดียว
+    CLASSIFY_ALL_SINGLE_CALL: bool = os.getenv("CLASSIFY_ALL_SINGLE_CALL", "false").lower() == "true"
+    
+    # ส่งเฉพาะ field ที่แต่ละ flow ใช้ประเมินเข้า prompt
+    PROJECT_FLOW_INPUTS: bool = os.getenv("PROJECT_FLOW_INPUTS", "true").lower() == "true"
+    
+    # Chain registry: เรียกแต่ละ chain หนึ่งครั้งตอน startup
+    WARMUP_CHAINS: bool = os.getenv("WARMUP_CHAINS", "false").lower() == "true"
+    
+    # Classification result cache (LRU in memory + SQLite on disk)
+    CACHE_ENABLED: bool = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+    CACHE_DB_PATH: Path = Path(os.getenv("CACHE_DB_PATH", str(CACHE_DIR / "classification_cache.sqlite3")))
+    CACHE_MAX_ENTRIES: int = int(os.getenv("CACHE_MAX_ENTRIES", "2048"))
+    CACHE_TTL_SECONDS: int = int(os.getenv("CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+    
+    # Request ที่เหมือนกันและกำลังประมวลผลอยู่ ใช้ LLM call เดียวร่วมกัน
+    COALESCE_REQUESTS: bool = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
+    
+    # Streaming CSV: อ่านไฟล์ทีละ chunk และประมวลผลพร้อมกันไม่เกิน window แถว
+    CSV_CHUNK_SIZE: int = int(os.getenv("CSV_CHUNK_SIZE", "50"))
+    CSV_ROW_WINDOW: int = int(os.getenv("CSV_ROW_WINDOW", "20"))
+    
+    # Batch checkpoints: เก็บผลราย (row, flow) เพื่อ resume งานที่ค้าง
+    CHECKPOINT_ENABLED: bool = os.getenv("CHECKPOINT_ENABLED", "true").lower() == "true"
+    CHECKPOINT_DB_PATH: Path = Path(os.getenv("CHECKPOINT_DB_PATH", str(CACHE_DIR / "batch_checkpoints.sqlite3")))
+    CHECKPOINT_TTL_SECONDS: int = int(os.getenv("CHECKPOINT_TTL_SECONDS", str(7 * 24 * 3600)))
+    
+    # Hedged requests: ถ้า call ยังไม่กลับภายใน percentile ของ latency ล่าสุดของ flow ให้ยิงซ้ำ
+    HEDGE_ENABLED: bool = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+    HEDGE_PERCENTILE: float = float(os.getenv("HEDGE_PERCENTILE", "95"))
+    HEDGE_BUDGET: float = float(os.getenv("HEDGE_BUDGET", "0.05"))  # hedge ต่อ call (0.05 = เพิ่มไม่เกิน ~5%)
+    HEDGE_MIN_SAMPLES: int = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+    
+    # Model cascade: ให้ local model (Ollama) ประเมินก่อน ส่งต่อ Gemini เมื่อผลไม่ผ่านการตรวจหรืออยู่ในระดับที่ต้อง escalate
+    CASCADE_ENABLED: bool = os.getenv("CASCADE_ENABLED", "false").lower() == "true"
+    LOCAL_MODEL_NAME: str = os.getenv("LOCAL_MODEL_NAME", "qwen2:latest")
+    OLLAMA_BASE_URL: str = os.getenv("OLLAMA_BASE_URL", "")  # ว่าง = ค่า default ของ Ollama (localhost:11434)
+    CASCADE_ESCALATE_LEVELS: str = os.getenv("CASCADE_ESCALATE_LEVELS", "ความเสี่ยงสูง")  # คั่นด้วย comma
+    CASCADE_LOCAL_TIMEOUT: float = float(os.getenv("CASCADE_LOCAL_TIMEOUT", "30"))
+    
+    # ข้าม flow ที่ไม่เกี่ยวข้องกับผู้ป่วย (เช่น ไม่มีการมัดฟัน) หรือไม่มีข้อมูล โดยไม่เรียก LLM
+    APPLICABILITY_GATING: bool = os.getenv("APPLICABILITY_GATING", "true").lower() == "true"
+    
+    # ส่งเกณฑ์แบบย่อ (compile จาก flowchart และผ่าน equivalence check) แทน Mermaid เต็ม
+    COMPACT_FLOW_CRITERIA: bool = os.getenv("COMPACT_FLOW_CRITERIA", "true").lower() == "true"
+    
+    # ใช้ structured output ของ provider (schema-constrained) แทน format instructions + text parser
+    STRUCTURED_OUTPUT: bool = os.getenv("STRUCTURED_OUTPUT", "true").lower() == "true"
     
-    # CSV Processing
-    MAX_CONCURRENT_REQUESTS: int = 10
+    # LLM cassette: off | record (บันทึก output ของ LLM) | replay (ใช้ output ที่บันทึกไว้ ไม่เรียก API)
+    LLM_CASSETTE_MODE: str = os.getenv("LLM_CASSETTE_MODE", "off").lower()
+    LLM_CASSETTE_PATH: Path = Path(os.getenv("LLM_CASSETTE_PATH", str(CACHE_DIR / "llm_cassette.sqlite3")))
     
     def __init__(self):
         """Initialize settings and validate"""
+        if not self.GOOGLE_API_KEY and self.GOOGLE_API_KEYS:
+            self.GOOGLE_API_KEY = self.GOOGLE_API_KEYS[0]
         if not self.GOOGLE_API_KEY:
             raise ValueError("GOOGLE_API_KEY environment variable is not set")
         
@@ -53,6 +133,7 @@ class Settings:
         # Create directories if they don't exist
         self.DATA_DIR.mkdir(exist_ok=True)
         self.LOGS_DIR.mkdir(exist_ok=True)
+        self.CACHE_DIR.mkdir(exist_ok=True)
 
 
 # Global settings instance
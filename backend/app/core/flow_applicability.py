@@ -0,0 +1,110 @@
+"""
+Flow Applicability Rules
+Declarative rules that say when a flow cannot apply to a patient (e.g. the
+IMF wire flow for a patient without IMF), evaluated from the form answers
+before any LLM call.
+"""
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Tuple
+
+from app.core.flow_engine import _is_missing
+
+
+# ------------------------------------------------------------
+# Data Structures
+# ------------------------------------------------------------
+@dataclass(frozen=True)
+class ApplicabilityRule:
+    """
+    Condition on one form field (substring match, case-insensitive)
+
+    A rule fails when the field has a value that does not contain any of
+    `requires` or contains one of `excludes`. A missing value never fails.
+    """
+    field: str
+    reason: str
+    requires: Tuple[str, ...] = ()
+    excludes: Tuple[str, ...] = ()
+
+    def fails(self, data: Dict[str, Any]) -> bool:
+        value = data.get(self.field)
+        if _is_missing(value):
+            return False
+        values = value if isinstance(value, (list, tuple)) else [value]
+        text = " ".join(str(v) for v in values if not _is_missing(v)).lower()
+        if not text:
+            return False
+        if self.requires and not any(keyword.lower() in text for keyword in self.requires):
+            return True
+        return any(keyword.lower() in text for keyword in self.excludes)
+
+
+@dataclass(frozen=True)
+class FlowApplicability:
+    """
+    Applicability of one flow
+
+    The flow does not apply when one of `rules` fails, unless the patient
+    still answered one of the flow's own questions (`answer_fields`, other
+    than the failing rule's field) — contradicting answers go to the LLM.
+    """
+    rules: Tuple[ApplicabilityRule, ...]
+    answer_fields: Tuple[str, ...] = field(default_factory=tuple)
+
+    def not_applicable_reason(self, data: Dict[str, Any]) -> Optional[str]:
+        for rule in self.rules:
+            if not rule.fails(data):
+                continue
+            answered = [
+                name for name in self.answer_fields
+                if name != rule.field and not _is_missing(data.get(name))
+            ]
+            if not answered:
+                return rule.reason
+        return None
+
+
+# ------------------------------------------------------------
+# Rules
+# ------------------------------------------------------------
+# หัตถการปลูกกระดูกสะโพก (ตัวเลือกในฟอร์ม หรือพิมพ์เพิ่มเอง)
+BONE_GRAFT_KEYWORDS = ("กระดูกสะโพก", "iliac", "bone graft", "alveolar cleft")
+
+_BONE_GRAFT_RULE = ApplicabilityRule(
+    field="procedures",
+    requires=BONE_GRAFT_KEYWORDS,
+    reason="ไม่ได้ทำหัตถการปลูกกระดูกสะโพก",
+)
+
+FLOW_APPLICABILITY: Dict[str, FlowApplicability] = {
+    "หากมีการมัดฟันบนและล่างเข้าด้วยกัน ลวดมัดฟันแน่นดีหรือไม่?": FlowApplicability(
+        rules=(ApplicabilityRule(field="has_imf", excludes=("ไม่มี",), reason="ไม่มีการมัดฟัน"),),
+        answer_fields=("imf_wire_status", "imf_wire_description"),
+    ),
+    "แผลบริเวณสะโพก: การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก": FlowApplicability(
+        rules=(_BONE_GRAFT_RULE,),
+    ),
+    "การเดิน: การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก": FlowApplicability(
+        rules=(
+            ApplicabilityRule(field="walking_status", excludes=("ไม่ได้ทำหัตถการ",), reason="ไม่ได้ทำหัตถการปลูกกระดูกสะโพก"),
+            _BONE_GRAFT_RULE,
+        ),
+        answer_fields=("walking_status", "walking_description"),
+    ),
+    "ตำแหน่งสายยางให้อาหาร: กรณีในผู้ป่วยที่รับประทานอาหารผ่านทางสายยาง (on NG-nasogastric tube)": FlowApplicability(
+        rules=(
+            ApplicabilityRule(
+                field="feeding_method",
+                requires=("สายยาง", "nasogastric", "ng tube", "ng-tube"),
+                reason="ไม่ได้รับประทานอาหารผ่านสายยาง",
+            ),
+        ),
+        answer_fields=("ng_tube_position", "ng_tube_description"),
+    ),
+}
+
+
+def not_applicable_reason(flow_name: str, data: Dict[str, Any]) -> Optional[str]:
+    """Reason the flow cannot apply to this patient, or None if it may apply"""
+    applicability = FLOW_APPLICABILITY.get(flow_name)
+    return applicability.not_applicable_reason(data) if applicability else None
@@ -0,0 +1,158 @@
+"""
+Compact Flow Criteria
+Compiles each Mermaid flowchart in FLOWS into a minimal flowchart of the
+same decision tree for the prompt's {flow_criteria}: the inputs, each
+question with its answer edges (leaf risk levels declared inline) and the
+summary of each leaf. Start/end nodes, layout, indentation and duplicated
+edges are dropped. Every compact flowchart is compiled again with
+flow_engine.compile_flow and compared with the original tree before it is
+used, otherwise the original flowchart is kept.
+
+Token report / check: python -m benchmarks.compact_flows [--check]
+"""
+from typing import Dict, List, Tuple
+
+from app.core.config import settings
+from app.core.flows import FLOWS
+from app.core.flow_engine import DECISION_TREES, DecisionTree, compile_flow
+
+
+# ------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------
+# Subgraph ที่ compile_flow ใช้: B = ข้อมูลที่ใช้, C = คำถาม/ผลลัพธ์, D = สรุป
+SUBGRAPH_TITLES = {"B": "ข้อมูลที่ใช้ประเมิน", "C": "ประเมินความเสี่ยง", "D": "สรุปส่งพยาบาล"}
+
+
+# ------------------------------------------------------------
+# Compiler
+# ------------------------------------------------------------
+def _decision_order(tree: DecisionTree) -> List[str]:
+    """Decision nodes in depth-first order from the root (each once)"""
+    order: List[str] = []
+    stack = [tree.root] if tree.root else []
+    while stack:
+        node_id = stack.pop()
+        if node_id in order or not tree.nodes[node_id].is_decision:
+            continue
+        order.append(node_id)
+        stack.extend(reversed(list(tree.branches.get(node_id, {}).values())))
+    return order
+
+
+def _leaves(tree: DecisionTree, decisions: List[str]) -> List[str]:
+    """Leaf nodes reached from the given decisions, in listing order"""
+    targets = [target for node_id in decisions for target in tree.branches.get(node_id, {}).values()]
+    return list(dict.fromkeys(target for target in targets if not tree.nodes[target].is_decision))
+
+
+def _subgraph(name: str, lines: List[str]) -> List[str]:
+    return [f"subgraph {name} [{SUBGRAPH_TITLES[name]}]", *lines, "end"] if lines else []
+
+
+def compile_compact(tree: DecisionTree) -> str:
+    """
+    Render a decision tree as a compact Mermaid flowchart
+
+    Example:
+        flowchart TD
+        subgraph B [ข้อมูลที่ใช้ประเมิน]
+        B1[/ระดับความปวด ณ ปัจจุบัน Pain score/]
+        end
+        subgraph C [ประเมินความเสี่ยง]
+        C1{Pain Score = 0 ?}
+        C1 -->|ใช่| C2[ความเสี่ยงต่ำ]
+        C1 -->|ไม่ใช่| C7
+        ...
+        end
+        subgraph D [สรุปส่งพยาบาล]
+        C2 --> D1[สรุป: Pain Score = 0]
+        end
+    """
+    inputs = [f"{node.node_id}[/{node.text}/]" for node in tree.nodes.values() if node.subgraph == "B" and node.text]
+    decisions = _decision_order(tree)
+    rules: List[str] = []
+    for node_id in decisions:
+        rules.append(f"{node_id}{{{tree.nodes[node_id].text}}}")
+        for label, target in tree.branches.get(node_id, {}).items():
+            node = tree.nodes[target]
+            rules.append(f"{node_id} -->|{label}| {target}" + ("" if node.is_decision else f"[{node.text}]"))
+    summary_ids = {node.text: node.node_id for node in tree.nodes.values() if node.subgraph == "D" and node.text}
+    summaries = [
+        f"{leaf} --> {summary_ids[tree.summaries[leaf]]}[{tree.summaries[leaf]}]"
+        for leaf in _leaves(tree, decisions) if leaf in tree.summaries
+    ]
+    return "\n".join(["flowchart TD", *_subgraph("B", inputs), *_subgraph("C", rules), *_subgraph("D", summaries)])
+
+
+def _reachable_tree(tree: DecisionTree) -> Tuple[List[str], Dict[str, Tuple[str, bool]], Dict[str, Dict[str, str]], Dict[str, str]]:
+    """(inputs, node texts, branches, summaries) of the part of a tree reachable from its root"""
+    decisions = _decision_order(tree)
+    leaves = _leaves(tree, decisions)
+    inputs = [node.text for node in tree.nodes.values() if node.subgraph == "B" and node.text]
+    nodes = {node_id: (tree.nodes[node_id].text, tree.nodes[node_id].is_decision) for node_id in decisions + leaves}
+    branches = {node_id: tree.branches.get(node_id, {}) for node_id in decisions}
+    summaries = {leaf: tree.summaries[leaf] for leaf in leaves if leaf in tree.summaries}
+    return inputs, nodes, branches, summaries
+
+
+def check_equivalence(tree: DecisionTree, text: str) -> List[str]:
+    """
+    Compare a compact flowchart with the flowchart it was compiled from
+
+    The compact text is compiled with flow_engine.compile_flow (the parser
+    of the original flowcharts), so both trees come from the same parser.
+
+    Returns:
+        List of problems (empty when the compact flowchart is equivalent)
+    """
+    problems: List[str] = []
+    if tree.root is None:
+        return ["no root decision node"]
+
+    # ส่วนที่ compact ตัดทิ้งได้ต้องไม่มีข้อมูลที่ใช้ประเมิน
+    decisions = _decision_order(tree)
+    leaves = set(_leaves(tree, decisions))
+    for node in tree.nodes.values():
+        if node.subgraph == "C" and node.is_decision and node.node_id not in decisions:
+            problems.append(f"decision {node.node_id} is not reachable from {tree.root}")
+        if node.subgraph == "C" and not node.is_decision and node.node_id not in leaves:
+            problems.append(f"leaf {node.node_id} ({node.text}) is not reachable from {tree.root}")
+    linked = {tree.summaries[leaf] for leaf in leaves if leaf in tree.summaries}
+    for node in tree.nodes.values():
+        if node.subgraph == "D" and node.text and node.text not in linked:
+            problems.append(f"summary {node.node_id} is not linked to any leaf")
+
+    compact = compile_flow(tree.flow_name, text)
+    if compact.root != tree.root:
+        problems.append(f"root {compact.root} != {tree.root}")
+    expected, actual = _reachable_tree(tree), _reachable_tree(compact)
+    for part, want, got in zip(("inputs", "nodes", "branches", "summaries"), expected, actual):
+        if got != want:
+            problems.append(f"{part} differ: {got} != {want}")
+    return problems
+
+
+def _build_compact_flows() -> Tuple[Dict[str, str], Dict[str, List[str]]]:
+    compact, problems = {}, {}
+    for name, tree in DECISION_TREES.items():
+        text = compile_compact(tree)
+        issues = check_equivalence(tree, text)
+        if issues:
+            problems[name] = issues
+        else:
+            compact[name] = text
+    return compact, problems
+
+
+# Compact flowchart ต่อ flow (เฉพาะ flow ที่ผ่าน equivalence check)
+COMPACT_FLOWS, COMPACT_PROBLEMS = _build_compact_flows()
+
+_COMPACT_BY_TEXT: Dict[str, str] = {FLOWS[name]: text for name, text in COMPACT_FLOWS.items()}
+
+
+def prompt_criteria(flow: str) -> str:
+    """Criteria text to inject into the prompt for a flow (compact when enabled and verified)"""
+    if not settings.COMPACT_FLOW_CRITERIA:
+        return flow
+    return _COMPACT_BY_TEXT.get(flow, flow)
@@ -0,0 +1,378 @@
+"""
+Deterministic Flow Engine
+Compiles the Mermaid flowcharts in FLOWS into executable decision trees
+so structured (multiple-choice / numeric) answers can be classified
+without calling the LLM.
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from app.core.flows import FLOWS
+
+
+# ------------------------------------------------------------
+# Constants
+# ------------------------------------------------------------
+RISK_LEVELS = ["ความเสี่ยงต่ำ", "ความเสี่ยงกลาง", "ความเสี่ยงสูง"]
+
+# สะกดผิดใน flowchart -> ระดับความเสี่ยงที่ถูกต้อง
+RISK_LEVEL_ALIASES = {
+    "ความเสี่ยงค่ำ": "ความเสี่ยงต่ำ",
+}
+
+# คำแนะนำ default ตามระดับความเสี่ยง (ตรงกับตัวอย่างใน prompt)
+DEFAULT_RECOMMENDATIONS = {
+    "ความเสี่ยงสูง": "ควรติดต่อแพทย์/พยาบาลโดยเร็ว",
+    "ความเสี่ยงกลาง": "ควรสังเกตอาการ หากแย่ลงให้ติดต่อแพทย์",
+    "ความเสี่ยงต่ำ": "ดูแลตามคำแนะนำทั่วไป",
+}
+
+YES_LABELS = {"ใช่", "มี"}
+NO_LABELS = {"ไม่ใช่", "ไม่มี"}
+
+# Mapping ระหว่าง decision node ในแต่ละ flow กับ field ในฟอร์ม
+FLOW_DECISION_FIELDS: Dict[str, Dict[str, str]] = {
+    "อาการปวด": {
+        "C1": "pain_score",
+        "C7": "pain_score",
+        "C3": "pain_medication_effective",
+    },
+    "อาการบวม": {
+        "C1": "breathing_or_swallowing_difficulty",
+        "C3": "swelling_status",
+    },
+    "อาการเลือดซึม/ เลือดออก": {"C1": "bleeding_status"},
+    "อาการไข้": {"C1": "fever_status"},
+    "บริเวณที่เอาเข็มน้ำเกลือออกที่หลังมือหรือข้อมือ (phlebitis)": {"C1": "phlebitis"},
+    "ไหมเย็บแผล": {"C1": "suture_status"},
+    "อาการอื่นๆ (เลือกได้หลายคำตอบ)": {"C1": "other_symptoms"},
+    "รับประทานยาฆ่าเชื้อครบตามแผนการรักษาหรือไม่?": {"C1": "antibiotic_compliance"},
+    "ประคบเย็น หรือ อุ่นอยู่หรือไม่?": {"C1": "compress_type"},
+    "หากมีการมัดฟันบนและล่างเข้าด้วยกัน ลวดมัดฟันแน่นดีหรือไม่?": {
+        "C0": "has_imf",
+        "C1": "imf_wire_status",
+    },
+    "การเดิน: การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก": {"C1": "walking_status"},
+    "ตำแหน่งสายยางให้อาหาร: กรณีในผู้ป่วยที่รับประทานอาหารผ่านทางสายยาง (on NG-nasogastric tube)": {
+        "C1": "ng_tube_position",
+    },
+    "การแปรงฟัน": {"C1": "brushing_teeth"},
+    "การบ้วนปาก": {"C1": "mouth_rinsing"},
+    "วิธีการรับประทานอาหาร": {"C1": "feeding_method"},
+    "ประเภทอาหารที่ทาน (สามารถเลือกได้หลายคำตอบ)": {"C1": "food_types"},
+    "ปริมาณอาหารที่ทาน": {"C1": "food_amount"},
+}
+
+# ตัวเลือกในฟอร์มที่เขียนต่างจาก label ใน flowchart (form value -> edge label)
+# คำตอบต้องตรงกับ label หรือ alias เท่านั้น ค่าอื่น (เช่นข้อความที่พิมพ์เอง) ให้ LLM ประเมิน
+VALUE_ALIASES: Dict[str, Dict[str, str]] = {
+    "pain_medication_effective": {"ไม่ได้ทานยาแก้ปวด": "ยังไม่ได้ทาน"},
+    "swelling_status": {
+        "ปัจจุบันหายบวมแล้ว": "หายบวมแล้ว",
+        "บวมลดลง": "บวมน้อยลง",
+        "บวมมากขึ้นมากๆจนกระทบการใช้ชีวิตประจำวัน": "บวมมากขึ้นมากๆจนกระทบการใช้ชีวิต",
+    },
+    "other_symptoms": {"ช้ำบริเวณแผลผ่าตัด": "ช้ำ"},
+    "antibiotic_compliance": {"ครบตามแพทย์สั่ง": "ครบทุกเม็ด"},
+    "has_imf": {"ไม่มีการมัดฟัน": "ไม่มี", "มีการมัดฟัน": "มี"},
+    "walking_status": {"เดินได้ปกติ": "เดินได้คล่อง"},
+}
+
+_SHAPES = [("([", "])"), ("[/", "/]"), ("[", "]"), ("{", "}")]
+_NODE_RE = re.compile(r"^(\w+)\s*(.*)$")
+_EDGE_LABEL_RE = re.compile(r"^\|(.*?)\|\s*(.*)$")
+_COMPARISON_RE = re.compile(r"(>=|<=|≥|≤|=|<|>)\s*(\d+(?:\.\d+)?)")
+
+
+# ------------------------------------------------------------
+# Data Structures
+# ------------------------------------------------------------
+@dataclass
+class FlowNode:
+    node_id: str
+    text: str = ""
+    is_decision: bool = False
+    subgraph: Optional[str] = None
+
+
+@dataclass
+class FlowDecision:
+    """ผลการประเมินจาก decision tree"""
+    risk_level: str
+    recommendation: str
+    reason: str
+
+
+@dataclass
+class DecisionTree:
+    """Executable decision tree compiled from one Mermaid flowchart"""
+    flow_name: str
+    nodes: Dict[str, FlowNode]
+    branches: Dict[str, Dict[str, str]]
+    summaries: Dict[str, str]
+    root: Optional[str]
+    bindings: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def fields(self) -> List[str]:
+        """Form fields that the decision nodes of this flow depend on"""
+        return list(dict.fromkeys(self.bindings.values()))
+
+    @property
+    def is_executable(self) -> bool:
+        """True if every decision node is bound to a form field"""
+        decisions = [n for n in self.nodes.values() if n.is_decision]
+        return self.root is not None and all(n.node_id in self.bindings for n in decisions)
+
+    def evaluate(self, data: Dict[str, Any]) -> Optional[FlowDecision]:
+        """
+        Walk the tree with structured form values
+
+        Args:
+            data: Patient data dictionary (English field names)
+
+        Returns:
+            FlowDecision, or None if any branch cannot be decided from
+            structured values (missing/unknown answer, unbound node)
+        """
+        if not self.is_executable:
+            return None
+
+        leaves = self._resolve(self.root, data)
+        if not leaves:
+            return None
+
+        levels = [_risk_level_of(self.nodes[leaf].text) for leaf in leaves]
+        if any(level is None for level in levels):
+            return None
+
+        reasons, recommendations = [], []
+        for leaf, level in zip(leaves, levels):
+            condition, advice = _split_summary(self.summaries.get(leaf, ""))
+            reasons.append(condition or self.nodes[leaf].text)
+            recommendations.append(advice or DEFAULT_RECOMMENDATIONS[level])
+
+        return FlowDecision(
+            risk_level=max(levels, key=RISK_LEVELS.index),
+            recommendation="\n".join(dict.fromkeys(recommendations)),
+            reason=", ".join(dict.fromkeys(reasons)),
+        )
+
+    def _resolve(self, node_id: str, data: Dict[str, Any]) -> Optional[List[str]]:
+        node = self.nodes[node_id]
+        if not node.is_decision:
+            return [node_id]
+
+        field_name = self.bindings[node_id]
+        value = data.get(field_name)
+        if _is_missing(value):
+            return None
+
+        # คำถามแบบเลือกได้หลายคำตอบ: ประเมินทุกตัวเลือกที่เลือก
+        values = value if isinstance(value, (list, tuple)) else [value]
+        values = [v for v in values if not _is_missing(v)]
+        if not values:
+            return None
+
+        leaves: List[str] = []
+        for item in values:
+            target = _choose_branch(node, self.branches.get(node_id, {}), item, VALUE_ALIASES.get(field_name, {}))
+            if target is None:
+                return None
+            resolved = self._resolve(target, data)
+            if resolved is None:
+                return None
+            leaves.extend(resolved)
+        return list(dict.fromkeys(leaves))
+
+
+# ------------------------------------------------------------
+# Helper Functions
+# ------------------------------------------------------------
+def _normalize(text: Any) -> str:
+    """ตัด quote / ช่องว่าง เพื่อใช้เทียบ label"""
+    return re.sub(r"\s+", "", str(text).replace('"', ""))
+
+
+def _is_missing(value: Any) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, float) and value != value:  # NaN
+        return True
+    if isinstance(value, str) and value.strip() == "":
+        return True
+    if isinstance(value, (list, tuple)) and len(value) == 0:
+        return True
+    return False
+
+
+def _clean_text(text: str) -> str:
+    text = text.replace("<br>", " ").strip()
+    while text.startswith('"') and text.endswith('"') and len(text) >= 2:
+        text = text[1:-1].strip()
+    return text
+
+
+def _parse_node(token: str) -> Optional[FlowNode]:
+    """Parse `ID`, `ID[text]`, `ID{text}`, `ID([text])`, `ID[/text/]`"""
+    match = _NODE_RE.match(token.strip())
+    if not match:
+        return None
+    node_id, rest = match.group(1), match.group(2).strip()
+    for open_, close in _SHAPES:
+        if rest.startswith(open_) and rest.endswith(close):
+            return FlowNode(
+                node_id=node_id,
+                text=_clean_text(rest[len(open_):-len(close)]),
+                is_decision=(open_ == "{"),
+            )
+    return FlowNode(node_id=node_id)
+
+
+def _risk_level_of(text: str) -> Optional[str]:
+    text = RISK_LEVEL_ALIASES.get(text.strip(), text.strip())
+    return text if text in RISK_LEVELS else None
+
+
+def _split_summary(summary: str):
+    """แยก summary 'เงื่อนไข → เสี่ยงสูง, แนะนำ: ...' เป็น (เงื่อนไข, คำแนะนำ)"""
+    summary = summary.strip()
+    if summary.startswith("สรุป:"):
+        summary = summary[len("สรุป:"):].strip()
+    condition, _, outcome = summary.partition("→")
+    advice = ""
+    if "แนะนำ:" in outcome:
+        advice = outcome.split("แนะนำ:", 1)[1].strip()
+    return condition.strip(), advice
+
+
+def _compare(value: float, op: str, threshold: float) -> bool:
+    if op == "=":
+        return value == threshold
+    if op in ("≥", ">="):
+        return value >= threshold
+    if op in ("≤", "<="):
+        return value <= threshold
+    if op == "<":
+        return value < threshold
+    return value > threshold
+
+
+def _choose_branch(node: FlowNode, branches: Dict[str, str], value: Any, aliases: Dict[str, str]) -> Optional[str]:
+    """เลือก edge ที่ตรงกับคำตอบ คืนค่า target node id หรือ None"""
+    # Decision แบบตัวเลข เช่น "Pain Score ≥ 7 ?" ที่มี edge ใช่/ไม่ใช่
+    comparison = _COMPARISON_RE.search(node.text)
+    if comparison:
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        passed = _compare(number, comparison.group(1), float(comparison.group(2)))
+        wanted = YES_LABELS if passed else NO_LABELS
+        for label, target in branches.items():
+            if label in wanted:
+                return target
+        return None
+
+    normalized = {_normalize(label): target for label, target in branches.items()}
+    value_str = str(value).strip()
+    value_norm = _normalize(aliases.get(value_str, value_str))
+
+    # ตรงกับ label หรือ alias เท่านั้น: ไม่เดาจาก substring (เช่น "ไม่มีน้ำมูก" มีคำว่า "มีน้ำมูก")
+    return normalized.get(value_norm)
+
+
+# ------------------------------------------------------------
+# Compiler
+# ------------------------------------------------------------
+def compile_flow(flow_name: str, flow: str, bindings: Optional[Dict[str, str]] = None) -> DecisionTree:
+    """
+    Compile a Mermaid `flowchart TD` into a DecisionTree
+
+    Args:
+        flow_name: Name of the flow (key in FLOWS)
+        flow: Mermaid flowchart text
+        bindings: Mapping of decision node id -> form field name
+
+    Returns:
+        DecisionTree: Decision nodes from subgraph C, leaf risk levels and
+        their linked summaries from subgraph D
+    """
+    nodes: Dict[str, FlowNode] = {}
+    edges = []
+    subgraph = None
+
+    def register(token: str) -> Optional[str]:
+        node = _parse_node(token)
+        if node is None:
+            return None
+        existing = nodes.get(node.node_id)
+        if existing is None:
+            node.subgraph = subgraph
+            nodes[node.node_id] = node
+        elif node.text and not existing.text:
+            existing.text, existing.is_decision = node.text, node.is_decision
+            existing.subgraph = existing.subgraph or subgraph
+        return node.node_id
+
+    for raw_line in flow.splitlines():
+        line = raw_line.strip()
+        if not line or line.startswith("flowchart"):
+            continue
+        if line.startswith("subgraph"):
+            subgraph = line.split()[1]
+            continue
+        if line == "end":
+            subgraph = None
+            continue
+
+        if "-->" in line:
+            left, right = line.split("-->", 1)
+            label = None
+            right = right.strip()
+            label_match = _EDGE_LABEL_RE.match(right)
+            if label_match:
+                label, right = _clean_text(label_match.group(1)), label_match.group(2)
+            source, target = register(left), register(right)
+            if source and target:
+                edges.append((source, label, target))
+        else:
+            register(line)
+
+    branches: Dict[str, Dict[str, str]] = {}
+    summaries: Dict[str, str] = {}
+    for source, label, target in edges:
+        source_node, target_node = nodes[source], nodes[target]
+        if source_node.is_decision and label is not None:
+            branches.setdefault(source, {})[label] = target
+        elif source_node.subgraph == "C" and target_node.subgraph == "D":
+            summaries[source] = target_node.text
+
+    decision_targets = {t for targets in branches.values() for t in targets.values()}
+    roots = [
+        n.node_id for n in nodes.values()
+        if n.is_decision and n.subgraph == "C" and n.node_id not in decision_targets
+    ]
+
+    return DecisionTree(
+        flow_name=flow_name,
+        nodes=nodes,
+        branches=branches,
+        summaries=summaries,
+        root=roots[0] if roots else None,
+        bindings=dict(bindings or {}),
+    )
+
+
+DECISION_TREES: Dict[str, DecisionTree] = {
+    name: compile_flow(name, flow, FLOW_DECISION_FIELDS.get(name))
+    for name, flow in FLOWS.items()
+}
+
+_TREES_BY_TEXT: Dict[str, DecisionTree] = {FLOWS[name]: tree for name, tree in DECISION_TREES.items()}
+
+
+def get_decision_tree(flow: str) -> Optional[DecisionTree]:
+    """Look up the compiled tree for a flow by its flowchart text"""
+    return _TREES_BY_TEXT.get(flow)
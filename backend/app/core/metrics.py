@@ -0,0 +1,186 @@
+"""
+Metrics - In-process Prometheus-style Metrics
+Minimal counters, histograms and gauges rendered in the Prometheus text
+exposition format by GET /metrics (no extra dependency).
+"""
+import threading
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Latency buckets (seconds): ครอบคลุมตั้งแต่ engine/cache (<1ms) ถึง LLM call + retry
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonic counter"""
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        lines = self.header()
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_number(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Gauge read from a callback at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        return self.header() + [f"{self.name} {_format_number(value or 0)}"]
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together by /metrics"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        # Re-registering (e.g. module reload) returns the existing metric
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, documentation, callback))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Global registry
+REGISTRY = MetricsRegistry()
+
+# Classification metrics (labels: flow, model)
+CLASSIFICATION_LATENCY = REGISTRY.histogram(
+    "classification_duration_seconds",
+    "End-to-end latency of one flow classification",
+    ("flow", "model", "source"),
+)
+STAGE_LATENCY = REGISTRY.histogram(
+    "classification_stage_duration_seconds",
+    "Latency of one classification stage (render_input, rate_limit_wait, prompt_render, model_call, output_parse)",
+    ("flow", "model", "stage"),
+)
+PROMPT_TOKENS = REGISTRY.histogram(
+    "llm_estimated_tokens",
+    "Estimated tokens (prompt + expected output) per LLM call",
+    ("flow", "model"),
+    buckets=TOKEN_BUCKETS,
+)
+RETRIES = REGISTRY.counter(
+    "classification_retries_total",
+    "Failed LLM attempts that were retried or gave up",
+    ("flow", "model"),
+)
+FALLBACKS = REGISTRY.counter(
+    "classification_fallbacks_total",
+    "Default \"ไม่สามารถประเมินได้\" responses after all retries failed",
+    ("flow", "model"),
+)
+RATE_LIMITED = REGISTRY.counter(
+    "llm_rate_limited_total",
+    "LLM calls rejected with a quota / rate-limit error (429)",
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "classification_cache_lookups_total",
+    "Result cache lookups by outcome (hits, disk_hits, misses)",
+    ("flow", "outcome"),
+)
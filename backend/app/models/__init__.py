@@ -1,3 +1,3 @@
-from .schemas import PatientData, RiskResponse, AllFlowsResult, LogData
+from .schemas import PatientData, RiskResponse, AllFlowsResult, LogData, JobStatus
 
-__all__ = ["PatientData", "RiskResponse", "AllFlowsResult", "LogData"]
+__all__ = ["PatientData", "RiskResponse", "AllFlowsResult", "LogData", "JobStatus"]
@@ -16,6 +16,7 @@ class RiskResponse(BaseModel):
     risk_level: str
     recommendation: str
     reason: str
+    model: Optional[str] = None  # model ที่ตอบ (None: ตัดสินโดย flowchart)
 
 
 class AllFlowsResult(BaseModel):
@@ -31,6 +32,23 @@ class LogData(BaseModel):
     session_id: Optional[str] = None
 
 
+class JobStatus(BaseModel):
+    """Progress of a background CSV classification job"""
+    job_id: str
+    status: str  # queued, running, completed, failed, cancelled
+    filename: str
+    rows_total: int
+    rows_done: int
+    flows_total: int
+    flows_done: int
+    error_count: int
+    eta_seconds: Optional[float] = None
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+
 class RawInputData(BaseModel):
     """Model for logging raw form input without AI results"""
     # Allow any fields from patient form
@@ -2,18 +2,30 @@
 Classification Router - Risk Assessment Endpoints
 """
 from fastapi import APIRouter, HTTPException, UploadFile, File, Depends
-from fastapi.responses import FileResponse
+from typing import Optional
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse
 import pandas as pd
 import os
 import logging
 import asyncio
+import json
 from datetime import datetime
 
 from app.models.schemas import PatientData, RiskResponse
-from app.services.risk_service import classify_risk, _process_all_rows, FORM_COLUMNS
+from app.services.risk_service import aclassify_risk, classify_flows_single_call, model_cascade, FORM_COLUMNS
+from app.services.stream_service import (
+    spool_upload, open_csv_reader, iter_csv_rows, stream_classified_rows, stream_csv_lines, stream_ndjson_lines,
+    classify_csv_to_file
+)
 from app.services.log_service import append_with_result
+from app.services.cache_service import classification_cache, single_flight
+from app.services.checkpoint_service import checkpoint_store
+from app.services.rate_limiter import rate_limiter
+from app.services.hedge_service import request_hedger
+from app.services.llm_pool import pool_stats
 from app.core.flows import FLOWS
 from app.core.config import settings
+from app.core.metrics import REGISTRY
 
 logger = logging.getLogger(__name__)
 
@@ -37,8 +49,18 @@ async def root():
         "endpoints": {
             "/classify": "POST - Classify single patient data",
             "/classify-all-flows": "POST - Classify with all flows",
+            "/classify-all-flows/stream": "POST - Classify with all flows, stream each flow as server-sent events",
             "/classify-csv": "POST - Upload and process CSV file",
-            "/flows": "GET - List available flows"
+            "/classify-csv/stream": "POST - Upload CSV file, stream results back as CSV or NDJSON",
+            "/jobs/classify-csv": "POST - Submit CSV file as a background job",
+            "/flows": "GET - List available flows",
+            "/cache/stats": "GET - Classification cache hit/miss counters per flow",
+            "/checkpoints/stats": "GET - Batch checkpoint store counters",
+            "/rate-limit/stats": "GET - Shared LLM rate limiter state",
+            "/llm-pool/stats": "GET - LLM client pool health, load and quota per client",
+            "/hedge/stats": "GET - Hedged request rate, win rate and tail latency",
+            "/cascade/stats": "GET - Local model cascade: served locally vs escalated to Gemini",
+            "/metrics": "GET - Prometheus metrics (latency histograms, retries, fallbacks, 429s, cache hits)"
         }
     }
 
@@ -49,6 +71,48 @@ async def get_flows():
     return {"flows": list(FLOWS.keys())}
 
 
+@router.get("/cache/stats")
+async def get_cache_stats():
+    """Get classification cache hit/miss counters per flow and coalesced call counts"""
+    return {**classification_cache.stats(), "single_flight": single_flight.stats()}
+
+
+@router.get("/checkpoints/stats")
+async def get_checkpoint_stats():
+    """Get batch checkpoint counters (stored, resumed and written cells)"""
+    return checkpoint_store.stats()
+
+
+@router.get("/rate-limit/stats")
+async def get_rate_limit_stats():
+    """Get shared LLM rate limiter limits, queue depth and wait times"""
+    return rate_limiter.stats()
+
+
+@router.get("/llm-pool/stats")
+async def get_llm_pool_stats():
+    """Get per-client state of the LLM pool (parked clients, in-flight calls, quota used)"""
+    return pool_stats()
+
+
+@router.get("/hedge/stats")
+async def get_hedge_stats():
+    """Get hedged request counters and tail latency (single call vs end-to-end)"""
+    return request_hedger.stats()
+
+
+@router.get("/cascade/stats")
+async def get_cascade_stats():
+    """Get local-first cascade counters (escalation rate and reasons per flow)"""
+    return model_cascade.stats()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus text exposition of classification metrics"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @router.post("/classify", response_model=RiskResponse)
 async def classify_patient(patient: PatientData, llm = Depends(lambda: get_llm())):
     """
@@ -72,26 +136,62 @@ async def classify_patient(patient: PatientData, llm = Depends(lambda: get_llm()
     flow = FLOWS[flow_name]
     
     try:
-        result = classify_risk(
+        result = await aclassify_risk(
             input_data=patient.data,
             flow=flow,
-            llm=llm
+            llm=llm,
+            flow_name=flow_name
         )
         return RiskResponse(
             risk_level=result.risk_level,
             recommendation=result.recommendation,
-            reason=result.reason
+            reason=result.reason,
+            model=result.answered_by
         )
     except Exception as e:
         logger.error(f"Classification error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Classification error: {str(e)}")
 
 
+async def _classify_flow(data: dict, flow_name: str, flow: str, llm):
+    """Process a single flow asynchronously, returns (flow_name, result, error)"""
+    try:
+        logger.info(f"Processing flow: {flow_name}")
+        # Native async call: no thread pool, event loop stays free
+        result = await aclassify_risk(
+            input_data=data,
+            flow=flow,
+            llm=llm,
+            flow_name=flow_name
+        )
+        logger.info(f"Successfully processed flow: {flow_name}")
+        return flow_name, {
+            "risk_level": result.risk_level,
+            "recommendation": result.recommendation,
+            "reason": result.reason,
+            "model": result.answered_by
+        }, None
+    except Exception as flow_error:
+        logger.error(f"Error in flow {flow_name}: {str(flow_error)}", exc_info=True)
+        return flow_name, None, str(flow_error)
+
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
 @router.post("/classify-all-flows")
-async def classify_all_flows(patient: PatientData, llm = Depends(lambda: get_llm())):
+async def classify_all_flows(
+    patient: PatientData,
+    single_call: Optional[bool] = None,
+    llm = Depends(lambda: get_llm())
+):
     """
     Classify risk for a single patient across all flows (parallel processing)
     
+    Set `single_call=true` (or CLASSIFY_ALL_SINGLE_CALL) to classify all flows
+    with one LLM call; flows that fail validation fall back to per-flow calls.
+    
     Example request:
     {
         "data": {"symptom": "ปวดหัว", "duration": "3 days"}
@@ -100,31 +200,29 @@ async def classify_all_flows(patient: PatientData, llm = Depends(lambda: get_llm
     logger.info(f"Received classify-all-flows request with data keys: {list(patient.data.keys())}")
     results = {}
     errors = {}
-
-    async def process_flow(flow_name: str, flow: str):
-        """Process a single flow asynchronously"""
+    
+    if single_call is None:
+        single_call = settings.CLASSIFY_ALL_SINGLE_CALL
+    
+    if single_call:
         try:
-            logger.info(f"Processing flow: {flow_name}")
-            # Run classify_risk in thread pool since it's synchronous
-            result = await asyncio.to_thread(
-                classify_risk,
-                input_data=patient.data,
-                flow=flow,
-                llm=llm
-            )
-            logger.info(f"Successfully processed flow: {flow_name}")
-            return flow_name, {
-                "risk_level": result.risk_level,
-                "recommendation": result.recommendation,
-                "reason": result.reason
-            }, None
-        except Exception as flow_error:
-            logger.error(f"Error in flow {flow_name}: {str(flow_error)}", exc_info=True)
-            return flow_name, None, str(flow_error)
+            flow_results = await classify_flows_single_call(patient.data, FLOWS, llm)
+            return {
+                flow_name: {
+                    "risk_level": result.risk_level,
+                    "recommendation": result.recommendation,
+                    "reason": result.reason,
+                    "model": result.answered_by
+                }
+                for flow_name, result in flow_results.items()
+            }
+        except Exception as e:
+            logger.error(f"Single-call classification error: {str(e)}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"Classification error: {str(e)}")
 
     try:
         # Process all flows in parallel
-        tasks = [process_flow(flow_name, flow) for flow_name, flow in FLOWS.items()]
+        tasks = [_classify_flow(patient.data, flow_name, flow, llm) for flow_name, flow in FLOWS.items()]
         flow_results = await asyncio.gather(*tasks)
         
         # Collect results and errors
@@ -158,42 +256,72 @@ async def classify_all_flows(patient: PatientData, llm = Depends(lambda: get_llm
         raise HTTPException(status_code=500, detail=f"Classification error: {str(e)}")
 
 
+@router.post("/classify-all-flows/stream")
+async def classify_all_flows_stream(patient: PatientData, llm = Depends(lambda: get_llm())):
+    """
+    Classify risk across all flows, streaming each flow as it finishes
+    
+    Server-sent events:
+    - `flow`: {"flow_name", "risk_level", "recommendation", "reason", "model"} as soon as a flow resolves
+    - `done`: {"completed": n, "total": n, "errors": {flow_name: error}} after the last flow
+    """
+    logger.info(f"Received classify-all-flows/stream request with data keys: {list(patient.data.keys())}")
+    
+    async def event_stream():
+        tasks = [
+            asyncio.create_task(_classify_flow(patient.data, flow_name, flow, llm))
+            for flow_name, flow in FLOWS.items()
+        ]
+        errors = {}
+        completed = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                flow_name, result, error = await next_done
+                if error:
+                    errors[flow_name] = error
+                    continue
+                completed += 1
+                yield _sse_event("flow", {"flow_name": flow_name, **result})
+            yield _sse_event("done", {"completed": completed, "total": len(tasks), "errors": errors})
+        finally:
+            # Client disconnected: stop the flows still running
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.post("/classify-csv")
 async def classify_csv(
     file: UploadFile = File(...),
     max_concurrent: int = 10,
-    llm = None
+    llm = Depends(lambda: get_llm())
 ):
     """
     Upload CSV file and process all rows
     Returns the processed file
+    
+    The upload is read in chunks and each finished row is appended to the
+    output file, so memory does not grow with the file size.
     """
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="File must be CSV format")
     
-    # Save uploaded file
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    input_path = f"temp_input_{timestamp}.csv"
     output_path = f"result_{timestamp}.csv"
     
     try:
-        # Save uploaded file
-        with open(input_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-        
-        # Read CSV and prepare dataframe
-        df = pd.read_csv(input_path)
-        for flow_name in FLOWS.keys():
-            df[f"{flow_name}_risk_level"] = ""
-            df[f"{flow_name}_risk_reason"] = ""
-            df[f"{flow_name}_recommendation"] = ""
-        
-        # Process CSV asynchronously
-        await _process_all_rows(df, llm, output_path, max_concurrent)
-        
-        # Clean up input file
-        os.remove(input_path)
+        reader = open_csv_reader(file.file)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid CSV file: {str(e)}")
+    
+    try:
+        # Classify rows as chunks arrive, appending results to the output file
+        await classify_csv_to_file(reader, llm, output_path, max_concurrent)
         
         # Return processed file
         return FileResponse(
@@ -203,9 +331,45 @@ async def classify_csv(
         )
     except Exception as e:
         # Clean up on error
-        if os.path.exists(input_path):
-            os.remove(input_path)
         if os.path.exists(output_path):
             os.remove(output_path)
         logger.error(f"CSV processing error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
+
+
+@router.post("/classify-csv/stream")
+async def classify_csv_stream(
+    file: UploadFile = File(...),
+    max_concurrent: int = 10,
+    output_format: str = "csv",
+    llm = Depends(lambda: get_llm())
+):
+    """
+    Upload CSV file and stream results back row by row
+    
+    Rows are classified as the upload is read and sent in input order as
+    soon as they finish (chunked CSV, or NDJSON with `output_format=ndjson`).
+    """
+    if not file.filename.endswith('.csv'):
+        raise HTTPException(status_code=400, detail="File must be CSV format")
+    if output_format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="output_format must be 'csv' or 'ndjson'")
+    
+    spool = await spool_upload(file)
+    try:
+        reader = open_csv_reader(spool)
+    except Exception as e:
+        spool.close()
+        raise HTTPException(status_code=400, detail=f"Invalid CSV file: {str(e)}")
+    
+    rows = stream_classified_rows(iter_csv_rows(reader, spool), llm, max_concurrent)
+    
+    if output_format == "ndjson":
+        return StreamingResponse(stream_ndjson_lines(rows), media_type="application/x-ndjson")
+    
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return StreamingResponse(
+        stream_csv_lines(rows),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="risk_classification_{timestamp}.csv"'}
+    )
@@ -0,0 +1,96 @@
+"""
+Jobs Router - Background CSV Classification Endpoints
+"""
+from fastapi import APIRouter, HTTPException, UploadFile, File, Depends
+from fastapi.responses import FileResponse
+from typing import List
+import asyncio
+import logging
+
+from app.models.schemas import JobStatus
+from app.services.job_service import job_manager
+from app.services.stream_service import spool_upload, count_csv_rows
+
+logger = logging.getLogger(__name__)
+
+# Global variable to hold get_llm function (set by main.py)
+get_llm = None
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"]
+)
+
+
+async def _get_status_or_404(job_id: str):
+    status = await job_manager.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return status
+
+
+@router.post("/classify-csv", response_model=JobStatus, status_code=202)
+async def submit_csv_job(
+    file: UploadFile = File(...),
+    max_concurrent: int = 10,
+    llm = Depends(lambda: get_llm())
+):
+    """
+    Upload a CSV file and classify it in the background
+    Returns the job id immediately; poll GET /jobs/{job_id} for progress
+    """
+    if not file.filename.endswith('.csv'):
+        raise HTTPException(status_code=400, detail="File must be CSV format")
+
+    # Upload copied in chunks (spills to disk); rows are counted (and the file
+    # validated) in a worker thread, then streamed by the job
+    spool = await spool_upload(file)
+    try:
+        rows_total = await asyncio.to_thread(count_csv_rows, spool)
+    except Exception as e:
+        spool.close()
+        raise HTTPException(status_code=400, detail=f"Invalid CSV file: {str(e)}")
+
+    job = job_manager.submit(spool, rows_total, llm, file.filename, max_concurrent)
+    return job.to_status()
+
+
+@router.get("", response_model=List[JobStatus])
+async def list_jobs():
+    """List all jobs (of every worker in multi-worker mode)"""
+    return await job_manager.statuses()
+
+
+@router.get("/{job_id}", response_model=JobStatus)
+async def get_job(job_id: str):
+    """Get job progress (rows and flows done, ETA, error counts)"""
+    return await _get_status_or_404(job_id)
+
+
+@router.get("/{job_id}/result")
+async def download_job_result(job_id: str):
+    """
+    Download job results
+    Returns the final CSV once completed, otherwise the partial results so far
+    """
+    await _get_status_or_404(job_id)
+    result = await job_manager.result_file(job_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"No results available yet for job: {job_id}")
+    path, partial = result
+    suffix = "_partial" if partial else ""
+
+    return FileResponse(
+        path=path,
+        filename=f"risk_classification_{job_id}{suffix}.csv",
+        media_type="text/csv"
+    )
+
+
+@router.post("/{job_id}/cancel", response_model=JobStatus)
+async def cancel_job(job_id: str):
+    """Cancel a running job (results finished so far remain downloadable)"""
+    await _get_status_or_404(job_id)
+    status = await job_manager.cancel(job_id)
+    logger.info(f"Cancel requested for job {job_id}")
+    return status
@@ -2,11 +2,15 @@
 Logging Router - Form Submission Logging Endpoints
 """
 from fastapi import APIRouter, HTTPException
+import asyncio
 import logging
 from datetime import datetime
 
 from app.models.schemas import LogData, RawInputData
-from app.services.log_service import append_raw_input, append_with_result
+from app.core.config import settings
+from app.services.log_service import (
+    append_raw_input, append_with_result, build_raw_input_row, build_result_row, sheets_replicator
+)
 from app.services.risk_service import FORM_COLUMNS
 
 logger = logging.getLogger(__name__)
@@ -17,11 +21,21 @@ router = APIRouter(
 )
 
 
+@router.get("/stats")
+async def get_log_stats():
+    """Get local store and Google Sheets replication counters (stored, pending rows per sheet)"""
+    return sheets_replicator.stats()
+
+
 @router.post("/submission")
 async def log_form_submission(log_data: LogData):
     """
     Log form submission to Google Sheets
     
+    With LOG_WRITE_BEHIND the row is written to the local submission
+    store and the request returns with status "stored"; rows are
+    replicated to Google Sheets in batches.
+    
     Example request:
     {
         "form_data": {"age": 25, "gender": "หญิง", ...},
@@ -32,13 +46,22 @@ async def log_form_submission(log_data: LogData):
     try:
         timestamp = datetime.now().isoformat()
         
-        # Log to Google Sheets
-        append_with_result(log_data.form_data, log_data.results, FORM_COLUMNS)
+        if settings.LOG_WRITE_BEHIND:
+            sheets_replicator.submit(
+                "input_with_result",
+                build_result_row(log_data.form_data, log_data.results, FORM_COLUMNS),
+                log_data.session_id
+            )
+            status = "stored"
+        else:
+            # Log to Google Sheets (blocking gspread call off the event loop)
+            await asyncio.to_thread(append_with_result, log_data.form_data, log_data.results, FORM_COLUMNS)
+            status = "success"
         
-        logger.info(f"Successfully logged form submission for session: {log_data.session_id}")
+        logger.info(f"Logged form submission ({status}) for session: {log_data.session_id}")
         
         return {
-            "status": "success",
+            "status": status,
             "timestamp": timestamp,
             "session_id": log_data.session_id
         }
@@ -67,12 +90,17 @@ async def log_raw_input(raw_data: RawInputData):
     try:
         # Convert Pydantic model to dict
         form_data = raw_data.model_dump()
-        append_raw_input(form_data, FORM_COLUMNS)
+        if settings.LOG_WRITE_BEHIND:
+            sheets_replicator.submit("raw_input", build_raw_input_row(form_data, FORM_COLUMNS))
+            status = "stored"
+        else:
+            await asyncio.to_thread(append_raw_input, form_data, FORM_COLUMNS)
+            status = "success"
         
-        logger.info("Successfully logged raw input")
+        logger.info(f"Logged raw input ({status})")
         
         return {
-            "status": "success",
+            "status": status,
             "timestamp": datetime.now().isoformat()
         }
         
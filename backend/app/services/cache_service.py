@@ -0,0 +1,297 @@
+"""
+Cache Service - Classification Result Cache
+In-process LRU with TTL in front of an on-disk SQLite tier, keyed by
+flow text, model name, prompt key and normalized patient input, plus a
+single-flight group that shares one LLM call between identical concurrent
+requests.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from app.core.config import settings
+from app.core.flows import FLOWS
+from app.core.flow_compact import prompt_criteria
+from app.core.metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+# Mapping flow text -> flow name (ใช้สำหรับนับ hit/miss ราย flow)
+FLOW_NAMES_BY_TEXT = {flow: name for name, flow in FLOWS.items()}
+
+
+def normalize_text(text: str) -> str:
+    """ตัดช่องว่างซ้ำซ้อนเพื่อให้ input ที่ต่างกันแค่ whitespace ได้ key เดียวกัน"""
+    lines = (re.sub(r"\s+", " ", line).strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def make_cache_key(flow: str, model_name: str, result_text: str, prompt_key: str) -> str:
+    """
+    Hash of flow criteria (as sent in the prompt), model name, prompt key
+    (prompt version + chain mode + template hash) and normalized rendered input
+    """
+    payload = "\x1f".join([
+        prompt_criteria(flow) if flow else "", model_name or "", prompt_key or "", normalize_text(result_text)
+    ])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ClassificationCache:
+    """
+    Two-tier cache: in-process LRU with TTL + SQLite on disk
+
+    get/set touch SQLite on the calling thread; the async aget/aset run the
+    disk tier in a worker thread so the event loop never waits on it.
+    """
+
+    def __init__(self, db_path: Optional[Path], max_entries: int = 2048, ttl_seconds: float = 7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        # _lock: memory tier + counters (never held during disk I/O); _db_lock: SQLite connection
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._conn = None
+
+        if db_path is not None:
+            try:
+                Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+                self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS classification_cache ("
+                    "key TEXT PRIMARY KEY, flow_name TEXT, value TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Failed to open cache database {db_path}, using memory only: {e}")
+                self._conn = None
+
+    def _count(self, flow_name: str, outcome: str) -> None:
+        stats = self._stats.setdefault(flow_name, {"hits": 0, "disk_hits": 0, "misses": 0})
+        stats[outcome] += 1
+        CACHE_LOOKUPS.inc(flow=flow_name, outcome=outcome)
+
+    def get(self, flow: str, model_name: str, result_text: str, prompt_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached result
+
+        Returns:
+            The cached result dict, or None on a miss / expired entry
+        """
+        key = make_cache_key(flow, model_name, result_text, prompt_key)
+        now = time.time()
+        value = self._get_memory(key, now)
+        disk_entry = self._read_disk(key, now) if value is None else None
+        return self._finish_get(flow, key, value, disk_entry)
+
+    async def aget(self, flow: str, model_name: str, result_text: str, prompt_key: str) -> Optional[Dict[str, Any]]:
+        """get() with the SQLite lookup in a worker thread"""
+        key = make_cache_key(flow, model_name, result_text, prompt_key)
+        now = time.time()
+        value = self._get_memory(key, now)
+        disk_entry = None
+        if value is None and self._conn is not None:
+            disk_entry = await asyncio.to_thread(self._read_disk, key, now)
+        return self._finish_get(flow, key, value, disk_entry)
+
+    def set(self, flow: str, model_name: str, result_text: str, prompt_key: str, value: Dict[str, Any]) -> None:
+        """Store a result in both tiers"""
+        key = make_cache_key(flow, model_name, result_text, prompt_key)
+        created_at = time.time()
+        with self._lock:
+            self._put_memory(key, dict(value), created_at)
+        self._write_disk(key, FLOW_NAMES_BY_TEXT.get(flow, "custom"), value, created_at)
+
+    async def aset(self, flow: str, model_name: str, result_text: str, prompt_key: str, value: Dict[str, Any]) -> None:
+        """set() with the SQLite write in a worker thread"""
+        key = make_cache_key(flow, model_name, result_text, prompt_key)
+        created_at = time.time()
+        with self._lock:
+            self._put_memory(key, dict(value), created_at)
+        if self._conn is not None:
+            await asyncio.to_thread(self._write_disk, key, FLOW_NAMES_BY_TEXT.get(flow, "custom"), value, created_at)
+
+    def _get_memory(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            value, created_at = entry
+            if now - created_at <= self.ttl_seconds:
+                self._memory.move_to_end(key)
+                return dict(value)
+            del self._memory[key]
+            return None
+
+    def _read_disk(self, key: str, now: float) -> Optional[tuple]:
+        """(value, created_at) from SQLite, None on a miss / expired entry"""
+        if self._conn is None:
+            return None
+        with self._db_lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM classification_cache WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.error(f"Cache read failed: {e}")
+                return None
+        if row is None or now - row[1] > self.ttl_seconds:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _write_disk(self, key: str, flow_name: str, value: Dict[str, Any], created_at: float) -> None:
+        if self._conn is None:
+            return
+        with self._db_lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO classification_cache (key, flow_name, value, created_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, flow_name, json.dumps(value, ensure_ascii=False), created_at)
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Cache write failed: {e}")
+
+    def _finish_get(self, flow: str, key: str, value: Optional[Dict[str, Any]], disk_entry: Optional[tuple]) -> Optional[Dict[str, Any]]:
+        """Count the lookup and promote a disk hit into the memory tier"""
+        flow_name = FLOW_NAMES_BY_TEXT.get(flow, "custom")
+        with self._lock:
+            if value is not None:
+                self._count(flow_name, "hits")
+                return value
+            if disk_entry is not None:
+                value, created_at = disk_entry
+                self._put_memory(key, value, created_at)
+                self._count(flow_name, "disk_hits")
+                return dict(value)
+            self._count(flow_name, "misses")
+            return None
+
+    def _put_memory(self, key: str, value: Dict[str, Any], created_at: float) -> None:
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters per flow"""
+        with self._lock:
+            per_flow = {name: dict(counts) for name, counts in self._stats.items()}
+            memory_entries = len(self._memory)
+        totals = {"hits": 0, "disk_hits": 0, "misses": 0}
+        for counts in per_flow.values():
+            for outcome, count in counts.items():
+                totals[outcome] += count
+        return {
+            "memory_entries": memory_entries,
+            "persistent": self._conn is not None,
+            "totals": totals,
+            "flows": per_flow,
+        }
+
+    def clear(self) -> None:
+        """Drop all cached entries (both tiers)"""
+        with self._lock:
+            self._memory.clear()
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.execute("DELETE FROM classification_cache")
+                self._conn.commit()
+
+
+# Global cache instance
+classification_cache = ClassificationCache(
+    db_path=settings.CACHE_DB_PATH if settings.CACHE_ENABLED else None,
+    max_entries=settings.CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.CACHE_TTL_SECONDS,
+)
+
+
+def get_cached_result(flow: str, result_text: str, prompt_key: str, model_name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Cached result for (flow, model, prompt, input), None if disabled or missing (model defaults to MODEL_NAME)"""
+    if not settings.CACHE_ENABLED:
+        return None
+    return classification_cache.get(flow, model_name or settings.MODEL_NAME, result_text, prompt_key)
+
+
+def store_result(flow: str, result_text: str, prompt_key: str, value: Dict[str, Any], model_name: Optional[str] = None) -> None:
+    """Store a successful classification result of model_name (defaults to MODEL_NAME)"""
+    if settings.CACHE_ENABLED:
+        classification_cache.set(flow, model_name or settings.MODEL_NAME, result_text, prompt_key, value)
+
+
+async def aget_cached_result(flow: str, result_text: str, prompt_key: str, model_name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """get_cached_result for async callers (SQLite tier off the event loop)"""
+    if not settings.CACHE_ENABLED:
+        return None
+    return await classification_cache.aget(flow, model_name or settings.MODEL_NAME, result_text, prompt_key)
+
+
+async def astore_result(flow: str, result_text: str, prompt_key: str, value: Dict[str, Any], model_name: Optional[str] = None) -> None:
+    """store_result for async callers (SQLite tier off the event loop)"""
+    if settings.CACHE_ENABLED:
+        await classification_cache.aset(flow, model_name or settings.MODEL_NAME, result_text, prompt_key, value)
+
+
+class SingleFlight:
+    """
+    Coalesce identical in-flight calls
+
+    Concurrent callers with the same key await one shared task and all get
+    its result. The shared task is cancelled only when every caller waiting
+    on it has been cancelled.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, tuple] = {}
+        self._leaders = 0
+        self._coalesced = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._calls.get(key)
+        if entry is None or entry[0].done():
+            task = asyncio.ensure_future(func())
+            entry = [task, 0]
+            self._calls[key] = entry
+            task.add_done_callback(lambda _, key=key, entry=entry: self._forget(key, entry))
+            self._leaders += 1
+        else:
+            self._coalesced += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and entry[1] == 1:
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _forget(self, key: str, entry) -> None:
+        if self._calls.get(key) is entry:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._calls),
+            "calls": self._leaders,
+            "coalesced": self._coalesced,
+        }
+
+
+# Global single-flight group for LLM classification calls
+single_flight = SingleFlight()
@@ -0,0 +1,105 @@
+"""
+Cascade Service - Local Model First, Escalate to Gemini
+Each flow is first classified by a local model (Ollama). The answer is kept
+only when it passes the schema, agrees with the flowchart's structured
+answers and is not in the escalate set (e.g. high risk); otherwise the call
+escalates to the remote model.
+"""
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from app.core.config import settings
+from app.core.flow_engine import RISK_LEVELS, get_decision_tree
+from app.core.metrics import REGISTRY
+
+CASCADE_OUTCOMES = REGISTRY.counter(
+    "llm_cascade_total",
+    "Cascade results by outcome (local = served by the local model, otherwise the escalation reason)",
+    ("flow", "outcome"),
+)
+
+# เหตุผลที่ส่งต่อไปยัง remote model
+ESCALATION_REASONS = ("invalid", "check", "level", "error")
+
+
+def parse_levels(value: str) -> tuple:
+    """Comma-separated risk levels from a setting"""
+    return tuple(level.strip() for level in value.split(",") if level.strip())
+
+
+class ModelCascade:
+    """
+    Local-first classification policy + counters
+
+    Args:
+        local_factory: Builds the local LLM (called once, on first use)
+        escalate_levels: Local verdicts that are always re-checked by the remote model
+        timeout: Seconds to wait for the local model before escalating
+    """
+
+    def __init__(self, local_factory: Callable[[], Any], escalate_levels: Iterable[str] = ("ความเสี่ยงสูง",), timeout: float = 30.0):
+        self.local_factory = local_factory
+        self.escalate_levels = tuple(escalate_levels)
+        self.timeout = timeout
+        self._local = None
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    @property
+    def local_llm(self):
+        if self._local is None:
+            with self._lock:
+                if self._local is None:
+                    self._local = self.local_factory()
+        return self._local
+
+    def escalation_reason(self, result, input_data: Optional[Dict[str, Any]], flow: str) -> Optional[str]:
+        """
+        Why a local result must go to the remote model, None to keep it
+
+        - invalid: risk level outside the three levels or empty text fields
+        - check: lower than the level the flowchart gives for the structured
+          answers alone (free text may raise the risk, never lower it)
+        - level: verdict in the escalate set
+        """
+        if result is None or result.risk_level not in RISK_LEVELS:
+            return "invalid"
+        if not result.recommendation.strip() or not result.reason.strip():
+            return "invalid"
+
+        tree = get_decision_tree(flow)
+        decision = tree.evaluate(input_data) if tree is not None and input_data else None
+        if decision is not None and RISK_LEVELS.index(result.risk_level) < RISK_LEVELS.index(decision.risk_level):
+            return "check"
+
+        if result.risk_level in self.escalate_levels:
+            return "level"
+        return None
+
+    def record(self, flow: str, outcome: str) -> None:
+        """Count one cascade result ("local" or an escalation reason)"""
+        CASCADE_OUTCOMES.inc(flow=flow, outcome=outcome)
+        with self._lock:
+            counts = self._stats.setdefault(flow, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Local / escalated counts and escalation rate"""
+        with self._lock:
+            per_flow = {name: dict(counts) for name, counts in self._stats.items()}
+        totals = {outcome: 0 for outcome in ("local",) + ESCALATION_REASONS}
+        for counts in per_flow.values():
+            for outcome, count in counts.items():
+                totals[outcome] += count
+        calls = sum(totals.values())
+        escalated = calls - totals["local"]
+        return {
+            "enabled": settings.CASCADE_ENABLED,
+            "local_model": settings.LOCAL_MODEL_NAME,
+            "escalate_levels": list(self.escalate_levels),
+            "calls": calls,
+            "escalated": escalated,
+            "escalation_rate": round(escalated / calls, 4) if calls else 0.0,
+            "totals": totals,
+            "flows": per_flow,
+        }
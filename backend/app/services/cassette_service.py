@@ -0,0 +1,269 @@
+"""
+Cassette Service - Record / Replay of LLM Calls
+Wraps a chat model so every call is stored as (prompt hash -> raw model
+output) in a SQLite cassette (record mode) or served from it without any
+network access (replay mode). Raw text and errors are stored, so the output
+parser and the retry path run exactly as they did when recorded.
+
+The prompt sent to the model depends on the wrapped model: with native
+structured output the schema is a call option, otherwise the prompt carries
+the parser's format instructions. Each cassette stores, per model name, the
+wrapped model class and this chain mode; replaying with a different one
+would miss every prompt and is reported (or refused with strict=True).
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableBinding, RunnableSequence
+from pydantic import BaseModel, ConfigDict, PrivateAttr
+
+from app.core.config import settings
+from app.core.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_MODES = ("off", "record", "replay")
+
+CASSETTE_LOOKUPS = REGISTRY.counter(
+    "llm_cassette_lookups_total",
+    "Cassette lookups by outcome (recorded, hits, misses)",
+    ("outcome",),
+)
+
+
+class CassetteMissError(Exception):
+    """Replay mode: no recorded output for this prompt"""
+
+
+class RecordedLLMError(Exception):
+    """Replay of an error that the model raised while recording"""
+
+
+class CassetteMismatchError(ValueError):
+    """Cassette recorded with another wrapped model or chain mode"""
+
+
+class _SchemaProbe(BaseModel):
+    value: str
+
+
+def chain_mode(llm) -> str:
+    """
+    "structured" if the model binds a provider response schema (as
+    bind_structured_output does), otherwise "parser" (format instructions in the prompt)
+    """
+    try:
+        llm.with_structured_output(_SchemaProbe, method="json_schema")
+    except (NotImplementedError, ValueError, TypeError):
+        return "parser"
+    return "structured"
+
+
+def cassette_profile(llm) -> Dict[str, str]:
+    """Wrapped model class and chain mode (both change the recorded prompts)"""
+    return {"inner": type(llm).__name__, "chain_mode": chain_mode(llm)}
+
+
+def prompt_hash(messages: List[BaseMessage], model_name: str, options: Optional[Dict[str, Any]] = None) -> str:
+    """Hash of model name, the exact prompt messages and call options (e.g. response schema)"""
+    payload = json.dumps(
+        [model_name, options or {}] + [[message.type, message.content] for message in messages],
+        ensure_ascii=False, default=str, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """
+    SQLite store of recorded outputs
+
+    The same prompt can be recorded several times (e.g. a retry after a
+    malformed answer); replay returns them in the recorded order and then
+    keeps returning the last one.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cassette ("
+            "key TEXT NOT NULL, seq INTEGER NOT NULL, output TEXT, error TEXT, created_at REAL NOT NULL, "
+            "PRIMARY KEY (key, seq))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cassette_meta (model_name TEXT PRIMARY KEY, profile TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        self._record_seq: Dict[str, int] = {}
+        self._replay_seq: Dict[str, int] = {}
+        self._stats = {"recorded": 0, "hits": 0, "misses": 0}
+        self._missed_keys: List[str] = []
+
+    def profile(self, model_name: str) -> Optional[Dict[str, str]]:
+        """Recorded profile (cassette_profile) of a model name, None if never recorded"""
+        with self._lock:
+            row = self._conn.execute("SELECT profile FROM cassette_meta WHERE model_name = ?", (model_name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_profile(self, model_name: str, profile: Dict[str, str]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cassette_meta (model_name, profile) VALUES (?, ?)", (model_name, json.dumps(profile))
+            )
+            self._conn.commit()
+
+    def record(self, key: str, output: Optional[str] = None, error: Optional[str] = None) -> None:
+        with self._lock:
+            seq = self._record_seq.get(key, 0)
+            self._record_seq[key] = seq + 1
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cassette (key, seq, output, error, created_at) VALUES (?, ?, ?, ?, ?)",
+                (key, seq, output, error, time.time())
+            )
+            self._conn.commit()
+            self._stats["recorded"] += 1
+        CASSETTE_LOOKUPS.inc(outcome="recorded")
+
+    def replay(self, key: str) -> Optional[tuple]:
+        """(output, error) of the next recorded call for key, None on a miss"""
+        with self._lock:
+            seq = self._replay_seq.get(key, 0)
+            row = self._conn.execute(
+                "SELECT output, error FROM llm_cassette WHERE key = ? AND seq <= ? ORDER BY seq DESC LIMIT 1",
+                (key, seq)
+            ).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                if len(self._missed_keys) < 100:
+                    self._missed_keys.append(key)
+            else:
+                self._replay_seq[key] = seq + 1
+                self._stats["hits"] += 1
+        CASSETTE_LOOKUPS.inc(outcome="misses" if row is None else "hits")
+        return row
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM llm_cassette").fetchone()[0]
+            return {"path": str(self.path), "entries": entries, **self._stats, "missed_keys": list(self._missed_keys)}
+
+
+class CassetteChatModel(BaseChatModel):
+    """
+    Chat model wrapper that records or replays the wrapped model's outputs
+
+    Args:
+        inner: The real chat model (only called in record mode)
+        cassette: Cassette store
+        mode: "record" or "replay"
+        model_name: Model name mixed into the prompt hash
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    inner: Any = None
+    mode: str = "replay"
+    model_name: str = ""
+
+    _cassette: Cassette = PrivateAttr()
+
+    def __init__(self, cassette: Cassette, **kwargs):
+        super().__init__(**kwargs)
+        self._cassette = cassette
+
+    @property
+    def _llm_type(self) -> str:
+        return f"cassette-{self.mode}"
+
+    @property
+    def cassette(self) -> Cassette:
+        return self._cassette
+
+    def with_structured_output(self, schema, **kwargs):
+        """
+        Structured output of the wrapped model: its provider options (response
+        schema) are bound to this wrapper and forwarded on record
+        """
+        structured = self.inner.with_structured_output(schema, **kwargs)
+        if not isinstance(structured, RunnableSequence) or not isinstance(structured.first, RunnableBinding):
+            raise NotImplementedError("Wrapped model does not bind structured output options")
+        return RunnableSequence(self.bind(**structured.first.kwargs), *structured.steps[1:])
+
+    def _replay(self, key: str) -> ChatResult:
+        row = self._cassette.replay(key)
+        if row is None:
+            raise CassetteMissError(f"No recorded LLM output for prompt {key[:12]}")
+        output, error = row
+        if error is not None:
+            raise RecordedLLMError(error)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=output))])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        key = prompt_hash(messages, self.model_name, kwargs)
+        if self.mode == "replay":
+            return self._replay(key)
+        try:
+            message = self.inner.invoke(messages, stop=stop, **kwargs)
+        except Exception as e:
+            self._cassette.record(key, error=str(e))
+            raise
+        self._cassette.record(key, output=message.content)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        key = prompt_hash(messages, self.model_name, kwargs)
+        if self.mode == "replay":
+            return self._replay(key)
+        try:
+            message = await self.inner.ainvoke(messages, stop=stop, **kwargs)
+        except Exception as e:
+            self._cassette.record(key, error=str(e))
+            raise
+        self._cassette.record(key, output=message.content)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def wrap_with_cassette(llm, mode: str = None, path: Path = None, model_name: str = None, strict: bool = False):
+    """
+    Wrap an LLM for record/replay according to LLM_CASSETTE_MODE
+
+    Returns the LLM unchanged when the mode is "off". `model_name` (part of
+    the prompt hash) defaults to MODEL_NAME. Record mode stores the wrapped
+    model's profile; replay with a different profile logs a warning, or
+    raises CassetteMismatchError when `strict` and the chain mode differs.
+    """
+    mode = (mode or settings.LLM_CASSETTE_MODE).lower()
+    if mode not in CASSETTE_MODES:
+        raise ValueError(f"LLM_CASSETTE_MODE must be one of {CASSETTE_MODES}, got {mode!r}")
+    if mode == "off":
+        return llm
+    model_name = model_name or settings.MODEL_NAME
+    cassette = Cassette(path or settings.LLM_CASSETTE_PATH)
+    logger.info(f"LLM cassette {mode} mode: {cassette.path}")
+
+    profile = cassette_profile(llm)
+    recorded = cassette.profile(model_name)
+    if recorded is not None and recorded != profile:
+        message = (
+            f"Cassette {cassette.path} was recorded for {model_name} with {recorded}, now {profile}: "
+            f"prompts differ, so {'recorded entries will not be reused' if mode == 'record' else 'every call will miss'}"
+        )
+        # ต่าง class แต่ chain mode เดียวกัน (เช่น LLM pool กับ client เดียว) prompt ยังตรงกัน
+        if strict and mode == "replay" and recorded.get("chain_mode") != profile["chain_mode"]:
+            raise CassetteMismatchError(message)
+        logger.warning(message)
+    if mode == "record":
+        cassette.set_profile(model_name, profile)
+    return CassetteChatModel(cassette, inner=llm, mode=mode, model_name=model_name)
@@ -0,0 +1,141 @@
+"""
+Checkpoint Service - Durable Per-cell Results for Batch Runs
+Persists every completed (row, flow) result of a batch run to SQLite as it
+finishes, so a rerun of the same input after a restart or quota outage only
+spends LLM calls on the cells that are still missing. A cell is keyed by the
+row (model + input values) and the flow's prompt (criteria + PROMPT_VERSION),
+so editing a flow or the prompt template invalidates its checkpoints.
+"""
+import hashlib
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from app.core.config import settings
+from app.core.flow_compact import prompt_criteria
+
+logger = logging.getLogger(__name__)
+
+# เพิ่มเลขนี้เมื่อแก้ prompt template (build_risk_prompt) เพื่อไม่ใช้ checkpoint / cache ที่ได้จาก prompt เดิม
+PROMPT_VERSION = "1"
+
+
+def row_checkpoint_key(input_data: dict, model_name: str) -> str:
+    """Hash of model name and the row's input values (result columns excluded by the caller)"""
+    values = {
+        str(key): (None if isinstance(value, float) and math.isnan(value) else value)
+        for key, value in input_data.items()
+    }
+    payload = model_name + "\x1f" + json.dumps(values, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def flow_checkpoint_key(flow_name: str, flow: str) -> str:
+    """Flow name + hash of the criteria sent in the prompt and PROMPT_VERSION"""
+    payload = PROMPT_VERSION + "\x1f" + prompt_criteria(flow)
+    return f"{flow_name}@{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]}"
+
+
+class CheckpointStore:
+    """
+    SQLite (WAL) store of completed batch cells keyed by (row key, flow key)
+
+    Args:
+        db_path: SQLite file (None = checkpoints disabled)
+        ttl_seconds: Age after which a checkpointed cell is ignored and removed
+    """
+
+    def __init__(self, db_path: Optional[Path], ttl_seconds: float = 7 * 24 * 3600):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = None
+        self._hits = 0
+        self._writes = 0
+
+        if db_path is not None:
+            try:
+                Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+                self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS batch_checkpoints ("
+                    "row_key TEXT NOT NULL, flow_name TEXT NOT NULL, value TEXT NOT NULL, created_at REAL NOT NULL, "
+                    "PRIMARY KEY (row_key, flow_name))"
+                )
+                self._conn.execute("DELETE FROM batch_checkpoints WHERE created_at < ?", (time.time() - ttl_seconds,))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Failed to open checkpoint database {db_path}, checkpoints disabled: {e}")
+                self._conn = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._conn is not None
+
+    def load_row(self, row_key: str) -> Dict[str, Dict[str, Any]]:
+        """
+        Completed results of one row (cells older than the TTL are skipped)
+
+        Returns:
+            Dict mapping flow key -> result dict (empty if nothing is checkpointed)
+        """
+        if self._conn is None:
+            return {}
+        with self._lock:
+            try:
+                rows = self._conn.execute(
+                    "SELECT flow_name, value FROM batch_checkpoints WHERE row_key = ? AND created_at >= ?",
+                    (row_key, time.time() - self.ttl_seconds)
+                ).fetchall()
+            except sqlite3.Error as e:
+                logger.error(f"Checkpoint read failed: {e}")
+                return {}
+            self._hits += len(rows)
+        return {flow_name: json.loads(value) for flow_name, value in rows}
+
+    def save(self, row_key: str, flow_key: str, value: Dict[str, Any]) -> None:
+        """Persist one completed (row, flow) result (flow_key from flow_checkpoint_key)"""
+        if self._conn is None:
+            return
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO batch_checkpoints (row_key, flow_name, value, created_at) VALUES (?, ?, ?, ?)",
+                    (row_key, flow_key, json.dumps(value, ensure_ascii=False), time.time())
+                )
+                self._conn.commit()
+                self._writes += 1
+            except sqlite3.Error as e:
+                logger.error(f"Checkpoint write failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Stored cell count and resume counters"""
+        stored = 0
+        if self._conn is not None:
+            with self._lock:
+                stored = self._conn.execute("SELECT COUNT(*) FROM batch_checkpoints").fetchone()[0]
+        return {
+            "enabled": self.enabled,
+            "stored_cells": stored,
+            "resumed_cells": self._hits,
+            "written_cells": self._writes,
+        }
+
+    def clear(self) -> None:
+        """Drop all checkpoints"""
+        if self._conn is not None:
+            with self._lock:
+                self._conn.execute("DELETE FROM batch_checkpoints")
+                self._conn.commit()
+
+
+# Global checkpoint store
+checkpoint_store = CheckpointStore(
+    settings.CHECKPOINT_DB_PATH if settings.CHECKPOINT_ENABLED else None,
+    ttl_seconds=settings.CHECKPOINT_TTL_SECONDS,
+)
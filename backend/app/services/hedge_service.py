@@ -0,0 +1,186 @@
+"""
+Hedge Service - Hedged LLM Requests
+When a flow's model call has not returned by a percentile of that flow's
+recent call latency, a duplicate call is fired and whichever finishes first
+wins (the other is cancelled). A token-bucket budget caps the extra load.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from app.core.config import settings
+from app.core.metrics import REGISTRY
+
+HEDGES = REGISTRY.counter(
+    "llm_hedges_total",
+    "Hedged LLM calls by outcome (fired, won, lost, denied)",
+    ("flow", "outcome"),
+)
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class RequestHedger:
+    """
+    Per-flow latency tracker + hedging policy
+
+    Args:
+        percentile: Percentile of recent call latency after which a hedge fires
+        budget: Hedges allowed per primary call (e.g. 0.05 = at most ~5% extra calls)
+        min_samples: Recent calls needed before a flow is hedged
+        window: Recent call latencies kept per flow
+        max_burst: Hedge tokens that can accumulate while nothing is slow
+    """
+
+    def __init__(self, percentile: float = 95.0, budget: float = 0.05, min_samples: int = 20, window: int = 200, max_burst: float = 5.0):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.max_burst = max_burst
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._window = window
+        self._tokens = 0.0
+        self._stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "denied": 0}
+        # เวลารวมตั้งแต่เริ่ม primary จนได้ผล (รวมผลของ hedge) เพื่อดู tail latency
+        self._end_to_end: Deque[float] = deque(maxlen=window * 5)
+
+    def record_latency(self, flow: str, seconds: float) -> None:
+        """Latency of one model call (primary or hedge), from its start after the rate limiter"""
+        samples = self._latencies.get(flow)
+        if samples is None:
+            samples = self._latencies[flow] = deque(maxlen=self._window)
+        samples.append(seconds)
+
+    def hedge_delay(self, flow: str) -> Optional[float]:
+        """Seconds to wait before hedging this flow, None if not enough history"""
+        samples = self._latencies.get(flow)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        return _percentile(list(samples), self.percentile)
+
+    def _take_token(self) -> bool:
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        return False
+
+    async def run(self, flow: str, call: Callable[[Callable[[], None]], Awaitable[Any]]) -> Any:
+        """
+        Await call(started), hedging it with a second call if it is slow
+
+        call() gets a callback to invoke once its model call really starts
+        (after the rate limiter granted the slot). Latency is measured from
+        there and the hedge timer only runs after the primary has started,
+        so time queued for budget is neither recorded nor hedged. A call that
+        is cancelled after running longer than the hedge delay is recorded
+        with its elapsed time (a lower bound of its latency).
+
+        Returns the first successful result. If every started call fails,
+        the first error is raised. Pending calls are cancelled on return or
+        when the caller is cancelled.
+        """
+        self._stats["calls"] += 1
+        self._tokens = min(self.max_burst, self._tokens + self.budget)
+        start = time.perf_counter()
+        delay = self.hedge_delay(flow)
+        call_starts: Dict[int, float] = {}
+
+        async def timed(number: int, started: asyncio.Event):
+            def on_start():
+                call_starts[number] = time.perf_counter()
+                started.set()
+
+            try:
+                result = await call(on_start)
+            except asyncio.CancelledError:
+                elapsed = time.perf_counter() - call_starts[number] if number in call_starts else 0.0
+                if delay is not None and elapsed >= delay:
+                    self.record_latency(flow, elapsed)
+                raise
+            self.record_latency(flow, time.perf_counter() - call_starts.get(number, start))
+            return result
+
+        primary_started = asyncio.Event()
+        primary = asyncio.ensure_future(timed(0, primary_started))
+        tasks = [primary]
+        waiting = None
+        try:
+            if delay is not None:
+                # รอคิว rate limiter ไม่นับว่าช้า: เริ่มจับเวลาเมื่อ primary ได้ slot แล้ว
+                waiting = asyncio.ensure_future(primary_started.wait())
+                await asyncio.wait([primary, waiting], return_when=asyncio.FIRST_COMPLETED)
+                if not primary.done():
+                    remaining = delay - (time.perf_counter() - call_starts[0])
+                    done, _ = await asyncio.wait(tasks, timeout=max(0.0, remaining))
+                    if not done:
+                        if self._take_token():
+                            self._stats["hedged"] += 1
+                            HEDGES.inc(flow=flow, outcome="fired")
+                            tasks.append(asyncio.ensure_future(timed(1, asyncio.Event())))
+                        else:
+                            self._stats["denied"] += 1
+                            HEDGES.inc(flow=flow, outcome="denied")
+
+            first_error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(tasks) > 1:
+                            won = task is not primary
+                            self._stats["hedge_wins"] += won
+                            HEDGES.inc(flow=flow, outcome="won" if won else "lost")
+                        self._end_to_end.append(time.perf_counter() - start)
+                        return task.result()
+                    first_error = first_error or task.exception()
+            raise first_error
+        finally:
+            for task in tasks + ([waiting] if waiting else []):
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Hedge rate, win rate and latency percentiles
+        
+        Single-call latency counts cancelled slow calls only up to the moment
+        they were cancelled, so the gain over no hedging is measured by the
+        `hedging` benchmark scenario (same workload with hedging off / on).
+        """
+        calls = self._stats["calls"]
+        single = [seconds for samples in self._latencies.values() for seconds in samples]
+        end_to_end = list(self._end_to_end)
+        call_latency = {f"p{p}": _round(_percentile(single, p)) for p in (50, 95, 99)}
+        end_to_end_latency = {f"p{p}": _round(_percentile(end_to_end, p)) for p in (50, 95, 99)}
+        return {
+            "enabled": settings.HEDGE_ENABLED,
+            "percentile": self.percentile,
+            "budget": self.budget,
+            **self._stats,
+            "hedge_rate": round(self._stats["hedged"] / calls, 4) if calls else 0.0,
+            "hedge_win_rate": round(self._stats["hedge_wins"] / self._stats["hedged"], 4) if self._stats["hedged"] else 0.0,
+            "call_latency": call_latency,
+            "end_to_end_latency": end_to_end_latency,
+            "tokens": round(self._tokens, 2),
+            "hedge_delay_by_flow": {flow: _round(self.hedge_delay(flow)) for flow in self._latencies},
+        }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 4) if value is not None else None
+
+
+# Global hedger shared by all async classification calls
+request_hedger = RequestHedger(
+    percentile=settings.HEDGE_PERCENTILE,
+    budget=settings.HEDGE_BUDGET,
+    min_samples=settings.HEDGE_MIN_SAMPLES,
+)
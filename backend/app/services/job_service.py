@@ -0,0 +1,443 @@
+"""
+Job Service - Background CSV Classification Jobs
+Runs batch classification in the background and tracks progress so the
+HTTP request can return a job id immediately. The uploaded CSV is streamed
+through the (row, flow) scheduler and finished rows are appended to the
+result file in input order (written in a worker thread), so a job never
+holds the whole file in memory. Finished jobs are removed after
+JOB_TTL_SECONDS by a periodic cleanup. In multi-worker mode job status
+is published to the shared state, so any worker can report progress, serve
+results and forward cancellation to the worker that runs the job. Shared
+state (SQLite) is only accessed from worker threads.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.flows import FLOWS
+from app.services.shared_state import SharedState, shared_state
+from app.services.stream_service import classify_csv_to_file, open_csv_reader
+
+logger = logging.getLogger(__name__)
+
+# สถานะของ job
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+FINISHED_STATUSES = {JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED}
+
+# Multi-worker: ความถี่ในการ publish progress และ snapshot ผลบางส่วน / ตรวจคำขอ cancel
+PUBLISH_INTERVAL = 1.0
+PARTIAL_SNAPSHOT_INTERVAL = 5.0
+
+# ความถี่สูงสุดในการลบ job ที่หมดอายุ (ไม่ลบใน endpoint ที่อ่านสถานะ)
+CLEANUP_INTERVAL = 300.0
+
+
+@dataclass
+class ClassificationJob:
+    """State of one background CSV classification job"""
+    job_id: str
+    filename: str
+    source: Optional[BinaryIO]
+    output_path: Path
+    status: str = JOB_QUEUED
+    rows_total: int = 0
+    rows_done: int = 0
+    flows_total: int = 0
+    flows_done: int = 0
+    error_count: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = None
+    _row_progress: Dict[Any, int] = field(default_factory=dict)
+    # ขนาดของส่วนที่เขียนครบแล้ว (header + แถวที่เสร็จ) ในไฟล์ที่กำลังเขียน
+    _bytes_written: int = 0
+    _published_at: float = 0.0
+    _snapshot_at: float = 0.0
+    _snapshot_task: Optional[asyncio.Task] = None
+    # สถานะล่าสุดที่รอ publish (status, partial path, ตรวจไฟล์ partial) และ task ที่เขียนลง shared state
+    _pending_publish: Optional[Tuple[Dict[str, Any], Optional[Path], bool]] = None
+    _publish_task: Optional[asyncio.Task] = None
+
+    def record_result(self, idx, flow_name: str, output) -> None:
+        """Progress callback for each finished (row, flow)"""
+        self.flows_done += 1
+        if output.risk_level == "ไม่สามารถประเมินได้":
+            self.error_count += 1
+        done = self._row_progress.get(idx, 0) + 1
+        if done >= len(FLOWS):
+            self._row_progress.pop(idx, None)
+            self.rows_done += 1
+        else:
+            self._row_progress[idx] = done
+
+    @property
+    def eta_seconds(self) -> Optional[float]:
+        if self.status != JOB_RUNNING or not self.started_at or self.flows_done == 0:
+            return None
+        elapsed = time.time() - self.started_at
+        return round(elapsed / self.flows_done * (self.flows_total - self.flows_done), 1)
+
+    def to_status(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "filename": self.filename,
+            "rows_total": self.rows_total,
+            "rows_done": self.rows_done,
+            "flows_total": self.flows_total,
+            "flows_done": self.flows_done,
+            "error_count": self.error_count,
+            "eta_seconds": self.eta_seconds,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    @property
+    def partial_path(self) -> Path:
+        return self.output_path.with_name(f"{self.output_path.stem}_partial.csv")
+
+    @property
+    def work_path(self) -> Path:
+        """Result file while the job runs (renamed to output_path once completed)"""
+        return self.output_path.with_name(f"{self.output_path.name}.part")
+
+    def write_partial(self, size: int) -> Path:
+        """
+        Copy the first `size` bytes (complete rows) of the work file to
+        partial_path and return the path
+
+        Written to a temp file and renamed, so a download in progress never
+        sees a half-written file. Blocking: use snapshot_partial on the event loop.
+        """
+        tmp_path = self.partial_path.with_name(f"{self.partial_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(self.work_path, "rb") as src, open(tmp_path, "wb") as dst:
+                while size > 0:
+                    data = src.read(min(size, 1024 * 1024))
+                    if not data:
+                        break
+                    dst.write(data)
+                    size -= len(data)
+            os.replace(tmp_path, self.partial_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return self.partial_path
+
+    async def snapshot_partial(self) -> Path:
+        """write_partial in a worker thread (rows finished so far)"""
+        return await asyncio.to_thread(self.write_partial, self._bytes_written)
+
+    def close_source(self) -> None:
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+
+class JobManager:
+    """
+    Keeps track of background classification jobs
+
+    Jobs run in the process that accepted them. With `shared` state their
+    status is also published there (throttled, one write at a time per job
+    in a worker thread), so lookups, downloads and cancellation work from
+    any worker.
+
+    Args:
+        results_dir: Directory of the result CSV files
+        shared: Cross-worker state (multi-worker mode)
+        ttl_seconds: Seconds a finished job and its files are kept
+    """
+
+    def __init__(self, results_dir: Path, shared: Optional[SharedState] = None, ttl_seconds: float = 24 * 3600):
+        self.results_dir = results_dir
+        self.shared = shared
+        self.ttl_seconds = ttl_seconds
+        self._jobs: Dict[str, ClassificationJob] = {}
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    def start_cleanup(self) -> None:
+        """Start removing expired jobs periodically (call from the running event loop)"""
+        if self._cleanup_task is None or self._cleanup_task.done():
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop(min(self.ttl_seconds, CLEANUP_INTERVAL)))
+
+    async def stop_cleanup(self) -> None:
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            await asyncio.gather(self._cleanup_task, return_exceptions=True)
+            self._cleanup_task = None
+
+    async def _cleanup_loop(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict_expired()
+            except Exception as e:
+                logger.warning(f"Job cleanup failed: {e}")
+
+    def submit(self, source: BinaryIO, rows_total: int, llm, filename: str, max_concurrent: int) -> ClassificationJob:
+        """
+        Create a job and start it in the background
+
+        Args:
+            source: Uploaded CSV file, positioned at the start (closed by the job)
+            rows_total: Number of data rows in the CSV (count_csv_rows)
+            llm: LLM instance
+            filename: Original upload filename
+            max_concurrent: Per-job cap on concurrent LLM calls
+
+        Returns:
+            ClassificationJob: The queued job
+        """
+        job_id = uuid.uuid4().hex
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        job = ClassificationJob(
+            job_id=job_id,
+            filename=filename,
+            source=source,
+            output_path=self.results_dir / f"result_{job_id}.csv",
+            rows_total=rows_total,
+            flows_total=rows_total * len(FLOWS),
+        )
+        self._jobs[job_id] = job
+        self._publish(job, force=True)
+        job.task = asyncio.create_task(self._run(job, llm, max_concurrent))
+        logger.info(f"Submitted job {job_id} ({job.rows_total} rows)")
+        return job
+
+    def _publish(self, job: ClassificationJob, force: bool = False) -> None:
+        """Publish job status (and a partial result snapshot) to the shared state"""
+        if self.shared is None:
+            return
+        now = time.time()
+        if not force and now - job._published_at < PUBLISH_INTERVAL:
+            return
+        job._published_at = now
+        if job.status == JOB_RUNNING and job._bytes_written and (force or now - job._snapshot_at >= PARTIAL_SNAPSHOT_INTERVAL):
+            # Snapshot เขียนใน thread แล้ว publish path เมื่อเขียนเสร็จ
+            job._snapshot_at = now
+            asyncio.create_task(self._publish_snapshot(job))
+        self._queue_publish(job, check_partial=job.status in FINISHED_STATUSES)
+
+    def _queue_publish(self, job: ClassificationJob, partial_path: Optional[Path] = None, check_partial: bool = False) -> None:
+        """
+        Queue the current status for the shared state
+
+        Only the latest status waits; one task per job writes it in a worker
+        thread, so the event loop never waits on SQLite and an older status
+        never overwrites a newer one.
+        """
+        if job._pending_publish is not None:
+            _, pending_path, pending_check = job._pending_publish
+            partial_path = partial_path or pending_path
+            check_partial = check_partial or pending_check
+        job._pending_publish = (job.to_status(), partial_path, check_partial)
+        if job._publish_task is None or job._publish_task.done():
+            job._publish_task = asyncio.create_task(self._flush_publish(job))
+
+    async def _flush_publish(self, job: ClassificationJob) -> None:
+        while job._pending_publish is not None:
+            status, partial_path, check_partial = job._pending_publish
+            job._pending_publish = None
+            await asyncio.to_thread(self._save_shared, job, status, partial_path, check_partial)
+
+    async def _snapshot(self, job: ClassificationJob) -> Path:
+        """Snapshot the partial results (one write at a time per job, shared by concurrent callers)"""
+        if job._snapshot_task is None or job._snapshot_task.done():
+            job._snapshot_task = asyncio.create_task(job.snapshot_partial())
+        return await asyncio.shield(job._snapshot_task)
+
+    async def _publish_snapshot(self, job: ClassificationJob) -> None:
+        try:
+            partial_path = await self._snapshot(job)
+        except Exception as e:
+            logger.warning(f"Could not snapshot partial results of job {job.job_id}: {e}")
+            return
+        self._queue_publish(job, partial_path)
+
+    def _save_shared(self, job: ClassificationJob, status: Dict[str, Any], partial_path: Optional[Path], check_partial: bool) -> None:
+        """Write one status to the shared state (blocking: runs in a worker thread)"""
+        if partial_path is None and check_partial and job.partial_path.exists():
+            partial_path = job.partial_path
+        try:
+            self.shared.save_job(status, job.output_path, partial_path)
+        except Exception as e:
+            logger.warning(f"Could not publish status of job {job.job_id}: {e}")
+
+    def _on_result(self, job: ClassificationJob, idx, flow_name: str, output) -> None:
+        job.record_result(idx, flow_name, output)
+        self._publish(job)
+
+    async def _watch_cancel(self, job: ClassificationJob) -> None:
+        """Cancel the job when another worker requested it in the shared state"""
+        while True:
+            await asyncio.sleep(PUBLISH_INTERVAL)
+            if await asyncio.to_thread(self.shared.cancel_requested, job.job_id):
+                logger.info(f"Cancel of job {job.job_id} requested by another worker")
+                job.task.cancel()
+                return
+
+    async def _run(self, job: ClassificationJob, llm, max_concurrent: int) -> None:
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        self._publish(job, force=True)
+        watcher = asyncio.create_task(self._watch_cancel(job)) if self.shared is not None else None
+        try:
+            on_result = lambda idx, flow_name, output: self._on_result(job, idx, flow_name, output)
+            on_flush = lambda size: setattr(job, "_bytes_written", size)
+            reader = await asyncio.to_thread(open_csv_reader, job.source)
+            await classify_csv_to_file(
+                reader, llm, str(job.work_path), max_concurrent, source=job.source, on_result=on_result, on_flush=on_flush
+            )
+            await asyncio.to_thread(os.replace, job.work_path, job.output_path)
+            job.status = JOB_COMPLETED
+            logger.info(f"Job {job.job_id} completed")
+        except asyncio.CancelledError:
+            job.status = JOB_CANCELLED
+            logger.info(f"Job {job.job_id} cancelled after {job.flows_done}/{job.flows_total} flows")
+        except Exception as e:
+            job.status = JOB_FAILED
+            job.error = str(e)
+            logger.error(f"Job {job.job_id} failed: {e}", exc_info=True)
+        finally:
+            job.finished_at = time.time()
+            if watcher is not None:
+                watcher.cancel()
+            await self._finish_files(job)
+            self._publish(job, force=True)
+            if job._publish_task is not None:
+                await job._publish_task
+
+    async def _finish_files(self, job: ClassificationJob) -> None:
+        """Close the upload and, when not completed, keep the rows finished so far as partial results"""
+        job.close_source()
+        if job._snapshot_task is not None:
+            # ไม่ให้ snapshot เก่าเขียนทับผลบางส่วนสุดท้าย
+            await asyncio.gather(job._snapshot_task, return_exceptions=True)
+        if job.status != JOB_COMPLETED:
+            try:
+                if job._bytes_written:
+                    await job.snapshot_partial()
+            except Exception as e:
+                logger.error(f"Could not save partial results of job {job.job_id}: {e}")
+            await asyncio.to_thread(job.work_path.unlink, missing_ok=True)
+
+    async def evict_expired(self) -> int:
+        """
+        Remove jobs finished more than ttl_seconds ago and delete their result files
+
+        Returns:
+            int: Number of jobs removed
+        """
+        cutoff = time.time() - self.ttl_seconds
+        expired: Dict[str, Tuple[Path, Path]] = {}
+        for job_id, job in list(self._jobs.items()):
+            if job.status in FINISHED_STATUSES and job.finished_at and job.finished_at < cutoff:
+                del self._jobs[job_id]
+                expired[job_id] = (job.output_path, job.partial_path)
+        return await asyncio.to_thread(self._remove_expired, cutoff, expired)
+
+    def _remove_expired(self, cutoff: float, expired: Dict[str, Tuple[Path, Optional[Path]]]) -> int:
+        """Prune the shared job state and delete result files (blocking: runs in a worker thread)"""
+        if self.shared is not None:
+            # รวม job ของ worker อื่น (เช่น worker ที่ไม่อยู่แล้ว)
+            try:
+                for entry in self.shared.prune_jobs(cutoff):
+                    expired.setdefault(entry["status"]["job_id"], (entry["output_path"], entry["partial_path"]))
+            except Exception as e:
+                logger.warning(f"Could not prune shared job state: {e}")
+        for paths in expired.values():
+            for path in paths:
+                if path is not None:
+                    path.unlink(missing_ok=True)
+        if expired:
+            logger.info(f"Removed {len(expired)} expired jobs")
+        return len(expired)
+
+    def get(self, job_id: str) -> Optional[ClassificationJob]:
+        """Job run by this process"""
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[ClassificationJob]:
+        return list(self._jobs.values())
+
+    async def _load_shared(self, job_id: str) -> Optional[Dict[str, Any]]:
+        if self.shared is None:
+            return None
+        return await asyncio.to_thread(self.shared.load_job, job_id)
+
+    async def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Status of a job run by this or (multi-worker) any other worker"""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_status()
+        shared = await self._load_shared(job_id)
+        return shared["status"] if shared else None
+
+    async def statuses(self) -> List[Dict[str, Any]]:
+        """Status of every job (all workers in multi-worker mode)"""
+        if self.shared is None:
+            return [job.to_status() for job in self._jobs.values()]
+        entries = await asyncio.to_thread(self.shared.list_jobs)
+        local = {job_id: job.to_status() for job_id, job in self._jobs.items()}
+        return [local.get(entry["status"]["job_id"], entry["status"]) for entry in entries]
+
+    async def result_file(self, job_id: str) -> Optional[Tuple[Path, bool]]:
+        """
+        (path, is_partial) of the results to download: the final CSV once
+        completed, otherwise the partial results (for a job run by another
+        worker, its latest snapshot). None if nothing can be served.
+        """
+        job = self._jobs.get(job_id)
+        if job is not None:
+            if job.status == JOB_COMPLETED and job.output_path.exists():
+                return job.output_path, False
+            if job.status == JOB_RUNNING and job._bytes_written:
+                return await self._snapshot(job), True
+            return (job.partial_path, True) if job.partial_path.exists() else None
+        shared = await self._load_shared(job_id)
+        if shared is None:
+            return None
+        if shared["status"]["status"] == JOB_COMPLETED and shared["output_path"].exists():
+            return shared["output_path"], False
+        if shared["partial_path"] is not None and shared["partial_path"].exists():
+            return shared["partial_path"], True
+        return None
+
+    async def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Cancel a running job; completed results stay downloadable"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            # Job ของ worker อื่น: ส่งคำขอผ่าน shared state
+            shared = await self._load_shared(job_id)
+            if shared is None:
+                return None
+            await asyncio.to_thread(self.shared.request_cancel, job_id)
+            return shared["status"]
+        if job.status not in FINISHED_STATUSES and job.task is not None:
+            if job.status == JOB_QUEUED:
+                # Task has not started yet, so _run will not record the cancellation
+                job.status = JOB_CANCELLED
+                job.finished_at = time.time()
+                job.close_source()
+                self._publish(job, force=True)
+            job.task.cancel()
+        return job.to_status()
+
+
+# Global job manager instance
+job_manager = JobManager(settings.RESULTS_DIR, shared=shared_state, ttl_seconds=settings.JOB_TTL_SECONDS)
@@ -0,0 +1,268 @@
+"""
+LLM Pool - Several Gemini Clients Behind One Chat Model
+Builds one client per (API key, model name) from GOOGLE_API_KEYS and
+LLM_POOL_MODELS. Each client keeps its own HTTP connections (its own
+genai.Client) and its own quota accounting (an AdaptiveRateLimiter); every
+call goes to the least-loaded healthy client, and a client that returns a
+quota error is parked for a while and the call moves to the next one. The
+model of the client that answered is stamped on the response message
+(POOL_MODEL_KEY), so results are cached, logged and metered under it.
+"""
+import logging
+import re
+import time
+from itertools import product
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableBinding, RunnableSequence
+from pydantic import ConfigDict
+
+from app.core.config import settings
+from app.core.metrics import REGISTRY
+from app.services.rate_limiter import AdaptiveRateLimiter, estimate_tokens, is_rate_limit_error, worker_share
+from app.services.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+POOL_CALLS = REGISTRY.counter(
+    "llm_pool_calls_total",
+    "LLM pool calls by client and outcome (ok, error, rate_limited)",
+    ("client", "outcome"),
+)
+
+# response_metadata key: model ของ client ที่ตอบ
+POOL_MODEL_KEY = "pool_model"
+
+# "retry in 17s" / "retryDelay": "17s" ในข้อความ error ของ Gemini
+_RETRY_DELAY_RE = re.compile(r"retry(?:_delay|Delay)?\W{0,4}(?:in\s+)?(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+
+def pool_client_configs() -> List[Tuple[str, str, str]]:
+    """(client name, API key, model name) of every pool client"""
+    keys = settings.GOOGLE_API_KEYS or [settings.GOOGLE_API_KEY]
+    models = settings.LLM_POOL_MODELS or [settings.MODEL_NAME]
+    # ไม่แสดง API key ใน stats / metrics: ใช้ลำดับของ key แทน
+    return [(f"key{index}/{model}", key, model) for (index, key), model in product(enumerate(keys, 1), models)]
+
+
+def retry_delay(error: BaseException, default: float) -> float:
+    """Seconds to park a client after a quota error (provider's retry hint if present)"""
+    match = _RETRY_DELAY_RE.search(str(error))
+    return float(match.group(1)) if match else default
+
+
+class PooledClient:
+    """One LLM client with its own limiter and parking state"""
+
+    def __init__(self, name: str, llm, limiter: AdaptiveRateLimiter, model_name: str = None):
+        self.name = name
+        self.llm = llm
+        self.limiter = limiter
+        self.model_name = model_name or settings.MODEL_NAME
+        self.parked_until = 0.0
+        self._stats = {"calls": 0, "errors": 0, "rate_limited": 0, "parked": 0}
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.parked_until
+
+    @property
+    def load(self) -> float:
+        """In-flight + queued calls relative to the client's current concurrency limit"""
+        return (self.limiter._in_flight + self.limiter._waiting) / max(self.limiter.concurrency_limit, 1.0)
+
+    def park(self, seconds: float) -> None:
+        self.parked_until = time.monotonic() + seconds
+        self._stats["parked"] += 1
+        logger.warning(f"LLM pool client {self.name} parked for {seconds:.0f}s after a quota error")
+
+    def record(self, error: Optional[BaseException] = None, started_at: Optional[float] = None) -> str:
+        """Count one call, returns the outcome label"""
+        self._stats["calls"] += 1
+        self.limiter.record_outcome(error, started_at)
+        if error is None:
+            outcome = "ok"
+        elif is_rate_limit_error(error):
+            outcome = "rate_limited"
+            self._stats["rate_limited"] += 1
+        else:
+            outcome = "error"
+            self._stats["errors"] += 1
+        POOL_CALLS.inc(client=self.name, outcome=outcome)
+        return outcome
+
+    def stats(self) -> Dict[str, Any]:
+        limiter = self.limiter.stats()
+        return {
+            "healthy": self.healthy,
+            "parked_for_seconds": round(max(0.0, self.parked_until - time.monotonic()), 1),
+            **self._stats,
+            "in_flight": limiter["in_flight"],
+            "queue_depth": limiter["queue_depth"],
+            "concurrency_limit": limiter["concurrency_limit"],
+            "requests_last_minute": limiter["requests_last_minute"],
+            "tokens_last_minute": limiter["tokens_last_minute"],
+        }
+
+
+class LLMClientPool(BaseChatModel):
+    """
+    Chat model that routes each call to one of several clients
+
+    A call goes to the least-loaded healthy client and waits for that
+    client's own RPM/TPM/concurrency budget. On a quota error the client is
+    parked (provider retry hint or `park_seconds`) and the call is retried on
+    the next healthy client; other errors are raised to the caller. When every
+    client is parked, the one that unparks first is tried.
+
+    Args:
+        clients: Pool clients
+        park_seconds: Default parking time after a quota error
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    clients: List[Any]
+    park_seconds: float = 60.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "llm-pool"
+
+    @property
+    def model_names(self) -> List[str]:
+        """Distinct models of the clients, in client order"""
+        return list(dict.fromkeys(client.model_name for client in self.clients))
+
+    def with_structured_output(self, schema, **kwargs):
+        """
+        Structured output of the pooled clients: the provider options
+        (response schema) are bound to the pool and forwarded to whichever
+        client serves the call
+        """
+        structured = self.clients[0].llm.with_structured_output(schema, **kwargs)
+        if not isinstance(structured, RunnableSequence) or not isinstance(structured.first, RunnableBinding):
+            raise NotImplementedError("Pooled model does not bind structured output options")
+        return RunnableSequence(self.bind(**structured.first.kwargs), *structured.steps[1:])
+
+    def pick(self, exclude: Tuple[PooledClient, ...] = ()) -> Optional[PooledClient]:
+        """Least-loaded healthy client (or the first to unpark if none is healthy)"""
+        candidates = [client for client in self.clients if client not in exclude]
+        if not candidates:
+            return None
+        healthy = [client for client in candidates if client.healthy]
+        if not healthy:
+            return min(candidates, key=lambda client: client.parked_until)
+        # Tiebreak: คำขอใน window ของ client นี้ (นับใน memory ไม่ต้อง prune หรืออ่าน shared state)
+        return min(healthy, key=lambda client: (client.load, len(client.limiter._requests)))
+
+    def _on_error(self, client: PooledClient, error: BaseException, started_at: float) -> bool:
+        """Record a failed call; True if the call should move to another client"""
+        if client.record(error, started_at) != "rate_limited":
+            return False
+        client.park(retry_delay(error, self.park_seconds))
+        return True
+
+    @staticmethod
+    def _result(client: PooledClient, message: BaseMessage) -> ChatResult:
+        client.record()
+        message.response_metadata[POOL_MODEL_KEY] = client.model_name
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        tokens = estimate_tokens(*(str(message.content) for message in messages))
+        tried: Tuple[PooledClient, ...] = ()
+        while True:
+            client = self.pick(tried)
+            started_at = time.monotonic()
+            try:
+                # Blocking caller (worker thread): same per-client budget as _agenerate
+                with client.limiter.acquire_blocking(tokens) as started_at:
+                    message = client.llm.invoke(messages, stop=stop, **kwargs)
+            except Exception as e:
+                tried += (client,)
+                if not self._on_error(client, e, started_at) or len(tried) == len(self.clients):
+                    raise
+                continue
+            return self._result(client, message)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        tokens = estimate_tokens(*(str(message.content) for message in messages))
+        tried: Tuple[PooledClient, ...] = ()
+        while True:
+            client = self.pick(tried)
+            # เวลาเริ่มเมื่อได้ slot (ถ้าล้มเหลวก่อนได้ slot ถือว่าเริ่มตอนนี้)
+            started_at = time.monotonic()
+            try:
+                async with client.limiter.acquire(tokens) as started_at:
+                    message = await client.llm.ainvoke(messages, stop=stop, **kwargs)
+            except Exception as e:
+                tried += (client,)
+                if not self._on_error(client, e, started_at) or len(tried) == len(self.clients):
+                    raise
+                continue
+            return self._result(client, message)
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-client health, load and quota counters"""
+        clients = {client.name: client.stats() for client in self.clients}
+        return {
+            "pooled": True,
+            "clients": len(self.clients),
+            "healthy_clients": sum(client.healthy for client in self.clients),
+            "per_client": clients,
+        }
+
+
+# Pool ที่ build_pooled_llm สร้าง (None = ใช้ client เดียว)
+_client_pool: Optional[LLMClientPool] = None
+
+
+def build_pooled_llm():
+    """
+    Chat model for the deployment: a single Gemini client when only one
+    (key, model) is configured, otherwise an LLMClientPool over all of them
+    """
+    global _client_pool
+    from app.services.risk_service import build_llm
+
+    configs = pool_client_configs()
+    if len(configs) == 1:
+        _, key, model = configs[0]
+        return build_llm(key, model)
+
+    clients = [
+        PooledClient(
+            name=name,
+            llm=build_llm(key, model),
+            limiter=AdaptiveRateLimiter(
+                max_concurrency=worker_share(settings.MAX_CONCURRENT_REQUESTS),
+                rpm=settings.LLM_RPM_LIMIT,
+                tpm=settings.LLM_TPM_LIMIT,
+                shared=shared_state,
+                scope=f"client:{name}",
+            ),
+            model_name=model,
+        )
+        for name, key, model in configs
+    ]
+    _client_pool = LLMClientPool(clients=clients, park_seconds=settings.LLM_POOL_PARK_SECONDS)
+    logger.info(f"LLM pool with {len(clients)} clients: {[client.name for client in clients]}")
+    return _client_pool
+
+
+def pool_stats() -> Dict[str, Any]:
+    """Stats of the pool in use ({"pooled": False} with a single client)"""
+    if _client_pool is None:
+        return {"pooled": False, "clients": 1}
+    return _client_pool.stats()
+
+
+REGISTRY.gauge(
+    "llm_pool_healthy_clients",
+    "LLM pool clients not parked after a quota error",
+    lambda: sum(client.healthy for client in _client_pool.clients) if _client_pool else 1,
+)
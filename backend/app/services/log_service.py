@@ -1,25 +1,40 @@
 """
 Log Service - Google Sheets Integration
-Handles logging form data and results to Google Sheets
+Handles logging form data and results to Google Sheets.
+Rows are stored locally first (submission_store) and replicated to the
+sheets in batches with one append_rows call per sheet, using a single
+authorized client.
 """
 import os
 import gspread
 import json
+import asyncio
 import logging
+import threading
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 from google.oauth2.service_account import Credentials
 
 from app.core.config import settings
 from app.services.risk_service import FIELD_LABELS
+from app.services.submission_store import SubmissionStore, submission_store
+from app.services.shared_state import shared_state
 
 logger = logging.getLogger(__name__)
 
+# Authorized client และ worksheet handles ที่ใช้ซ้ำทั้ง process
+_client_lock = threading.Lock()
+_spreadsheet = None
+_worksheets: Dict[str, Any] = {}
+
 
 def get_sheet_by_name(sheet_name: str):
     """
     Get a worksheet by name from the configured Google Spreadsheet
     
+    The authorized client, spreadsheet and worksheet handles are created
+    once and reused for the lifetime of the process.
+    
     Args:
         sheet_name: Name of the worksheet to retrieve
         
@@ -36,19 +51,29 @@ def get_sheet_by_name(sheet_name: str):
     if not settings.SPREADSHEET_ID:
         raise ValueError("SPREADSHEET_ID not configured")
     
+    global _spreadsheet
+    
     try:
-        service_account_info = json.loads(settings.GOOGLE_SERVICE_ACCOUNT_JSON)
-        
-        scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-        credentials = Credentials.from_service_account_info(
-            service_account_info,
-            scopes=scopes
-        )
-        
-        client = gspread.authorize(credentials)
-        spreadsheet = client.open_by_key(settings.SPREADSHEET_ID)
-        
-        return spreadsheet.worksheet(sheet_name)
+        with _client_lock:
+            worksheet = _worksheets.get(sheet_name)
+            if worksheet is not None:
+                return worksheet
+            
+            if _spreadsheet is None:
+                service_account_info = json.loads(settings.GOOGLE_SERVICE_ACCOUNT_JSON)
+                
+                scopes = ["https://www.googleapis.com/auth/spreadsheets"]
+                credentials = Credentials.from_service_account_info(
+                    service_account_info,
+                    scopes=scopes
+                )
+                
+                client = gspread.authorize(credentials)
+                _spreadsheet = client.open_by_key(settings.SPREADSHEET_ID)
+            
+            worksheet = _spreadsheet.worksheet(sheet_name)
+            _worksheets[sheet_name] = worksheet
+            return worksheet
     except json.JSONDecodeError as e:
         logger.error(f"Invalid JSON in GOOGLE_SERVICE_ACCOUNT_JSON: {e}")
         raise ValueError("Invalid service account JSON configuration")
@@ -59,6 +84,33 @@ def get_sheet_by_name(sheet_name: str):
         logger.error(f"Failed to access Google Sheets: {e}")
         raise
 
+def build_raw_input_row(data: Dict[str, Any], FORM_COLUMNS: List[str]) -> List[Any]:
+    """
+    Build the raw_input sheet row for form data
+    
+    Args:
+        data: Form data dictionary with English field names (age, gender, etc.)
+        FORM_COLUMNS: List of column names in Thai (อายุ, เพศ, etc.)
+    """
+    # Create reverse mapping: Thai label -> English field name
+    label_to_field = {v: k for k, v in FIELD_LABELS.items()}
+    
+    row = [datetime.now().isoformat()]
+    for col in FORM_COLUMNS[1:]:  # Skip first column (Timestamp)
+        # Get English field name from Thai column name
+        field_name = label_to_field.get(col)
+        if field_name:
+            value = data.get(field_name)
+            # Convert lists to comma-separated strings
+            if isinstance(value, list):
+                value = ", ".join(str(v) for v in value)
+            row.append(value)
+        else:
+            # Column not in mapping, leave empty
+            row.append(None)
+    return row
+
+
 def append_raw_input(data: Dict[str, Any], FORM_COLUMNS: List[str]) -> None:
     """
     Append raw form input to Google Sheets
@@ -69,13 +121,42 @@ def append_raw_input(data: Dict[str, Any], FORM_COLUMNS: List[str]) -> None:
     """
     try:
         sheet = get_sheet_by_name("raw_input")
-        
-        # Create reverse mapping: Thai label -> English field name
-        label_to_field = {v: k for k, v in FIELD_LABELS.items()}
-        
-        row = [datetime.now().isoformat()]
-        for col in FORM_COLUMNS[1:]:  # Skip first column (Timestamp)
-            # Get English field name from Thai column name
+        row = build_raw_input_row(data, FORM_COLUMNS)
+        sheet.append_row(row, value_input_option="USER_ENTERED")
+        logger.info(f"Successfully appended raw input to Google Sheets")
+    except Exception as e:
+        logger.error(f"Failed to append raw input to Google Sheets: {e}")
+        raise
+
+
+def build_result_row(
+    data: Dict[str, Any], 
+    ai_results: Dict[str, Dict[str, str]], 
+    FORM_COLUMNS: List[str]
+) -> List[Any]:
+    """
+    Build the input_with_result sheet row for form data and AI results
+    
+    Args:
+        data: Form data dictionary
+        ai_results: Dictionary mapping flow names to their risk assessment results
+                   Each result should contain: risk_level, reason, recommendation
+                   (and model, the model that answered)
+        FORM_COLUMNS: List of column names
+    """
+    # Create reverse mapping: Thai label -> English field name
+    label_to_field = {v: k for k, v in FIELD_LABELS.items()}
+    
+    # Debug: Log incoming data
+    logger.info(f"Incoming data keys: {list(data.keys())[:10]}")
+    
+    # Build base row with form data
+    row = []
+    for col in FORM_COLUMNS:
+        if col == "Timestamp":
+            row.append(datetime.now().isoformat())
+        else:
+            # Map Thai column name to English field name
             field_name = label_to_field.get(col)
             if field_name:
                 value = data.get(field_name)
@@ -84,14 +165,30 @@ def append_raw_input(data: Dict[str, Any], FORM_COLUMNS: List[str]) -> None:
                     value = ", ".join(str(v) for v in value)
                 row.append(value)
             else:
-                # Column not in mapping, leave empty
                 row.append(None)
-        
-        sheet.append_row(row, value_input_option="USER_ENTERED")
-        logger.info(f"Successfully appended raw input to Google Sheets")
-    except Exception as e:
-        logger.error(f"Failed to append raw input to Google Sheets: {e}")
-        raise
+    
+    # Add AI results for each flow
+    for flow_name, result in ai_results.items():
+        row.extend([
+            flow_name,
+            result.get("risk_level", "N/A"),
+            result.get("reason", "N/A"),
+            result.get("recommendation", "N/A")
+        ])
+    
+    logger.info(f"Total row length: {len(row)} (should match sheet columns)")
+    
+    # Add metadata: model ที่ตอบจริง (LLM pool อาจมีหลาย model)
+    models = dict.fromkeys(
+        result["model"] for result in ai_results.values() if isinstance(result, dict) and result.get("model")
+    )
+    row.extend([
+        ", ".join(models) or settings.MODEL_NAME,
+        datetime.now().isoformat()
+    ])
+    return row
+
+
 def append_with_result(
     data: Dict[str, Any], 
     ai_results: Dict[str, Dict[str, str]], 
@@ -108,60 +205,162 @@ def append_with_result(
     """
     try:
         sheet = get_sheet_by_name("input_with_result")
-        
-        # Create reverse mapping: Thai label -> English field name
-        label_to_field = {v: k for k, v in FIELD_LABELS.items()}
-        
-        # Debug: Log incoming data
-        logger.info(f"Incoming data keys: {list(data.keys())[:10]}")
-        logger.info(f"Data has 'age': {('age' in data)}, value: {data.get('age')}")
-        logger.info(f"Data has 'gender': {('gender' in data)}, value: {data.get('gender')}")
-        
-        # Debug: Log FORM_COLUMNS
-        logger.info(f"FORM_COLUMNS has {len(FORM_COLUMNS)} columns")
-        logger.info(f"First 5 FORM_COLUMNS: {FORM_COLUMNS[:5]}")
-        
-        # Build base row with form data
-        row = []
-        for col in FORM_COLUMNS:
-            if col == "Timestamp":
-                timestamp_value = datetime.now().isoformat()
-                row.append(timestamp_value)
-                logger.info(f"Added Timestamp: {timestamp_value}")
-            else:
-                # Map Thai column name to English field name
-                field_name = label_to_field.get(col)
-                if field_name:
-                    value = data.get(field_name)
-                    # Convert lists to comma-separated strings
-                    if isinstance(value, list):
-                        value = ", ".join(str(v) for v in value)
-                    row.append(value)
-                else:
-                    row.append(None)
-        
-        # Add AI results for each flow
-        for flow_name, result in ai_results.items():
-            row.extend([
-                flow_name,
-                result.get("risk_level", "N/A"),
-                result.get("reason", "N/A"),
-                result.get("recommendation", "N/A")
-            ])
-        
-        logger.info(f"Total row length: {len(row)} (should match sheet columns)")
-        logger.info(f"First 5 values in row: {row[:5]}")
-        
-        # Add metadata
-        row.extend([
-            settings.MODEL_NAME,
-            datetime.now().isoformat()
-        ])
-        
+        row = build_result_row(data, ai_results, FORM_COLUMNS)
         sheet.append_row(row, value_input_option="USER_ENTERED")
         logger.info(f"Successfully appended form with results to Google Sheets ({len(ai_results)} flows)")
     except Exception as e:
         logger.error(f"Failed to append form with results to Google Sheets: {e}")
         raise
 
-    
+
+def is_sheets_quota_error(error: BaseException) -> bool:
+    """True if the Sheets API rejected the call for quota / rate limit reasons"""
+    message = str(error)
+    return "429" in message or "RATE_LIMIT_EXCEEDED" in message or "Quota exceeded" in message
+
+
+class SheetsReplicator:
+    """
+    Replicates the local submission store to Google Sheets
+
+    Rows are written to the local store first (the request returns right
+    away). A background loop appends rows above each sheet's high-water
+    mark with one append_rows call per sheet, whenever the batch size is
+    reached or the flush interval elapses, and then advances the mark.
+    On errors (quota or outage) the rows stay in the store and are
+    retried with exponential backoff, so nothing is lost.
+    With several workers only the holder of the shared "sheets_replicator"
+    lease syncs, so rows are not appended twice.
+
+    Args:
+        store: Local submission store
+        batch_size: Max rows per append_rows call
+        flush_interval: Sync unsent rows at least this often (seconds)
+        max_backoff: Upper bound of the retry delay after errors (seconds)
+    """
+
+    def __init__(self, store: SubmissionStore, batch_size: int = 50, flush_interval: float = 2.0, max_backoff: float = 60.0):
+        self.store = store
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._unflushed = 0
+        self._written = 0
+        self._batches = 0
+        self._errors = 0
+        self._last_error: Optional[str] = None
+
+    def start(self) -> None:
+        """Start the background replication loop (call from the running event loop)"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Make a final sync attempt and stop the loop (unsent rows stay in the store)"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def submit(self, sheet_name: str, row: List[Any], session_id: Optional[str] = None) -> int:
+        """Store one row locally and schedule its replication (returns the local id)"""
+        row_id = self.store.add(sheet_name, row, session_id)
+        self._unflushed += 1
+        if self._wakeup is not None and self._unflushed >= self.batch_size:
+            self._wakeup.set()
+        return row_id
+
+    async def _run(self) -> None:
+        backoff = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=backoff or self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._unflushed = 0
+            
+            try:
+                if not await self._is_leader():
+                    if self._stopping:
+                        return
+                    continue
+                ok = await self.sync_once()
+            except Exception as e:
+                # Unexpected error (e.g. local store / shared state): back off and keep the loop alive
+                self._errors += 1
+                self._last_error = str(e)[:200]
+                logger.error(f"Google Sheets replication loop error, retrying: {e}", exc_info=True)
+                ok = False
+            if self._stopping:
+                return
+            backoff = 0.0 if ok else min(self.max_backoff, max(1.0, backoff * 2))
+
+    async def _is_leader(self) -> bool:
+        """True if this process should replicate (always, with a single worker)"""
+        if shared_state is None:
+            return True
+        # Lease นานกว่ารอบที่ช้าที่สุด (backoff สูงสุด) เพื่อไม่ให้ worker อื่นแย่งกลางรอบ
+        return await asyncio.to_thread(
+            shared_state.try_lease, "sheets_replicator", 3 * max(self.max_backoff, self.flush_interval)
+        )
+
+    async def sync_once(self) -> bool:
+        """
+        Append all unsent rows of every sheet
+
+        Returns:
+            bool: False if an error stopped the sync (rows stay pending)
+        """
+        for sheet_name in await asyncio.to_thread(self.store.sheet_names):
+            while True:
+                pending = await asyncio.to_thread(self.store.fetch_unsent, sheet_name, self.batch_size)
+                if not pending:
+                    break
+                rows = [row for _, row in pending]
+                try:
+                    sheet = await asyncio.to_thread(get_sheet_by_name, sheet_name)
+                    await asyncio.to_thread(sheet.append_rows, rows, value_input_option="USER_ENTERED")
+                except Exception as e:
+                    self._errors += 1
+                    self._last_error = str(e)[:200]
+                    if is_sheets_quota_error(e):
+                        logger.warning(f"Google Sheets quota exceeded, {len(rows)}+ row(s) for '{sheet_name}' stay pending")
+                    else:
+                        logger.error(f"Failed to replicate to Google Sheets '{sheet_name}': {e}")
+                    return False
+                await asyncio.to_thread(self.store.mark_sent, sheet_name, pending[-1][0])
+                self._written += len(rows)
+                self._batches += 1
+                logger.info(f"Replicated {len(rows)} row(s) to Google Sheets '{sheet_name}'")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """Replication counters and per-sheet pending rows"""
+        return {
+            "running": self.running,
+            "written": self._written,
+            "batches": self._batches,
+            "errors": self._errors,
+            "last_error": self._last_error,
+            "sheets": self.store.stats(),
+        }
+
+
+# Global replicator (started by the app lifespan)
+sheets_replicator = SheetsReplicator(
+    submission_store,
+    batch_size=settings.LOG_BATCH_SIZE,
+    flush_interval=settings.LOG_FLUSH_INTERVAL,
+)
@@ -0,0 +1,352 @@
+"""
+Rate Limiter Service - Process-wide Adaptive Limiter for LLM Calls
+Enforces requests-per-minute, tokens-per-minute and concurrency budgets
+shared by every classification entry point. Backs off multiplicatively on
+quota errors (429 / ResourceExhausted) and ramps up additively on success.
+Async callers use acquire(); synchronous callers (worker threads) use
+acquire_blocking() and draw on the same budget.
+"""
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+import math
+from collections import deque
+from typing import Any, Dict, Optional
+
+from app.core.config import settings
+from app.core.metrics import REGISTRY, RATE_LIMITED
+from app.services.shared_state import SharedState, shared_state
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60.0
+
+
+def estimate_tokens(*texts: str, output_tokens: int = 256) -> int:
+    """Rough token estimate for budgeting (ภาษาไทย ~3 ตัวอักษรต่อ token)"""
+    return sum(len(text or "") for text in texts) // 3 + output_tokens
+
+
+def worker_share(limit: int) -> int:
+    """Per-worker part of a deployment-wide limit (multi-worker mode)"""
+    return max(1, math.ceil(limit / settings.WORKERS))
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """True if the exception is a provider quota / rate-limit error"""
+    name = type(error).__name__
+    message = str(error)
+    return (
+        name in ("ResourceExhausted", "TooManyRequests", "RateLimitError")
+        or "429" in message
+        or "RESOURCE_EXHAUSTED" in message
+        or "rate limit" in message.lower()
+    )
+
+
+class AdaptiveRateLimiter:
+    """
+    AIMD limiter shared by all LLM calls in the process
+
+    Args:
+        max_concurrency: Upper bound of concurrent in-flight calls
+        rpm: Upper bound of requests per minute (0 = unlimited)
+        tpm: Tokens per minute budget (0 = unlimited)
+        decrease_factor: Multiplier applied to the limits on a quota error
+        min_concurrency: Lower bound of the adaptive concurrency limit
+        min_rpm: Lower bound of the adaptive requests-per-minute limit
+        shared: Cross-worker state; when given, the RPM/TPM windows are
+                counted over all workers (concurrency stays per process)
+        scope: Name of the shared windows (one per quota, e.g. per API key)
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        rpm: int = 0,
+        tpm: int = 0,
+        decrease_factor: float = 0.5,
+        min_concurrency: int = 1,
+        min_rpm: int = 1,
+        shared: Optional[SharedState] = None,
+        scope: str = "global",
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_rpm = rpm
+        self.tpm = tpm
+        self.decrease_factor = decrease_factor
+        self.min_concurrency = min_concurrency
+        self.min_rpm = min_rpm
+        self.shared = shared
+        self.scope = scope
+
+        self.concurrency_limit = float(self.max_concurrency)
+        self.rpm_limit = float(rpm)
+
+        self._requests: deque = deque()
+        self._tokens: deque = deque()
+        self._token_total = 0
+        self._in_flight = 0
+        self._waiting = 0
+        # Counter ใช้ร่วมกันระหว่าง event loop กับ thread ที่เรียกแบบ sync
+        self._state_lock = threading.Lock()
+        self._released = threading.Condition()
+        self._reserve_lock: Optional[asyncio.Lock] = None
+        self._lock_loop = None
+        self._waiters: set = set()
+
+        self._acquired = 0
+        self._rate_limited = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_decrease = float("-inf")
+        self._ignored_rate_limited = 0
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._reserve_lock is None or self._lock_loop is not loop:
+            self._reserve_lock = asyncio.Lock()
+            self._lock_loop = loop
+            self._waiters = set()
+        return self._reserve_lock
+
+    @staticmethod
+    def _wake(waiter: asyncio.Future) -> None:
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def _wake_all(self) -> None:
+        for waiter in list(self._waiters):
+            self._wake(waiter)
+
+    def _prune(self, now: float) -> None:
+        while self._requests and now - self._requests[0] >= WINDOW_SECONDS:
+            self._requests.popleft()
+        while self._tokens and now - self._tokens[0][0] >= WINDOW_SECONDS:
+            self._token_total -= self._tokens.popleft()[1]
+
+    def _count(self, now: float, tokens: int) -> None:
+        self._requests.append(now)
+        if tokens:
+            self._tokens.append((now, tokens))
+            self._token_total += tokens
+
+    def _take_slot(self, tokens: int) -> float:
+        """
+        Take an in-flight slot (and, without shared state, the RPM/TPM budget)
+
+        Returns 0 when taken, otherwise the seconds to wait.
+        """
+        with self._state_lock:
+            now = time.monotonic()
+            self._prune(now)
+            if self._in_flight >= int(self.concurrency_limit):
+                return 1.0  # woken earlier when a slot is released
+            if self.shared is None:
+                if self.max_rpm and len(self._requests) >= int(self.rpm_limit):
+                    return max(0.01, self._requests[0] + WINDOW_SECONDS - now)
+                if self.tpm and self._tokens and self._token_total + tokens > self.tpm:
+                    return max(0.01, self._tokens[0][0] + WINDOW_SECONDS - now)
+                self._count(now, tokens)
+            self._in_flight += 1
+            return 0.0
+
+    def _reserve_shared(self, tokens: int) -> float:
+        """
+        Reserve RPM/TPM in the windows of all workers for a slot taken by
+        _take_slot (blocking SQLite transaction); the slot is given back when
+        the windows are full
+
+        Returns 0 when reserved, otherwise the seconds to wait.
+        """
+        delay = 0.0
+        if self.max_rpm or self.tpm:
+            # ไม่รอใน transaction: ได้เวลาที่ต้องรอกลับมา
+            delay = self.shared.reserve_quota(self.scope, tokens, int(self.rpm_limit) if self.max_rpm else 0, self.tpm)
+        if delay:
+            self._release()
+        else:
+            with self._state_lock:
+                self._count(time.monotonic(), tokens)
+        return delay
+
+    def _release(self) -> None:
+        """Give back an in-flight slot and wake the callers waiting for one"""
+        with self._state_lock:
+            self._in_flight -= 1
+        with self._released:
+            self._released.notify_all()
+        loop = self._lock_loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._wake_all()
+        else:
+            loop.call_soon_threadsafe(self._wake_all)
+
+    def _record_wait(self, start: float) -> None:
+        waited = time.monotonic() - start
+        with self._state_lock:
+            self._acquired += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+
+    def _add_waiting(self, count: int) -> None:
+        with self._state_lock:
+            self._waiting += count
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, tokens: int = 0):
+        """
+        Wait for budget, then hold one in-flight slot for the duration of the block
+
+        Yields the (monotonic) time the call started, to pass to record_outcome.
+
+        Args:
+            tokens: Estimated tokens of the call (prompt + expected output)
+        """
+        lock = self._get_lock()
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        self._add_waiting(1)
+        try:
+            while True:
+                # จองทีละ call: การตรวจ limit กับการจองใน shared state ไม่สลับกัน
+                async with lock:
+                    delay = self._take_slot(tokens)
+                    if delay == 0 and self.shared is not None:
+                        # SQLite transaction อาจรอ lock ของ worker อื่น: รันใน thread เพื่อไม่ให้ event loop ค้าง
+                        delay = await asyncio.to_thread(self._reserve_shared, tokens)
+                if delay == 0:
+                    break
+                # รอจนมี slot คืนหรือครบเวลา (future + timer แทน wait_for(condition.wait()):
+                # task ที่ถูก cancel ซ้อนกันจะออกจาก condition โดยไม่ถือ lock)
+                waiter = loop.create_future()
+                self._waiters.add(waiter)
+                timer = loop.call_later(delay, self._wake, waiter)
+                try:
+                    await waiter
+                finally:
+                    timer.cancel()
+                    self._waiters.discard(waiter)
+        finally:
+            self._add_waiting(-1)
+
+        self._record_wait(start)
+        try:
+            yield time.monotonic()
+        finally:
+            self._release()
+
+    @contextlib.contextmanager
+    def acquire_blocking(self, tokens: int = 0):
+        """
+        acquire() for synchronous callers: blocks the calling thread (never
+        call it on an event loop thread) until there is budget
+
+        Yields the (monotonic) time the call started, to pass to record_outcome.
+        """
+        start = time.monotonic()
+        self._add_waiting(1)
+        try:
+            while True:
+                delay = self._take_slot(tokens)
+                if delay == 0 and self.shared is not None:
+                    delay = self._reserve_shared(tokens)
+                if delay == 0:
+                    break
+                with self._released:
+                    self._released.wait(timeout=delay)
+        finally:
+            self._add_waiting(-1)
+
+        self._record_wait(start)
+        try:
+            yield time.monotonic()
+        finally:
+            self._release()
+
+    def record_success(self) -> None:
+        """Additive increase after a successful call"""
+        if self.concurrency_limit < self.max_concurrency:
+            self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1.0 / self.concurrency_limit)
+        if self.max_rpm and self.rpm_limit < self.max_rpm:
+            # ~100 successful calls to recover from one halving back to the budget
+            self.rpm_limit = min(self.max_rpm, self.rpm_limit + self.max_rpm / 100.0)
+
+    def record_rate_limited(self, started_at: Optional[float] = None) -> None:
+        """
+        Multiplicative decrease after a quota error
+
+        A quota burst fails every call in flight at once; only calls started
+        after the last decrease (i.e. under the reduced limits) decrease again,
+        so one burst halves the limits once instead of once per call.
+        """
+        self._rate_limited += 1
+        RATE_LIMITED.inc()
+        if started_at is not None and started_at < self._last_decrease:
+            self._ignored_rate_limited += 1
+            return
+        self._last_decrease = time.monotonic()
+        self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit * self.decrease_factor)
+        if self.max_rpm:
+            self.rpm_limit = max(self.min_rpm, self.rpm_limit * self.decrease_factor)
+        logger.warning(
+            f"LLM quota error, backing off: concurrency={self.concurrency_limit:.1f}, rpm={self.rpm_limit:.0f}"
+        )
+
+    def record_outcome(self, error: Optional[BaseException] = None, started_at: Optional[float] = None) -> None:
+        """
+        Feed the result of a call back into the limiter
+
+        Args:
+            error: Exception raised by the call (None on success)
+            started_at: Time the call started (yielded by acquire)
+        """
+        with self._state_lock:
+            if error is None:
+                self.record_success()
+            elif is_rate_limit_error(error):
+                self.record_rate_limited(started_at)
+
+    def stats(self) -> Dict[str, Any]:
+        """Current limits, queue depth and wait-time statistics"""
+        with self._state_lock:
+            self._prune(time.monotonic())
+        return {
+            "in_flight": self._in_flight,
+            "queue_depth": self._waiting,
+            "concurrency_limit": round(self.concurrency_limit, 2),
+            "max_concurrency": self.max_concurrency,
+            "rpm_limit": round(self.rpm_limit, 2) if self.max_rpm else None,
+            "requests_last_minute": len(self._requests),
+            "tpm_limit": self.tpm or None,
+            "tokens_last_minute": self._token_total,
+            "acquired": self._acquired,
+            "rate_limited": self._rate_limited,
+            "rate_limited_same_burst": self._ignored_rate_limited,
+            "avg_wait_seconds": round(self._total_wait / self._acquired, 4) if self._acquired else 0.0,
+            "max_wait_seconds": round(self._max_wait, 4),
+            **({"all_workers": self.shared.quota_usage(self.scope)} if self.shared is not None else {}),
+        }
+
+
+# Global limiter instance shared by all LLM calls
+# (limits are per client: with an LLM pool the process budget is the sum of its clients;
+#  with several workers, concurrency is split between them and RPM/TPM are counted in shared_state)
+rate_limiter = AdaptiveRateLimiter(
+    max_concurrency=worker_share(settings.MAX_CONCURRENT_REQUESTS * settings.LLM_POOL_SIZE),
+    rpm=settings.LLM_RPM_LIMIT * settings.LLM_POOL_SIZE,
+    tpm=settings.LLM_TPM_LIMIT * settings.LLM_POOL_SIZE,
+    shared=shared_state,
+)
+
+REGISTRY.gauge("llm_in_flight_calls", "LLM calls currently in flight", lambda: rate_limiter._in_flight)
+REGISTRY.gauge("llm_queue_depth", "Calls waiting for rate limiter budget", lambda: rate_limiter._waiting)
+REGISTRY.gauge("llm_concurrency_limit", "Current adaptive concurrency limit", lambda: rate_limiter.concurrency_limit)
@@ -1,14 +1,37 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import PydanticOutputParser, JsonOutputParser
+from langchain_core.prompts import PromptTemplate, BasePromptTemplate
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.messages import BaseMessage
+from langchain_core.output_parsers import BaseOutputParser
+from langchain_core.runnables import RunnableSequence
 from langchain_ollama import ChatOllama
 import asyncio
 import aiohttp
-from typing import List
+import contextlib
+import hashlib
+import json
+import threading
+import time
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Dict, List, Literal, Optional, Tuple
 from tqdm import tqdm
 
+from app.core.config import settings
 from app.core.flows import FLOWS
+from app.core.flow_engine import get_decision_tree, DECISION_TREES, RISK_LEVELS
+from app.core.flow_compact import prompt_criteria
+from app.core.flow_applicability import not_applicable_reason
+from app.core.metrics import CLASSIFICATION_LATENCY, STAGE_LATENCY, PROMPT_TOKENS, RETRIES, FALLBACKS
+from app.services.cache_service import (
+    get_cached_result, store_result, aget_cached_result, astore_result, make_cache_key, single_flight, FLOW_NAMES_BY_TEXT
+)
+from app.services.rate_limiter import rate_limiter, estimate_tokens
+from app.services.checkpoint_service import PROMPT_VERSION, checkpoint_store, flow_checkpoint_key, row_checkpoint_key
+from app.services.cassette_service import CassetteMissError, wrap_with_cassette
+from app.services.cascade_service import ModelCascade, parse_levels
+from app.services.hedge_service import request_hedger
+from app.services.llm_pool import POOL_MODEL_KEY
 import pandas as pd
 import os
 
@@ -94,6 +117,25 @@ DESCRIPTION_LABELS = {
     'ng_tube_description': 'คำอธิบายเพิ่มเติมสำหรับตำแหน่งสายยางให้อาหาร',
 }
 
+# Field เพิ่มเติมที่ flow ใช้ประเมินนอกเหนือจาก field ของ decision node
+FLOW_EXTRA_INPUT_FIELDS = {
+    'แผลบริเวณสะโพก: การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก': ['procedures', 'additional_questions'],
+    'การเดิน: การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก': ['procedures'],
+}
+
+# Field ที่ส่งให้ทุก flow: หมายเหตุพิเศษของหมอ (เช่น แพ้ยา เลือดออกมาก) อาจเกี่ยวกับหัวข้อใดก็ได้
+COMMON_INPUT_FIELDS = ['note']
+
+# Mapping ระหว่าง flow กับ field ที่ใช้ประเมิน: field ที่ decision node ของ flowchart ผูกไว้
+# (FLOW_DECISION_FIELDS ใน flow_engine) + FLOW_EXTRA_INPUT_FIELDS + COMMON_INPUT_FIELDS
+FLOW_INPUT_FIELDS = {
+    flow_name: list(dict.fromkeys(
+        DECISION_TREES[flow_name].fields + FLOW_EXTRA_INPUT_FIELDS.get(flow_name, []) + COMMON_INPUT_FIELDS
+    ))
+    for flow_name in FLOWS
+}
+_FLOW_INPUT_FIELDS_BY_TEXT = {FLOWS[flow_name]: fields for flow_name, fields in FLOW_INPUT_FIELDS.items()}
+
 
 # ------------------------------------------------------------
 # 1) Pydantic Model
@@ -103,6 +145,19 @@ class OutputRiskClassification(BaseModel):
     recommendation: str = Field(description="คำแนะนำการดูแลตนเองสำหรับผู้ป่วย เขียนเป็นภาษาไทย ต้องบอกชัดว่าควรทำอะไร")
     reason: str = Field(description="เหตุผลที่ประเมินระดับความเสี่ยงนี้ เขียนเป็นภาษาไทย")
 
+    # Model ที่ตอบ (ไม่อยู่ใน schema / cache)
+    _answered_by: Optional[str] = PrivateAttr(default=None)
+
+    @property
+    def answered_by(self) -> Optional[str]:
+        """Model that produced this result (None for gate, flow engine and fallback results)"""
+        return self._answered_by
+
+
+class StructuredRiskClassification(OutputRiskClassification):
+    """Schema sent to providers with native structured output (risk_level limited to the three levels)"""
+    risk_level: Literal["ความเสี่ยงต่ำ", "ความเสี่ยงกลาง", "ความเสี่ยงสูง"] = Field(description="ระดับความเสี่ยงของผู้ป่วย")
+
 
 
 
@@ -181,6 +236,42 @@ def dict_as_text(data: dict) -> str:
     return result
 
 
+def project_input(data: dict, flows: List[str]) -> dict:
+    """
+    เลือกเฉพาะ field ที่ flow ใช้ประเมิน (รวม description คู่กัน)
+    
+    Field ที่ไม่มีค่าจะถูกใส่เป็น None เพื่อให้แสดงเป็น "ไม่ได้ระบุ".
+    Returns the full data when projection is disabled, a flow is unknown, or
+    the data does not use the form field names at all (e.g. raw CSV headers).
+    """
+    if not settings.PROJECT_FLOW_INPUTS:
+        return data
+    
+    fields = []
+    for flow in flows:
+        flow_fields = _FLOW_INPUT_FIELDS_BY_TEXT.get(flow)
+        if not flow_fields:
+            return data
+        fields.extend(flow_fields)
+    fields = list(dict.fromkeys(fields))
+    
+    if not any(key in FIELD_LABELS for key in data):
+        return data
+    
+    projected = {}
+    for field_name in fields:
+        projected[field_name] = data.get(field_name)
+        desc_field = FIELD_WITH_DESCRIPTION.get(field_name)
+        if desc_field and desc_field in data:
+            projected[desc_field] = data[desc_field]
+    return projected
+
+
+def render_flow_input(data: dict, flow: str) -> str:
+    """แปลงเฉพาะข้อมูลที่ flow นี้ใช้เป็น text สำหรับ prompt"""
+    return dict_as_text(project_input(data, [flow]))
+
+
 def save_debug_output(text: str, filename: str = "temp.txt"):
     """บันทึก output สำหรับ debug"""
     try:
@@ -191,6 +282,97 @@ def save_debug_output(text: str, filename: str = "temp.txt"):
         pass
 
 
+def has_free_text(data: dict, fields: List[str]) -> bool:
+    """ตรวจว่ามี free text (คำอธิบายเพิ่มเติมของ field ที่ระบุ หรือหมายเหตุที่ทุก flow ได้รับ) หรือไม่"""
+    names = [FIELD_WITH_DESCRIPTION.get(field_name) for field_name in fields] + COMMON_INPUT_FIELDS
+    for name in names:
+        if name and convert_value_to_string(data.get(name)).strip() not in ("", "ไม่ได้ระบุ"):
+            return True
+    return False
+
+
+# ------------------------------------------------------------
+# 2) Applicability Gating + Deterministic Flow Engine
+# ------------------------------------------------------------
+# ผลของ flow ที่ไม่เกี่ยวข้องกับผู้ป่วยรายนี้ (ไม่ใช่ระดับความเสี่ยง)
+NOT_APPLICABLE_LEVEL = "ไม่เกี่ยวข้อง"
+
+# คำตอบกรณีไม่มีข้อมูล (ตรงกับที่กำหนดใน prompt)
+NO_DATA_RESULT = {
+    "risk_level": "ความเสี่ยงต่ำ",
+    "reason": "ไม่ได้ระบุข้อมูล",
+    "recommendation": "ไม่มีคำแนะนำเฉพาะ กรุณาปฏิบัติตามคำแนะนำทั่วไปหลังผ่าตัด",
+}
+
+
+def has_flow_data(data: dict, fields: List[str]) -> bool:
+    """ตรวจว่ามีข้อมูล (คำตอบหรือคำอธิบายเพิ่มเติม) ใน field ที่ flow ใช้ประเมินหรือไม่"""
+    for field_name in fields:
+        for name in (field_name, FIELD_WITH_DESCRIPTION.get(field_name)):
+            if name and convert_value_to_string(data.get(name)).strip() not in ("", "ไม่ได้ระบุ"):
+                return True
+    return False
+
+
+def classify_with_applicability(input_data: dict, flow: str) -> Optional[OutputRiskClassification]:
+    """
+    Answer a flow without calling the LLM when it cannot apply to the patient
+    
+    Returns a NOT_APPLICABLE_LEVEL result when an applicability rule rules the
+    flow out (e.g. IMF flow without IMF), the canned no-data answer when none
+    of the flow's fields are filled, and None otherwise (or when the data does
+    not use the form field names, e.g. raw CSV headers).
+    """
+    if not settings.APPLICABILITY_GATING:
+        return None
+    
+    flow_name = FLOW_NAMES_BY_TEXT.get(flow)
+    if flow_name is None or not any(key in FIELD_LABELS for key in input_data):
+        return None
+    
+    reason = not_applicable_reason(flow_name, input_data)
+    if reason is not None:
+        return OutputRiskClassification(
+            risk_level=NOT_APPLICABLE_LEVEL,
+            recommendation="ไม่มีคำแนะนำเฉพาะ",
+            reason=f"ไม่ประเมินหัวข้อนี้: {reason}"
+        )
+    
+    if not has_flow_data(input_data, FLOW_INPUT_FIELDS[flow_name]):
+        return OutputRiskClassification(**NO_DATA_RESULT)
+    return None
+
+def classify_with_flow_engine(input_data: dict, flow: str) -> Optional[OutputRiskClassification]:
+    """
+    Classify risk from the compiled flowchart without calling the LLM
+    
+    Returns None when the flow cannot be decided from structured values
+    (unknown flow, missing answer or one that is not a flowchart option,
+    free-text description or clinician note given), in which case the
+    caller should fall back to the LLM.
+    """
+    if not settings.USE_FLOW_ENGINE:
+        return None
+    
+    tree = get_decision_tree(flow)
+    if tree is None or not tree.is_executable:
+        return None
+    
+    # คำอธิบายเพิ่มเติมหรือหมายเหตุอาจเปลี่ยนผลการประเมิน ให้ LLM เป็นผู้ตัดสิน
+    if has_free_text(input_data, tree.fields):
+        return None
+    
+    decision = tree.evaluate(input_data)
+    if decision is None:
+        return None
+    
+    return OutputRiskClassification(
+        risk_level=decision.risk_level,
+        recommendation=decision.recommendation,
+        reason=decision.reason
+    )
+
+
 # ------------------------------------------------------------
 # 3) Build LLM Model
 # ------------------------------------------------------------
@@ -200,19 +382,29 @@ def build_llm(api_key: str, model_name: str = "gemini-2.0-flash-lite"):
         google_api_key=api_key
     )
 
-def build_llm_local():
+def build_llm_local(model_name: str = None):
+    kwargs = {"base_url": settings.OLLAMA_BASE_URL} if settings.OLLAMA_BASE_URL else {}
     return ChatOllama(
-        model="qwen2:latest",
+        model=model_name or settings.LOCAL_MODEL_NAME,
         temperature=0.0,
+        # classify_risk (sync) ยกเลิก call ไม่ได้: จำกัดเวลาที่ client แทน asyncio.wait_for
+        sync_client_kwargs={"timeout": settings.CASCADE_LOCAL_TIMEOUT},
+        **kwargs,
     )
 
 # ------------------------------------------------------------
 # 4) Create the Prompt + Chain
 # ------------------------------------------------------------
-def build_risk_chain(llm):
-    parser = PydanticOutputParser(pydantic_object=OutputRiskClassification)
-
-    prompt = PromptTemplate(
+def build_risk_prompt(parser: Optional[PydanticOutputParser] = None) -> PromptTemplate:
+    """
+    Prompt template for single-flow classification
+    
+    Args:
+        parser: Text parser whose format instructions are appended. None for
+                native structured output, where the schema is sent to the
+                provider instead.
+    """
+    return PromptTemplate(
         template=(
             "คุณเป็นพยาบาลที่ให้คำปรึกษาผู้ป่วยหลังผ่าตัด\n\n"
             "**สำคัญ: ประเมินเฉพาะตามเกณฑ์การประเมินที่กำหนดให้เท่านั้น อย่าวิเคราะห์อาการอื่นๆ**\n\n"
@@ -239,11 +431,290 @@ def build_risk_chain(llm):
             "{format_instructions}\n"
         ),
         input_variables=["flow_criteria", "result_text"],
-        partial_variables={"format_instructions": parser.get_format_instructions()}
+        partial_variables={"format_instructions": parser.get_format_instructions() if parser else ""}
+    )
+
+
+def build_multi_flow_prompt() -> PromptTemplate:
+    """Prompt template that classifies several flows in one call, returning JSON keyed by flow name"""
+    return PromptTemplate(
+        template=(
+            "คุณเป็นพยาบาลที่ให้คำปรึกษาผู้ป่วยหลังผ่าตัด\n\n"
+            "**สำคัญ: ประเมินแต่ละหัวข้อแยกกัน ตามเกณฑ์ของหัวข้อนั้นเท่านั้น อย่าวิเคราะห์อาการอื่นๆ**\n\n"
+            
+            "เกณฑ์การประเมิน (แต่ละหัวข้อขึ้นต้นด้วย ### ตามด้วยชื่อหัวข้อ):\n{flows_criteria}\n\n"
+            "ข้อมูลผู้ป่วย:\n{result_text}\n\n"
+            
+            "วิธีการประเมิน (ทำแยกทีละหัวข้อ):\n"
+            "1. ดูเฉพาะข้อมูลที่เกี่ยวข้องกับเกณฑ์ของหัวข้อนั้น\n"
+            "2. ประเมินระดับความเสี่ยง [ความเสี่ยงต่ำ, ความเสี่ยงกลาง, ความเสี่ยงสูง]\n"
+            "3. เหตุผล (reason): อธิบายสั้นๆ ตามเกณฑ์ที่ประเมิน (ไม่เกิน 2-3 ประโยค)\n"
+            "4. คำแนะนำ (recommendation): ให้คำแนะนำที่เกี่ยวข้องกับเกณฑ์ที่ประเมินเท่านั้น กระชับ บอกชัดว่าควรทำอะไร\n\n"
+            
+            "กรณีไม่มีข้อมูล: risk_level = 'ความเสี่ยงต่ำ', reason = 'ไม่ได้ระบุข้อมูล', recommendation = 'ไม่มีคำแนะนำเฉพาะ กรุณาปฏิบัติตามคำแนะนำทั่วไปหลังผ่าตัด'\n\n"
+            
+            "ตอบเป็น JSON object เท่านั้น โดยมี key เป็นชื่อหัวข้อตามที่ระบุหลัง ### ทุกหัวข้อ:\n"
+            "{flow_names}\n"
+            "และ value ของแต่ละ key เป็น object ที่มี field \"risk_level\", \"recommendation\", \"reason\" (ภาษาไทย)\n"
+        ),
+        input_variables=["flows_criteria", "flow_names", "result_text"],
     )
 
-    chain = prompt | llm | parser
-    return chain
+
+# Parser / prompt สร้างครั้งเดียวตอน import แล้วใช้ซ้ำทุก chain
+RISK_PARSER = PydanticOutputParser(pydantic_object=OutputRiskClassification)
+RISK_PROMPT = build_risk_prompt(RISK_PARSER)
+STRUCTURED_RISK_PROMPT = build_risk_prompt()
+MULTI_FLOW_PROMPT = build_multi_flow_prompt()
+
+
+def prompt_key(prompt: BasePromptTemplate, mode: str) -> str:
+    """
+    Identity of the prompt a cached result came from: PROMPT_VERSION, chain
+    mode and a hash of the template (with its format instructions, or the
+    response schema in structured mode)
+    """
+    schema = StructuredRiskClassification.model_json_schema() if mode == "structured" else None
+    payload = json.dumps([prompt.template, prompt.partial_variables, schema], ensure_ascii=False, sort_keys=True, default=str)
+    return f"{PROMPT_VERSION}:{mode}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]}"
+
+
+def bind_structured_output(llm):
+    """
+    LLM constrained to StructuredRiskClassification by the provider
+    (Gemini response schema, Ollama format), followed by its parser
+    
+    Returns:
+        Runnable, or None if the backend has no native structured output
+    """
+    try:
+        return llm.with_structured_output(StructuredRiskClassification, method="json_schema")
+    except (NotImplementedError, ValueError, TypeError):
+        return None
+
+
+def build_risk_chain(llm, flow: str = None):
+    """
+    Build the single-flow chain
+    
+    Uses the provider's schema-constrained output when STRUCTURED_OUTPUT is on
+    and the backend supports it (no format instructions in the prompt);
+    otherwise falls back to format instructions + PydanticOutputParser.
+    
+    Args:
+        llm: LLM instance
+        flow: Flow criteria to bind as a partial (optional). When given, the
+              chain only needs `result_text`; otherwise it also needs `flow_criteria`.
+              Bound as the compact flowchart when COMPACT_FLOW_CRITERIA is on.
+    """
+    structured = bind_structured_output(llm) if settings.STRUCTURED_OUTPUT else None
+    prompt = RISK_PROMPT if structured is None else STRUCTURED_RISK_PROMPT
+    if flow is not None:
+        prompt = prompt.partial(flow_criteria=prompt_criteria(flow))
+    if structured is None:
+        return prompt | llm | RISK_PARSER
+    return prompt | structured
+
+
+def build_multi_flow_chain(llm):
+    """Chain that classifies several flows in one call, returning JSON keyed by flow name"""
+    return MULTI_FLOW_PROMPT | llm | JsonOutputParser()
+
+
+class ChainRegistry:
+    """
+    Ready-to-use chains for one LLM instance, one per flow with the flow
+    criteria already bound. Built once (at startup) and reused by every
+    request and the CSV path.
+    """
+    
+    def __init__(self, llm):
+        self.llm = llm
+        self._chains: Dict[str, object] = {}
+        self._multi_flow_chain = None
+        self._lock = threading.Lock()
+        # Cache keys of results produced by this registry's chains
+        structured = settings.STRUCTURED_OUTPUT and bind_structured_output(llm) is not None
+        self.mode = "structured" if structured else "parser"
+        self.prompt_key = prompt_key(STRUCTURED_RISK_PROMPT if structured else RISK_PROMPT, self.mode)
+        self.multi_flow_prompt_key = prompt_key(MULTI_FLOW_PROMPT, "multi_flow")
+    
+    def build_all(self, flows: Dict[str, str] = None) -> "ChainRegistry":
+        """Precompile chains for all flows"""
+        for flow in (flows or FLOWS).values():
+            self.get(flow)
+        self.multi_flow_chain()
+        return self
+    
+    def get(self, flow: str):
+        """Chain for a flow (flow text), built on first use if not precompiled"""
+        chain = self._chains.get(flow)
+        if chain is None:
+            with self._lock:
+                chain = self._chains.get(flow)
+                if chain is None:
+                    chain = build_risk_chain(self.llm, flow)
+                    self._chains[flow] = chain
+        return chain
+    
+    def multi_flow_chain(self):
+        if self._multi_flow_chain is None:
+            self._multi_flow_chain = build_multi_flow_chain(self.llm)
+        return self._multi_flow_chain
+    
+    async def warm_up(self, flows: Dict[str, str] = None) -> Dict[str, str]:
+        """
+        Exercise each flow chain once (with empty patient data) so the first
+        real request does not pay connection / initialization cost
+        
+        Returns:
+            Dict of flow name -> error message for chains that failed
+        """
+        errors = {}
+        
+        async def run(flow_name: str, flow: str):
+            try:
+                await ainvoke_limited(self.get(flow), {"result_text": "ไม่ได้ระบุข้อมูล"}, prompt_criteria(flow), flow_name=flow_name)
+            except Exception as e:
+                errors[flow_name] = str(e)
+        
+        await asyncio.gather(*[run(name, flow) for name, flow in (flows or FLOWS).items()])
+        return errors
+
+
+def _stage_name(step) -> str:
+    """Metric stage label of one chain step"""
+    if isinstance(step, BasePromptTemplate):
+        return "prompt_render"
+    if isinstance(step, BaseLanguageModel) or isinstance(getattr(step, "bound", None), BaseLanguageModel):
+        return "model_call"
+    if isinstance(step, BaseOutputParser):
+        return "output_parse"
+    return type(step).__name__
+
+
+def _answering_model(value, model_name: str) -> str:
+    """Model stamped on a model step's output by the LLM pool (model_name otherwise)"""
+    if isinstance(value, BaseMessage):
+        return value.response_metadata.get(POOL_MODEL_KEY, model_name)
+    return model_name
+
+
+def _observe_stages(timings: List[Tuple[str, float]], flow_name: str, model_name: str) -> None:
+    for stage, seconds in timings:
+        STAGE_LATENCY.observe(seconds, flow=flow_name, model=model_name, stage=stage)
+
+
+async def _ainvoke_stages(chain, inputs: dict, flow_name: str, model_name: str = None):
+    """
+    Run a chain step by step, recording the latency of each stage under
+    the model that answered
+
+    Returns:
+        (chain output, name of the model that answered)
+    """
+    model_name = model_name or settings.MODEL_NAME
+    steps = chain.steps if isinstance(chain, RunnableSequence) else [chain]
+    value = inputs
+    timings = []
+    try:
+        for step in steps:
+            start = time.perf_counter()
+            value = await step.ainvoke(value)
+            timings.append((_stage_name(step), time.perf_counter() - start))
+            model_name = _answering_model(value, model_name)
+    finally:
+        _observe_stages(timings, flow_name, model_name)
+    return value, model_name
+
+
+def _observe_call(tokens: int, waited: float, flow_name: str, model_name: str) -> None:
+    PROMPT_TOKENS.observe(tokens, flow=flow_name, model=model_name)
+    STAGE_LATENCY.observe(waited, flow=flow_name, model=model_name, stage="rate_limit_wait")
+
+
+async def ainvoke_limited(chain, inputs: dict, *prompt_texts: str, output_tokens: int = 256, flow_name: str = "custom", on_start: Callable[[], None] = None):
+    """
+    Invoke a chain through the process-wide rate limiter and report the
+    outcome (success / quota error) back to it
+    
+    on_start (optional) is called when the slot is granted, right before
+    the chain runs (the hedger times calls from there).
+    
+    Returns:
+        (chain output, name of the model that answered)
+    """
+    tokens = estimate_tokens(*prompt_texts, *inputs.values(), output_tokens=output_tokens)
+    start = time.perf_counter()
+    async with rate_limiter.acquire(tokens) as started_at:
+        waited = time.perf_counter() - start
+        if on_start is not None:
+            on_start()
+        try:
+            result, model_name = await _ainvoke_stages(chain, inputs, flow_name)
+        except Exception as e:
+            rate_limiter.record_outcome(e, started_at)
+            _observe_call(tokens, waited, flow_name, settings.MODEL_NAME)
+            raise
+    rate_limiter.record_outcome()
+    _observe_call(tokens, waited, flow_name, model_name)
+    return result, model_name
+
+
+def _invoke_stages(chain, inputs: dict, flow_name: str, model_name: str = None):
+    """Synchronous _ainvoke_stages (for classify_risk)"""
+    model_name = model_name or settings.MODEL_NAME
+    steps = chain.steps if isinstance(chain, RunnableSequence) else [chain]
+    value = inputs
+    timings = []
+    try:
+        for step in steps:
+            start = time.perf_counter()
+            value = step.invoke(value)
+            timings.append((_stage_name(step), time.perf_counter() - start))
+            model_name = _answering_model(value, model_name)
+    finally:
+        _observe_stages(timings, flow_name, model_name)
+    return value, model_name
+
+
+def invoke_limited(chain, inputs: dict, *prompt_texts: str, output_tokens: int = 256, flow_name: str = "custom"):
+    """Synchronous ainvoke_limited: blocks the calling thread while waiting for budget"""
+    tokens = estimate_tokens(*prompt_texts, *inputs.values(), output_tokens=output_tokens)
+    start = time.perf_counter()
+    with rate_limiter.acquire_blocking(tokens) as started_at:
+        waited = time.perf_counter() - start
+        try:
+            result, model_name = _invoke_stages(chain, inputs, flow_name)
+        except Exception as e:
+            rate_limiter.record_outcome(e, started_at)
+            _observe_call(tokens, waited, flow_name, settings.MODEL_NAME)
+            raise
+    rate_limiter.record_outcome()
+    _observe_call(tokens, waited, flow_name, model_name)
+    return result, model_name
+
+
+# Registry ต่อ LLM instance (key = id ของ llm)
+_CHAIN_REGISTRIES: Dict[int, ChainRegistry] = {}
+
+
+def get_chain_registry(llm) -> ChainRegistry:
+    """Get (or create) the chain registry for an LLM instance"""
+    registry = _CHAIN_REGISTRIES.get(id(llm))
+    if registry is None or registry.llm is not llm:
+        registry = ChainRegistry(llm)
+        _CHAIN_REGISTRIES[id(llm)] = registry
+    return registry
+
+
+def llm_model_names(llm) -> List[str]:
+    """
+    Models whose results an LLM instance can return: MODEL_NAME, then the
+    other models of an LLM pool (also behind a cassette wrapper)
+    """
+    inner = getattr(llm, "inner", None) or llm
+    return list(dict.fromkeys([settings.MODEL_NAME, *getattr(inner, "model_names", [])]))
 
 
 # ------------------------------------------------------------
@@ -252,6 +723,13 @@ def build_risk_chain(llm):
 def classify_risk(input_data: dict, api_key: str = None, flow: str = None, llm=None, max_retries: int = 3):
     """
     Classify risk with option to reuse LLM instance and retry mechanism
+    
+    Synchronous counterpart of aclassify_risk for scripts and worker threads:
+    model calls go through the shared rate limiter (acquire_blocking) and
+    the cascade, and share the result cache. It blocks the calling thread,
+    so it refuses to run on an event loop thread (await aclassify_risk
+    there); hedging and request coalescing are only done by aclassify_risk.
+    
     Args:
         input_data: Patient data dictionary
         api_key: Google API key (not needed if llm is provided)
@@ -259,44 +737,86 @@ def classify_risk(input_data: dict, api_key: str = None, flow: str = None, llm=N
         llm: Pre-built LLM instance (optional, will create new if not provided)
         max_retries: Maximum number of retries if LLM returns None (default: 3)
     """
+    # Flows that cannot apply (or have no data) need no model call
+    gated = classify_with_applicability(input_data, flow)
+    if gated is not None:
+        return gated
+    
+    # Structured answers are decided by the flowchart itself
+    deterministic = classify_with_flow_engine(input_data, flow)
+    if deterministic is not None:
+        return deterministic
+    
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError("classify_risk blocks the event loop; await aclassify_risk instead")
+    
     if llm is None:
         if api_key is None:
             raise ValueError("Either llm or api_key must be provided")
         os.environ["GOOGLE_API_KEY"] = api_key
         llm = build_llm(api_key)
 
+    flow_label = FLOW_NAMES_BY_TEXT.get(flow, "custom")
     # Prepare model + data
-    result_text = dict_as_text(input_data)
-    chain = build_risk_chain(llm)
-
+    result_text = render_flow_input(input_data, flow)
+    
+    registry = get_chain_registry(llm)
+    cache_keys = [(model_name, registry.prompt_key) for model_name in llm_model_names(llm)]
+    if settings.CASCADE_ENABLED:
+        local_key = get_chain_registry(model_cascade.local_llm).prompt_key
+        cache_keys.append((settings.LOCAL_MODEL_NAME, local_key))
+    for model_name, key in cache_keys:
+        cached = get_cached_result(flow, result_text, key, model_name)
+        if cached is not None:
+            result = OutputRiskClassification(**cached)
+            result._answered_by = model_name
+            return result
+    
+    if settings.CASCADE_ENABLED:
+        local = classify_local(result_text, flow, flow_label, input_data)
+        if local is not None:
+            store_result(flow, result_text, local_key, local.model_dump(), settings.LOCAL_MODEL_NAME)
+            local._answered_by = settings.LOCAL_MODEL_NAME
+            return local
+    
+    chain = registry.get(flow)
+    
     # Retry mechanism
     last_error = None
     for attempt in range(max_retries):
         try:
             # Run prediction
-            result = chain.invoke({
-                "flow_criteria": flow,
-                "result_text": result_text
-            })
+            result, model_name = invoke_limited(chain, {"result_text": result_text}, prompt_criteria(flow), flow_name=flow_label)
             
             # Check if result is None
             if result is None:
                 raise ValueError(f"LLM returned None (attempt {attempt + 1}/{max_retries})")
             
+            store_result(flow, result_text, registry.prompt_key, result.model_dump(), model_name)
+            result._answered_by = model_name
             return result
             
         except Exception as e:
             last_error = e
+            RETRIES.inc(flow=flow_label, model=settings.MODEL_NAME)
             print(f"Error on attempt {attempt + 1}/{max_retries}: {str(e)}")
             
-            # Wait before retry (exponential backoff)
+            # Cassette replay miss: retrying cannot produce a recording
+            if isinstance(e, CassetteMissError):
+                break
+            
+            # Wait before retry (exponential backoff) without holding a limiter slot
             if attempt < max_retries - 1:
-                import time
                 wait_time = 2 ** attempt  # 1s, 2s, 4s
                 print(f"Waiting {wait_time}s before retry...")
                 time.sleep(wait_time)
     
     # If all retries failed, return default safe response
+    FALLBACKS.inc(flow=flow_label, model=settings.MODEL_NAME)
     print(f"All {max_retries} attempts failed. Returning default response.")
     return OutputRiskClassification(
         risk_level="ไม่สามารถประเมินได้",
@@ -304,90 +824,499 @@ def classify_risk(input_data: dict, api_key: str = None, flow: str = None, llm=N
         reason=f"ระบบประมวลผลล้มเหลว: {str(last_error)[:100]}"
     )
 
+# Native async version (ainvoke, non-blocking backoff, cancellable)
+async def aclassify_risk(input_data: dict, flow: str, llm, max_retries: int = 3, semaphore=None, flow_name: str = None):
+    """
+    Async classify risk using the model's native `ainvoke`
+    
+    Nothing blocks the event loop: the LLM call is awaited directly and the
+    retry backoff uses asyncio.sleep. Cancelling the awaiting task cancels
+    the in-flight call (asyncio.CancelledError is never swallowed).
+    
+    Identical concurrent requests (same flow, model and normalized input)
+    share one in-flight call when COALESCE_REQUESTS is enabled.
+    
+    With CASCADE_ENABLED, results accepted from the local model are cached
+    under LOCAL_MODEL_NAME and only looked up on the cascade path, so they
+    never answer a request that expects the remote model.
+    
+    Args:
+        input_data: Patient data dictionary
+        flow: Risk flow criteria
+        llm: Pre-built LLM instance
+        max_retries: Maximum number of attempts (default: 3)
+        semaphore: Optional semaphore held only while a model call is in flight
+        flow_name: Flow name used in log messages (optional)
+    """
+    flow_label = flow_name or FLOW_NAMES_BY_TEXT.get(flow, "custom")
+    start = time.perf_counter()
+    
+    def observe(source: str, result: OutputRiskClassification, model_name: str = settings.MODEL_NAME) -> OutputRiskClassification:
+        CLASSIFICATION_LATENCY.observe(time.perf_counter() - start, flow=flow_label, model=model_name, source=source)
+        result._answered_by = model_name if source in ("cache", "llm") else None
+        return result
+    
+    # Flows that cannot apply (or have no data) need no model call
+    gated = classify_with_applicability(input_data, flow)
+    if gated is not None:
+        return observe("gate", gated)
+    
+    # Structured answers are decided by the flowchart itself (no semaphore slot needed)
+    deterministic = classify_with_flow_engine(input_data, flow)
+    if deterministic is not None:
+        return observe("engine", deterministic)
+    
+    # Convert only the fields this flow uses to text for LLM
+    render_start = time.perf_counter()
+    result_text = render_flow_input(input_data, flow)
+    STAGE_LATENCY.observe(time.perf_counter() - render_start, flow=flow_label, model=settings.MODEL_NAME, stage="render_input")
+    
+    # Remote result first (any model of the pool), then (cascade only) a result the local model already gave
+    prompt_key = get_chain_registry(llm).prompt_key
+    cache_keys = [(model_name, prompt_key) for model_name in llm_model_names(llm)]
+    if settings.CASCADE_ENABLED:
+        cache_keys.append((settings.LOCAL_MODEL_NAME, get_chain_registry(model_cascade.local_llm).prompt_key))
+    for model_name, key in cache_keys:
+        cached = await aget_cached_result(flow, result_text, key, model_name)
+        if cached is not None:
+            return observe("cache", OutputRiskClassification(**cached), model_name)
+    
+    if settings.COALESCE_REQUESTS:
+        models, keys = zip(*cache_keys)
+        key = make_cache_key(flow, "+".join(models), result_text, "+".join(keys))
+        result, model_name = await single_flight.do(
+            key, lambda: _aclassify_uncached(result_text, flow, llm, max_retries, semaphore, flow_label, input_data)
+        )
+    else:
+        result, model_name = await _aclassify_uncached(result_text, flow, llm, max_retries, semaphore, flow_label, input_data)
+    return observe("fallback" if result.risk_level == "ไม่สามารถประเมินได้" else "llm", result, model_name)
+
+
+async def _aclassify_uncached(result_text: str, flow: str, llm, max_retries: int, semaphore, flow_label: str, input_data: dict = None):
+    """
+    LLM call with retries for aclassify_risk (after engine and cache lookups)
+    
+    Returns:
+        (result, name of the model that answered)
+    """
+    if settings.CASCADE_ENABLED:
+        local = await aclassify_local(result_text, flow, semaphore, flow_label, input_data)
+        if local is not None:
+            local_key = get_chain_registry(model_cascade.local_llm).prompt_key
+            await astore_result(flow, result_text, local_key, local.model_dump(), settings.LOCAL_MODEL_NAME)
+            return local, settings.LOCAL_MODEL_NAME
+    
+    # Precompiled chain for this flow
+    registry = get_chain_registry(llm)
+    chain = registry.get(flow)
+    
+    last_error = None
+    for attempt in range(max_retries):
+        try:
+            async with (semaphore or contextlib.nullcontext()):
+                call = lambda on_start=None: ainvoke_limited(
+                    chain, {"result_text": result_text}, prompt_criteria(flow), flow_name=flow_label, on_start=on_start
+                )
+                if settings.HEDGE_ENABLED:
+                    # Duplicate the call if it is slower than recent calls of this flow
+                    result, model_name = await request_hedger.run(flow_label, call)
+                else:
+                    result, model_name = await call()
+            
+            # Validate result is not None
+            if result is None:
+                raise ValueError(f"LLM returned None for flow: {flow_label} (attempt {attempt + 1}/{max_retries})")
+            
+            # Cache ภายใต้ model ที่ตอบจริง (client ใน LLM pool อาจเป็นคนละ model)
+            await astore_result(flow, result_text, registry.prompt_key, result.model_dump(), model_name)
+            return result, model_name
+            
+        except Exception as e:
+            last_error = e
+            RETRIES.inc(flow=flow_label, model=settings.MODEL_NAME)
+            print(f"Error in flow {flow_label} (attempt {attempt + 1}/{max_retries}): {str(e)}")
+            
+            # Cassette replay miss: retrying cannot produce a recording
+            if isinstance(e, CassetteMissError):
+                break
+            
+            # Wait before retry without holding a concurrency slot
+            if attempt < max_retries - 1:
+                await asyncio.sleep(2 ** attempt)
+    
+    # All retries failed - return default safe response
+    FALLBACKS.inc(flow=flow_label, model=settings.MODEL_NAME)
+    print(f"All {max_retries} attempts failed for flow {flow_label}. Returning default response.")
+    return OutputRiskClassification(
+        risk_level="ไม่สามารถประเมินได้",
+        recommendation="กรุณาติดต่อทีมแพทย์เพื่อประเมินเพิ่มเติม",
+        reason=f"ไม่สามารถประเมินความเสี่ยงได้: {str(last_error)[:100]}"
+    ), settings.MODEL_NAME
+
+
+# ------------------------------------------------------------
+# Model Cascade (local model first)
+# ------------------------------------------------------------
+# Local model (Ollama) สร้างเมื่อใช้ครั้งแรก และบันทึก/เล่นซ้ำผ่าน cassette เช่นเดียวกับ Gemini
+model_cascade = ModelCascade(
+    lambda: wrap_with_cassette(build_llm_local(), model_name=settings.LOCAL_MODEL_NAME),
+    escalate_levels=parse_levels(settings.CASCADE_ESCALATE_LEVELS),
+    timeout=settings.CASCADE_LOCAL_TIMEOUT,
+)
+
+
+async def aclassify_local(result_text: str, flow: str, semaphore, flow_label: str, input_data: dict = None) -> Optional[OutputRiskClassification]:
+    """
+    One attempt on the local model for the cascade
+    
+    Not rate limited (no API quota) and never retried: a failed call,
+    unparseable output or a result rejected by model_cascade returns None
+    so the caller escalates to the remote model.
+    """
+    chain = get_chain_registry(model_cascade.local_llm).get(flow)
+    try:
+        async with (semaphore or contextlib.nullcontext()):
+            result, _ = await asyncio.wait_for(
+                _ainvoke_stages(chain, {"result_text": result_text}, flow_label, settings.LOCAL_MODEL_NAME),
+                timeout=model_cascade.timeout,
+            )
+    except Exception as e:
+        # Parser / schema errors are ValueErrors (OutputParserException, ValidationError)
+        reason = "invalid" if isinstance(e, ValueError) else "error"
+        model_cascade.record(flow_label, reason)
+        print(f"Local model failed for flow {flow_label} ({reason}), escalating: {str(e)[:100]}")
+        return None
+    
+    reason = model_cascade.escalation_reason(result, input_data, flow)
+    model_cascade.record(flow_label, reason or "local")
+    return None if reason else result
+
+
+def classify_local(result_text: str, flow: str, flow_label: str, input_data: dict = None) -> Optional[OutputRiskClassification]:
+    """
+    Synchronous aclassify_local (for classify_risk); the local client's
+    sync timeout is CASCADE_LOCAL_TIMEOUT
+    """
+    chain = get_chain_registry(model_cascade.local_llm).get(flow)
+    try:
+        result, _ = _invoke_stages(chain, {"result_text": result_text}, flow_label, settings.LOCAL_MODEL_NAME)
+    except Exception as e:
+        reason = "invalid" if isinstance(e, ValueError) else "error"
+        model_cascade.record(flow_label, reason)
+        print(f"Local model failed for flow {flow_label} ({reason}), escalating: {str(e)[:100]}")
+        return None
+    
+    reason = model_cascade.escalation_reason(result, input_data, flow)
+    model_cascade.record(flow_label, reason or "local")
+    return None if reason else result
+
+
 # Async version for concurrent processing
 async def classify_risk_async(input_data: dict, llm, flow: str, flow_name: str, semaphore, max_retries: int = 3):
     """
     Classify risk with concurrency, error handling, and retry mechanism
+    
+    Returns:
+        Tuple of (flow_name, OutputRiskClassification)
     """
-    async with semaphore:
-        last_error = None
-        for attempt in range(max_retries):
-            try:
-                # Convert input data to text for LLM
-                result_text = dict_as_text(input_data)
-                
-                # Build the risk classification chain
-                chain = build_risk_chain(llm)
-                
-                # Run the prediction in a thread pool to avoid blocking
-                loop = asyncio.get_event_loop()
-                result = await loop.run_in_executor(
-                    None,
-                    lambda: chain.invoke({
-                        "flow_criteria": flow,
-                        "result_text": result_text
-                    })
-                )
-                
-                # Validate result is not None
-                if result is None:
-                    raise ValueError(f"LLM returned None for flow: {flow_name} (attempt {attempt + 1}/{max_retries})")
-                
-                return flow_name, result
-                
-            except Exception as e:
-                last_error = e
-                print(f"Error in flow {flow_name} (attempt {attempt + 1}/{max_retries}): {str(e)}")
-                
-                # Wait before retry
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt)
+    result = await aclassify_risk(input_data, flow, llm, max_retries=max_retries, semaphore=semaphore, flow_name=flow_name)
+    return flow_name, result
+
+# ------------------------------------------------------------
+# 6) Single-call Multi-flow Classification
+# ------------------------------------------------------------
+def validate_flow_result(value) -> Optional[OutputRiskClassification]:
+    """Validate one flow entry from the multi-flow response, None if invalid"""
+    if not isinstance(value, dict):
+        return None
+    try:
+        result = OutputRiskClassification.model_validate(value)
+    except Exception:
+        return None
+    if result.risk_level not in RISK_LEVELS:
+        return None
+    return result
+
+
+async def classify_flows_single_call(input_data: dict, flows: Dict[str, str], llm) -> Dict[str, OutputRiskClassification]:
+    """
+    Classify several flows with a single LLM call
+    
+    Flows ruled out by applicability gating, decided by the flow engine or
+    found in the result cache skip the LLM entirely. The remaining flows are
+    packed into one prompt that carries the patient data once; each returned
+    entry is validated individually and any flow that is missing or invalid
+    falls back to a per-flow aclassify_risk call.
+    
+    Args:
+        input_data: Patient data dictionary
+        flows: Mapping of flow name -> flow criteria
+        llm: Pre-built LLM instance
         
-        # All retries failed - return default safe response
-        print(f"All {max_retries} attempts failed for flow {flow_name}. Returning default response.")
-        default_response = OutputRiskClassification(
-            risk_level="ไม่สามารถประเมินได้",
-            recommendation="กรุณาติดต่อทีมแพทย์เพื่อประเมินเพิ่มเติม",
-            reason=f"ไม่สามารถประเมินความเสี่ยงได้: {str(last_error)[:100]}"
-        )
-        return flow_name, default_response
+    Returns:
+        Dict mapping flow name to its OutputRiskClassification
+    """
+    registry = get_chain_registry(llm)
+    # ผลจาก prompt แบบ flow เดียวหรือแบบหลาย flow ของทุก model ใน pool ใช้ได้ทั้งหมด
+    cache_keys = [
+        (model_name, key)
+        for model_name in llm_model_names(llm)
+        for key in (registry.prompt_key, registry.multi_flow_prompt_key)
+    ]
+    results: Dict[str, OutputRiskClassification] = {}
+    pending: Dict[str, str] = {}
+    for flow_name, flow in flows.items():
+        deterministic = classify_with_applicability(input_data, flow) or classify_with_flow_engine(input_data, flow)
+        if deterministic is not None:
+            results[flow_name] = deterministic
+            continue
+        result_text = render_flow_input(input_data, flow)
+        for model_name, key in cache_keys:
+            cached = await aget_cached_result(flow, result_text, key, model_name)
+            if cached is not None:
+                results[flow_name] = OutputRiskClassification(**cached)
+                results[flow_name]._answered_by = model_name
+                break
+        else:
+            pending[flow_name] = flow
+    
+    if not pending:
+        return {flow_name: results[flow_name] for flow_name in flows}
+    
+    chain = registry.multi_flow_chain()
+    try:
+        response, model_name = await ainvoke_limited(chain, {
+            "flows_criteria": "\n\n".join(f"### {name}\n{prompt_criteria(flow)}" for name, flow in pending.items()),
+            "flow_names": "\n".join(f"- {name}" for name in pending),
+            "result_text": dict_as_text(project_input(input_data, list(pending.values())))
+        }, output_tokens=256 * len(pending), flow_name="multi_flow")
+    except Exception as e:
+        print(f"Single-call classification failed, falling back to per-flow calls: {str(e)}")
+        response, model_name = {}, None
+    
+    fallback = []
+    for flow_name, flow in pending.items():
+        value = response.get(flow_name) if isinstance(response, dict) else None
+        result = validate_flow_result(value)
+        if result is not None:
+            result._answered_by = model_name
+            results[flow_name] = result
+            await astore_result(flow, render_flow_input(input_data, flow), registry.multi_flow_prompt_key, result.model_dump(), model_name)
+        else:
+            fallback.append(flow_name)
+    
+    if fallback:
+        print(f"Falling back to per-flow calls for {len(fallback)} flow(s): {fallback}")
+        fallback_results = await asyncio.gather(*[
+            aclassify_risk(input_data, pending[flow_name], llm, flow_name=flow_name)
+            for flow_name in fallback
+        ])
+        results.update(zip(fallback, fallback_results))
+    
+    # คงลำดับตาม flows ที่ส่งเข้ามา
+    return {flow_name: results[flow_name] for flow_name in flows}
+
 
-async def _process_all_rows(df: pd.DataFrame, llm, output_file: str, max_concurrent: int):
+# คอลัมน์ผลลัพธ์ (risk_level, risk_reason, recommendation) ของทุก flow
+RESULT_COLUMNS = [
+    f"{flow_name}_{suffix}"
+    for flow_name in FLOWS.keys()
+    for suffix in ("risk_level", "risk_reason", "recommendation")
+]
+
+
+def add_result_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """เพิ่มคอลัมน์ผลลัพธ์ (risk_level, risk_reason, recommendation) ของทุก flow"""
+    for column in RESULT_COLUMNS:
+        df[column] = ""
+    return df
+
+
+def row_input(row: dict) -> dict:
+    """ตัดคอลัมน์ผลลัพธ์ออก เหลือเฉพาะ input ของแถว"""
+    return {key: value for key, value in row.items() if key not in RESULT_COLUMNS}
+
+
+def load_row_checkpoint(input_data: dict):
     """
-    Process all rows with concurrent API calls
+    Checkpoint key and already completed flows of one batch row
+
+    Cells checkpointed with other flow criteria or another PROMPT_VERSION are
+    not returned (they are classified again).
+
+    Returns:
+        Tuple of (row_key, dict flow name -> OutputRiskClassification)
+    """
+    row_key = row_checkpoint_key(input_data, settings.MODEL_NAME)
+    flow_names = {flow_checkpoint_key(flow_name, flow): flow_name for flow_name, flow in FLOWS.items()}
+    completed = {
+        flow_names[flow_key]: OutputRiskClassification(**value)
+        for flow_key, value in checkpoint_store.load_row(row_key).items()
+        if flow_key in flow_names
+    }
+    return row_key, completed
+
+
+async def classify_batch_cell(input_data: dict, row_key: str, flow_name: str, flow: str, llm, semaphore):
+    """
+    Classify one (row, flow) cell of a batch run and checkpoint the result
+    
+    Failed cells (default response) are not checkpointed so a rerun retries them.
+    
+    Returns:
+        Tuple of (flow_name, OutputRiskClassification)
+    """
+    result = await classify_risk_async(input_data, llm, flow, flow_name, semaphore)
+    output = result[1]
+    if output.risk_level != "ไม่สามารถประเมินได้":
+        checkpoint_store.save(row_key, flow_checkpoint_key(flow_name, flow), output.model_dump())
+    return result
+
+
+async def classify_rows(
+    rows: AsyncGenerator[Tuple[Any, dict], None],
+    llm,
+    max_concurrent: int,
+    window: int,
+    on_result: Optional[Callable] = None
+) -> AsyncIterator[Tuple[Any, dict, Dict[str, OutputRiskClassification]]]:
+    """
+    Classify rows with a (row, flow) work-queue scheduler, yielding them in input order
+    
+    Every (row, flow) pair is an independent work item. A producer reads
+    rows and feeds a bounded queue; a pool of workers pulls cells from any
+    row, so the concurrency window stays full across rows and one slow flow
+    (retries + backoff) only holds back the output of its own row. Finished
+    rows wait in a reorder buffer until the rows before them are out; at
+    most `window` rows are read and not yet yielded, so memory does not grow
+    with the input.
     
-    This function takes a Pandas DataFrame, an LLM instance, an output file path, 
-    and a maximum number of concurrent API calls. It processes each row of the 
-    DataFrame by creating a task for each risk flow criteria to classify the risk 
-    level, reason, and recommendation. It then runs all these tasks concurrently 
-    using asyncio.gather and updates the DataFrame with the results. Finally, it 
-    saves the updated DataFrame to the output file path.
+    `on_result(key, flow_name, output)` is called as soon as each cell is
+    done (checkpointed cells included). Every completed cell is
+    checkpointed; rerunning the same input only calls the LLM for the rest.
+    
+    Args:
+        rows: Async generator of (key, input data) pairs (closed when done)
+        llm: LLM instance
+        max_concurrent: Maximum concurrent LLM calls
+        window: Maximum rows read and not yet yielded
+        on_result: Optional per-cell progress callback
+    
+    Yields:
+        Tuple of (key, input data, dict flow name -> OutputRiskClassification)
     """
     semaphore = asyncio.Semaphore(max_concurrent)
+    # Workers > semaphore slots: a worker sleeping in retry backoff does not hold a slot
+    num_workers = max(1, max_concurrent * 2)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=num_workers * 2)
+    window_slots = asyncio.Semaphore(max(1, window))
+    # ลำดับแถว -> [key, input, ผลแต่ละ flow, จำนวน flow ที่ยังไม่เสร็จ]
+    in_flight: Dict[int, list] = {}
+    row_done = asyncio.Event()
     
-    # Process each row
-    for idx, row in tqdm(df.iterrows(), total=len(df), desc="Processing rows"):
-        # Convert row to dictionary for LLM input
-        input_data = row.to_dict()
-        
-        # Create tasks for all flows for this row
-        tasks = [
-            classify_risk_async(input_data, llm, flow, flow_name, semaphore)
-            for flow_name, flow in FLOWS.items()
-        ]
-        
-        # Run all flow classifications concurrently for this row
-        results = await asyncio.gather(*tasks)
-        
-        # Update dataframe with results
-        for flow_name, output in results:
-            # Update dataframe with risk level, reason, and recommendation
-            df.at[idx, f"{flow_name}_risk_level"] = output.risk_level
-            df.at[idx, f"{flow_name}_risk_reason"] = output.reason
-            df.at[idx, f"{flow_name}_recommendation"] = output.recommendation
-    
-    # Save results
-    df.to_csv(output_file, index=False)
+    def complete(seq: int, flow_name: str, output: OutputRiskClassification):
+        state = in_flight[seq]
+        state[2][flow_name] = output
+        state[3] -= 1
+        if on_result is not None:
+            on_result(state[0], flow_name, output)
+        if state[3] == 0:
+            row_done.set()
+    
+    async def producer() -> int:
+        seq = 0
+        # ปิด source ทันทีเมื่อหยุดกลางทาง (ไม่รอ garbage collector ของ async generator)
+        async with contextlib.aclosing(rows):
+            async for key, input_data in rows:
+                await window_slots.acquire()
+                row_key, completed = await asyncio.to_thread(load_row_checkpoint, input_data)
+                in_flight[seq] = [key, input_data, {}, len(FLOWS)]
+                for flow_name, flow in FLOWS.items():
+                    if flow_name in completed:
+                        complete(seq, flow_name, completed[flow_name])
+                    else:
+                        await queue.put((seq, input_data, row_key, flow_name, flow))
+                seq += 1
+        for _ in range(num_workers):
+            await queue.put(None)
+        return seq
+    
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            seq, input_data, row_key, flow_name, flow = item
+            _, output = await classify_batch_cell(input_data, row_key, flow_name, flow, llm, semaphore)
+            complete(seq, flow_name, output)
+    
+    producer_task = asyncio.create_task(producer())
+    tasks = [producer_task] + [asyncio.create_task(worker()) for _ in range(num_workers)]
+    next_seq = 0
+    try:
+        while True:
+            row_done.clear()
+            state = in_flight.get(next_seq)
+            if state is not None and state[3] == 0:
+                del in_flight[next_seq]
+                next_seq += 1
+                window_slots.release()
+                yield state[0], state[1], state[2]
+                continue
+            failed = next((task for task in tasks if task.done() and not task.cancelled() and task.exception() is not None), None)
+            if failed is not None:
+                raise failed.exception()
+            if producer_task.done() and next_seq >= producer_task.result():
+                return
+            waiter = asyncio.ensure_future(row_done.wait())
+            try:
+                await asyncio.wait([waiter, *(task for task in tasks if not task.done())], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+    finally:
+        # Cancelled, failed or closed early: stop the producer and the remaining workers
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _process_all_rows(df: pd.DataFrame, llm, output_file: str, max_concurrent: int, on_result: Optional[Callable] = None):
+    """
+    Process all rows with concurrent API calls
+    
+    Rows go through the classify_rows scheduler; results are written back
+    to the DataFrame as each cell completes, and the DataFrame is saved to
+    the output file path at the end.
+    
+    `on_result(idx, flow_name, output)` is called as soon as each flow of a
+    row finishes (used for job progress tracking).
+    """
+    progress = tqdm(total=len(df) * len(FLOWS), desc="Processing cells")
+    
+    def write_result(idx, flow_name: str, output: OutputRiskClassification):
+        # Write back immediately so partial results are visible
+        df.at[idx, f"{flow_name}_risk_level"] = output.risk_level
+        df.at[idx, f"{flow_name}_risk_reason"] = output.reason
+        df.at[idx, f"{flow_name}_recommendation"] = output.recommendation
+        progress.update(1)
+        if on_result is not None:
+            on_result(idx, flow_name, output)
+    
+    async def df_rows():
+        for idx, row in df.iterrows():
+            # Convert row to dictionary for LLM input
+            yield idx, row_input(row.to_dict())
+    
+    try:
+        # ผลถูกเขียนลง DataFrame ตาม idx อยู่แล้ว: ไม่ต้องจำกัดจำนวนแถวที่รอเรียงลำดับ
+        async with contextlib.aclosing(classify_rows(df_rows(), llm, max_concurrent, len(df), write_result)) as rows:
+            async for _ in rows:
+                pass
+    finally:
+        progress.close()
+    
+    # Save results (in a worker thread: the event loop may be serving other requests)
+    await asyncio.to_thread(df.to_csv, output_file, index=False)
     print(f"\nResults saved to {output_file}")
 
 def csv_to_risk_classification(csv_file: str, api_key: str, output_file: str = "result_with_risk.csv", max_concurrent: int = 10):
@@ -401,11 +1330,7 @@ def csv_to_risk_classification(csv_file: str, api_key: str, output_file: str = "
     """
     os.environ["GOOGLE_API_KEY"] = api_key
     
-    df = pd.read_csv(csv_file)
-    for flow_name in FLOWS.keys():
-        df[f"{flow_name}_risk_level"] = ""
-        df[f"{flow_name}_risk_reason"] = ""
-        df[f"{flow_name}_recommendation"] = ""
+    df = add_result_columns(pd.read_csv(csv_file))
 
     # สร้าง LLM instance เพียงครั้งเดียว
     llm = build_llm(api_key)
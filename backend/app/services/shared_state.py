@@ -0,0 +1,215 @@
+"""
+Shared State - Cross-worker State for Multi-process Serving
+SQLite (WAL) file shared by all uvicorn workers on the host when
+WEB_CONCURRENCY > 1: LLM request/token windows (so N workers spend one
+quota), leader leases for singleton background loops (Sheets replication)
+and background job status (any worker can answer /jobs). The classification
+cache, batch checkpoints and submission store are already SQLite files and
+are shared the same way.
+
+Leases and jobs are owned by "<pid>:<instance id>". The instance id is a
+uuid drawn at startup and registered per PID, so a PID reused after a
+container restart is not mistaken for the process that used it before.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60.0
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedState:
+    """SQLite-backed state shared by the worker processes of one deployment"""
+
+    def __init__(self, db_path: Path):
+        self.path = Path(db_path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.pid = os.getpid()
+        self.instance = uuid.uuid4().hex
+        self.owner = f"{self.pid}:{self.instance}"
+        self._lock = threading.Lock()
+        # isolation_level=None: transaction ควบคุมเองด้วย BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_quota (scope TEXT NOT NULL, ts REAL NOT NULL, tokens INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_quota_scope ON llm_quota (scope, ts)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, owner TEXT NOT NULL, output_path TEXT NOT NULL, "
+            "partial_path TEXT, cancel_requested INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL)"
+        )
+        # Process ล่าสุดที่ใช้แต่ละ PID (PID ถูกใช้ซ้ำหลัง container restart)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers (pid INTEGER PRIMARY KEY, instance TEXT NOT NULL, started_at REAL NOT NULL)"
+        )
+        self._transaction(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO workers (pid, instance, started_at) VALUES (?, ?, ?)",
+            (self.pid, self.instance, time.time())
+        ))
+
+    def _owner_alive(self, conn, owner) -> bool:
+        """True if the process "<pid>:<instance>" still runs (its PID is alive and was not reused)"""
+        if owner == self.owner:
+            return True
+        pid, _, instance = str(owner).partition(":")
+        if not _pid_alive(int(pid)):
+            return False
+        row = conn.execute("SELECT instance FROM workers WHERE pid = ?", (int(pid),)).fetchone()
+        return row is not None and row[0] == instance
+
+    def _transaction(self, fn):
+        """Run fn(conn) in a write transaction (serialized across processes)"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    # ------------------------------------------------------------
+    # LLM quota windows
+    # ------------------------------------------------------------
+    def reserve_quota(self, scope: str, tokens: int, rpm: int = 0, tpm: int = 0) -> float:
+        """
+        Reserve one request (and its tokens) in the shared 60 s window of scope
+
+        Returns:
+            0 when reserved, otherwise the seconds until the window has room
+        """
+        def reserve(conn) -> float:
+            now = time.time()
+            conn.execute("DELETE FROM llm_quota WHERE scope = ? AND ts <= ?", (scope, now - WINDOW_SECONDS))
+            count, total, oldest = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(tokens), 0), MIN(ts) FROM llm_quota WHERE scope = ?", (scope,)
+            ).fetchone()
+            if (rpm and count >= rpm) or (tpm and count and total + tokens > tpm):
+                return max(0.01, oldest + WINDOW_SECONDS - now)
+            conn.execute("INSERT INTO llm_quota (scope, ts, tokens) VALUES (?, ?, ?)", (scope, now, tokens))
+            return 0.0
+
+        return self._transaction(reserve)
+
+    def quota_usage(self, scope: str) -> Dict[str, int]:
+        """Requests and tokens of all workers in the last 60 s"""
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM llm_quota WHERE scope = ? AND ts > ?",
+                (scope, time.time() - WINDOW_SECONDS)
+            ).fetchone()
+        return {"requests_last_minute": count, "tokens_last_minute": total}
+
+    # ------------------------------------------------------------
+    # Leader leases
+    # ------------------------------------------------------------
+    def try_lease(self, name: str, ttl: float) -> bool:
+        """Acquire or renew the lease `name` for this process (True if held)"""
+        def acquire(conn) -> bool:
+            now = time.time()
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != self.owner and row[1] > now and self._owner_alive(conn, row[0]):
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)", (name, self.owner, now + ttl)
+            )
+            return True
+
+        return self._transaction(acquire)
+
+    # ------------------------------------------------------------
+    # Background jobs
+    # ------------------------------------------------------------
+    def save_job(self, status: Dict[str, Any], output_path: Path, partial_path: Optional[Path] = None) -> None:
+        """Publish the status of a job run by this process"""
+        self._transaction(lambda conn: conn.execute(
+            "INSERT INTO jobs (job_id, status, owner, output_path, partial_path, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(job_id) DO UPDATE SET status = excluded.status, owner = excluded.owner, "
+            "output_path = excluded.output_path, partial_path = COALESCE(excluded.partial_path, partial_path), "
+            "updated_at = excluded.updated_at",
+            (status["job_id"], json.dumps(status), self.owner, str(output_path),
+             str(partial_path) if partial_path else None, time.time())
+        ))
+
+    def _job_from_row(self, row) -> Dict[str, Any]:
+        """Job entry of a row (call with self._lock held)"""
+        job_id, status, owner, output_path, partial_path, cancel_requested = row
+        status = json.loads(status)
+        # Worker ที่รัน job หายไป (restart / crash): job จะไม่มีวันจบ
+        if status["status"] in ("queued", "running") and not self._owner_alive(self._conn, owner):
+            status.update(status="failed", error="Worker running the job exited", eta_seconds=None)
+        return {
+            "status": status,
+            "owner": owner,
+            "output_path": Path(output_path),
+            "partial_path": Path(partial_path) if partial_path else None,
+            "cancel_requested": bool(cancel_requested),
+        }
+
+    def load_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Status, owner and result paths of a job (None if unknown)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, status, owner, output_path, partial_path, cancel_requested FROM jobs WHERE job_id = ?",
+                (job_id,)
+            ).fetchone()
+            return self._job_from_row(row) if row else None
+
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id, status, owner, output_path, partial_path, cancel_requested FROM jobs ORDER BY rowid"
+            ).fetchall()
+            return [self._job_from_row(row) for row in rows]
+
+    def prune_jobs(self, before: float) -> List[Dict[str, Any]]:
+        """Remove jobs last updated before `before` (epoch seconds); returns the removed entries"""
+        def prune(conn) -> List[Dict[str, Any]]:
+            rows = conn.execute(
+                "SELECT job_id, status, owner, output_path, partial_path, cancel_requested FROM jobs WHERE updated_at < ?",
+                (before,)
+            ).fetchall()
+            conn.execute("DELETE FROM jobs WHERE updated_at < ?", (before,))
+            return [self._job_from_row(row) for row in rows]
+
+        return self._transaction(prune)
+
+    def request_cancel(self, job_id: str) -> None:
+        """Ask the worker that runs the job to cancel it"""
+        self._transaction(lambda conn: conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,)))
+
+    def cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+
+# Shared state of a multi-worker deployment (None with a single worker)
+shared_state: Optional[SharedState] = SharedState(settings.SHARED_STATE_PATH) if settings.WORKERS > 1 else None
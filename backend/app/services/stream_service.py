@@ -0,0 +1,215 @@
+"""
+Stream Service - Constant-memory CSV Classification
+Reads an uploaded CSV in chunks, classifies rows as they arrive and emits
+finished rows in input order, so memory stays flat regardless of file size
+and the first rows are available as soon as they are classified.
+"""
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import math
+import tempfile
+from typing import Any, AsyncIterator, BinaryIO, Callable, Dict, List, Optional
+
+import pandas as pd
+
+from app.core.config import settings
+from app.core.flows import FLOWS
+from app.services.risk_service import classify_rows, row_input, RESULT_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_READ_SIZE = 1024 * 1024
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+async def spool_upload(upload) -> BinaryIO:
+    """
+    Copy an UploadFile in 1 MB chunks into a spooled temp file
+
+    The copy outlives the request (FastAPI closes the upload before a
+    StreamingResponse body runs) and spills to disk above 1 MB.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    while True:
+        data = await upload.read(UPLOAD_READ_SIZE)
+        if not data:
+            break
+        spool.write(data)
+    spool.seek(0)
+    return spool
+
+
+def open_csv_reader(file_obj: BinaryIO, chunk_size: int = None):
+    """
+    Open a chunked CSV reader (parses the header, so invalid files fail here)
+
+    Args:
+        file_obj: Binary file object (e.g. UploadFile.file)
+        chunk_size: Rows per chunk (default: CSV_CHUNK_SIZE)
+    """
+    return pd.read_csv(file_obj, chunksize=chunk_size or settings.CSV_CHUNK_SIZE)
+
+
+def count_csv_rows(file_obj: BinaryIO, chunk_size: int = None) -> int:
+    """
+    Count the rows of a CSV through the chunked reader (so the whole file is
+    validated without holding it in memory), then rewind the file
+
+    Blocking: run it in a worker thread (asyncio.to_thread).
+    """
+    try:
+        return sum(len(chunk) for chunk in open_csv_reader(file_obj, chunk_size))
+    finally:
+        file_obj.seek(0)
+
+
+async def iter_csv_rows(reader, source: Optional[BinaryIO] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yield one dict per row from a chunked CSV reader
+
+    Parsing of each chunk runs in a worker thread so the event loop stays free.
+    `source` (the file the reader was opened on) is closed when done.
+    """
+    read = None
+    try:
+        while True:
+            # Cancel ไม่หยุด thread ที่กำลัง parse: รอให้เสร็จก่อนปิดไฟล์
+            read = asyncio.ensure_future(asyncio.to_thread(next, reader, None))
+            chunk = await asyncio.shield(read)
+            if chunk is None:
+                break
+            for _, row in chunk.iterrows():
+                yield row.to_dict()
+    finally:
+        if read is not None and not read.done():
+            await asyncio.wait([read])
+        reader.close()
+        if source is not None:
+            source.close()
+
+
+def result_row(input_data: dict, results: Dict[str, Any]) -> Dict[str, Any]:
+    """The input row with the result columns of every flow added"""
+    row = dict(input_data)
+    for flow_name in FLOWS.keys():
+        output = results[flow_name]
+        row[f"{flow_name}_risk_level"] = output.risk_level
+        row[f"{flow_name}_risk_reason"] = output.reason
+        row[f"{flow_name}_recommendation"] = output.recommendation
+    return row
+
+
+async def stream_classified_rows(
+    rows: AsyncIterator[Dict[str, Any]],
+    llm,
+    max_concurrent: int,
+    window: int = None,
+    on_result: Optional[Callable] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Classify rows as they arrive and yield them in input order
+
+    Cells of all rows in the window share one work queue (classify_rows),
+    so a slow flow only delays the output of its own row. At most `window`
+    rows are read and not yet emitted, so memory is bounded by the window
+    and not by the file size.
+
+    Args:
+        rows: Async generator of input rows (closed when done)
+        llm: LLM instance
+        max_concurrent: Maximum concurrent LLM calls
+        window: Maximum rows in flight (default: CSV_ROW_WINDOW)
+        on_result: Optional callback (row number, flow name, output) per finished cell
+    """
+    async def numbered():
+        seq = 0
+        async with contextlib.aclosing(rows):
+            async for input_data in rows:
+                yield seq, row_input(input_data)
+                seq += 1
+
+    scheduler = classify_rows(numbered(), llm, max_concurrent, window or settings.CSV_ROW_WINDOW, on_result)
+    async with contextlib.aclosing(scheduler) as classified:
+        async for _, input_data, results in classified:
+            yield result_row(input_data, results)
+
+
+def _clean_value(value: Any) -> Any:
+    """NaN -> None so rows serialize the same way as DataFrame.to_csv"""
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def row_to_csv_line(row: Dict[str, Any], columns: List[str]) -> str:
+    """Format one row as a CSV line (same quoting as DataFrame.to_csv)"""
+    buffer = io.StringIO()
+    pd.DataFrame([[_clean_value(row.get(column)) for column in columns]]).to_csv(buffer, header=False, index=False)
+    return buffer.getvalue()
+
+
+def row_to_ndjson_line(row: Dict[str, Any]) -> str:
+    """Format one row as a JSON line"""
+    return json.dumps({key: _clean_value(value) for key, value in row.items()}, ensure_ascii=False, default=str) + "\n"
+
+
+async def stream_csv_lines(rows: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[str]:
+    """Yield a CSV header followed by one line per classified row"""
+    columns: Optional[List[str]] = None
+    async for row in rows:
+        if columns is None:
+            columns = [column for column in row if column not in RESULT_COLUMNS] + RESULT_COLUMNS
+            yield row_to_csv_line(dict(zip(columns, columns)), columns)
+        yield row_to_csv_line(row, columns)
+
+
+async def stream_ndjson_lines(rows: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[str]:
+    """Yield one JSON object per classified row"""
+    async for row in rows:
+        yield row_to_ndjson_line(row)
+
+
+def _append(f, line: str) -> int:
+    """Write and flush one line, returns the file size (blocking)"""
+    f.write(line.encode("utf-8"))
+    f.flush()
+    return f.tell()
+
+
+async def classify_csv_to_file(
+    reader,
+    llm,
+    output_file: str,
+    max_concurrent: int,
+    source: Optional[BinaryIO] = None,
+    on_result: Optional[Callable] = None,
+    on_flush: Optional[Callable[[int], None]] = None
+) -> int:
+    """
+    Stream-classify a CSV and append each finished row to output_file
+
+    Each line is written and flushed in a worker thread, so the event loop
+    never waits on the disk. `on_result` gets every finished cell (row
+    number, flow name, output) and `on_flush` the file size after each row,
+    i.e. the length of the file's complete prefix.
+
+    Returns:
+        int: Number of rows written
+    """
+    count = 0
+    rows = stream_classified_rows(iter_csv_rows(reader, source), llm, max_concurrent, on_result=on_result)
+    f = await asyncio.to_thread(open, output_file, "wb")
+    try:
+        async for line in stream_csv_lines(rows):
+            size = await asyncio.to_thread(_append, f, line)
+            count += 1
+            if on_flush is not None:
+                on_flush(size)
+    finally:
+        await asyncio.to_thread(f.close)
+    rows_written = max(0, count - 1)
+    logger.info(f"Streamed {rows_written} rows to {output_file}")
+    return rows_written
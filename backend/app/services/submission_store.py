@@ -0,0 +1,103 @@
+"""
+Submission Store - Local Durable Log of Form Submissions
+Append-only SQLite (WAL) table that is the primary record of every logged
+row. Google Sheets is a replica fed from here; the replicator keeps a
+high-water mark per sheet so unsent rows survive restarts and outages.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SubmissionStore:
+    """Append-only store of sheet rows with a per-sheet replication high-water mark"""
+
+    def __init__(self, db_path: Path):
+        self._lock = threading.Lock()
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS submissions ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, sheet_name TEXT NOT NULL, row TEXT NOT NULL, "
+            "session_id TEXT, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_submissions_sheet ON submissions (sheet_name, id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS replication_state (sheet_name TEXT PRIMARY KEY, last_id INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+
+    def add(self, sheet_name: str, row: List[Any], session_id: Optional[str] = None) -> int:
+        """
+        Append one row for sheet_name
+
+        Returns:
+            int: Local id of the stored row
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO submissions (sheet_name, row, session_id, created_at) VALUES (?, ?, ?, ?)",
+                (sheet_name, json.dumps(row, ensure_ascii=False, default=str), session_id, time.time())
+            )
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def high_water_mark(self, sheet_name: str) -> int:
+        """Id of the last row replicated to sheet_name (0 if none)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_id FROM replication_state WHERE sheet_name = ?", (sheet_name,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def fetch_unsent(self, sheet_name: str, limit: int) -> List[Tuple[int, List[Any]]]:
+        """Oldest rows above the high-water mark, as (id, row) pairs"""
+        last_id = self.high_water_mark(sheet_name)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, row FROM submissions WHERE sheet_name = ? AND id > ? ORDER BY id LIMIT ?",
+                (sheet_name, last_id, limit)
+            ).fetchall()
+        return [(row_id, json.loads(row)) for row_id, row in rows]
+
+    def mark_sent(self, sheet_name: str, last_id: int) -> None:
+        """Advance the high-water mark of sheet_name"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO replication_state (sheet_name, last_id) VALUES (?, ?) "
+                "ON CONFLICT(sheet_name) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)",
+                (sheet_name, last_id)
+            )
+            self._conn.commit()
+
+    def sheet_names(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT sheet_name FROM submissions").fetchall()
+        return [row[0] for row in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        """Stored and pending row counts per sheet"""
+        sheets = {}
+        for sheet_name in self.sheet_names():
+            last_id = self.high_water_mark(sheet_name)
+            with self._lock:
+                stored, pending = self._conn.execute(
+                    "SELECT COUNT(*), SUM(CASE WHEN id > ? THEN 1 ELSE 0 END) FROM submissions WHERE sheet_name = ?",
+                    (last_id, sheet_name)
+                ).fetchone()
+            sheets[sheet_name] = {"stored": stored, "pending": pending or 0, "high_water_mark": last_id}
+        return sheets
+
+
+# Global submission store
+submission_store = SubmissionStore(settings.SUBMISSION_DB_PATH)
@@ -0,0 +1 @@
+"""Offline benchmarks for the classification hot path (fake LLM, no API quota)"""
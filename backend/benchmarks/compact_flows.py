@@ -0,0 +1,44 @@
+"""
+Compact Flow Criteria Report
+Estimated prompt tokens of each flow's original flowchart against its
+compact flowchart (app/core/flow_compact.py), and the flows that failed the
+equivalence check and are sent as the original text.
+
+Usage (from backend/):
+    python -m benchmarks.compact_flows            # token report per flow
+    python -m benchmarks.compact_flows --show อาการปวด
+    python -m benchmarks.compact_flows --check    # exit 1 if any flow is not equivalent
+"""
+import argparse
+import sys
+from typing import List, Optional
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from app.core.flow_compact import COMPACT_FLOWS, COMPACT_PROBLEMS
+    from app.core.flows import FLOWS
+    from app.services.rate_limiter import estimate_tokens
+
+    parser = argparse.ArgumentParser(description="Report token savings of the compact flow criteria")
+    parser.add_argument("--show", default=None, help="Print the compact flowchart of one flow")
+    parser.add_argument("--check", action="store_true", help="Exit 1 if any flow fails the equivalence check")
+    args = parser.parse_args(argv)
+
+    if args.show:
+        print(COMPACT_FLOWS.get(args.show) or "\n".join(COMPACT_PROBLEMS.get(args.show, ["unknown flow"])))
+        return 0
+
+    total_before = total_after = 0
+    print(f"{'flow':<42} {'tokens':>7} {'compact':>8} {'saved':>6}  status")
+    for name, flow in FLOWS.items():
+        before = estimate_tokens(flow, output_tokens=0)
+        after = estimate_tokens(COMPACT_FLOWS.get(name, flow), output_tokens=0)
+        total_before, total_after = total_before + before, total_after + after
+        status = "ok" if name in COMPACT_FLOWS else "kept original: " + "; ".join(COMPACT_PROBLEMS[name])
+        print(f"{name[:42]:<42} {before:>7} {after:>8} {1 - after / before:>6.0%}  {status}")
+    print(f"{'total (one call per flow)':<42} {total_before:>7} {total_after:>8} {1 - total_after / total_before:>6.0%}")
+    return 1 if args.check and COMPACT_PROBLEMS else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
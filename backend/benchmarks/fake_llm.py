@@ -0,0 +1,114 @@
+"""
+Fake Chat Model for Benchmarks
+Deterministic stand-in for Gemini with configurable latency, jitter,
+failure, rate-limit and malformed-output rates. Answers single-flow
+prompts with one OutputRiskClassification JSON and multi-flow prompts
+with one entry per `### <flow>` section, so every code path runs without
+spending quota.
+"""
+import asyncio
+import json
+import random
+import re
+import time
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import PrivateAttr
+
+RISK_LEVELS = ["ความเสี่ยงต่ำ", "ความเสี่ยงกลาง", "ความเสี่ยงสูง"]
+MULTI_FLOW_HEADER = re.compile(r"^### (.+)$", re.MULTILINE)
+
+
+class FakeRateLimitError(Exception):
+    """Looks like a provider quota error to the rate limiter (429)"""
+
+
+class BenchmarkChatModel(BaseChatModel):
+    """
+    Chat model that sleeps instead of calling an API
+
+    Args:
+        latency: Mean response time in seconds
+        jitter: Uniform +/- jitter added to the latency (seconds)
+        failure_rate: Probability of raising a generic error
+        rate_limit_rate: Probability of raising a 429-style error
+        malformed_rate: Probability of returning text the parser rejects
+        slow_rate: Probability of a slow (tail) response
+        slow_latency: Response time of a slow response in seconds
+        seed: Seed of the random generator (same seed = same sequence)
+        risk_level: Fixed risk level of every answer (random when None)
+    """
+
+    latency: float = 0.05
+    jitter: float = 0.0
+    failure_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    malformed_rate: float = 0.0
+    slow_rate: float = 0.0
+    slow_latency: float = 1.0
+    seed: int = 0
+    risk_level: Optional[str] = None
+    model: str = "benchmark-fake"
+
+    _rng: random.Random = PrivateAttr()
+    _calls: int = PrivateAttr(default=0)
+
+    def model_post_init(self, __context: Any) -> None:
+        self._rng = random.Random(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "benchmark-fake"
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    def _plan(self, messages: List[BaseMessage]):
+        """Draw delay and outcome for one call (before sleeping, so the sequence is deterministic)"""
+        self._calls += 1
+        delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+        if self.slow_rate and self._rng.random() < self.slow_rate:
+            delay = self.slow_latency
+        roll = self._rng.random()
+        if roll < self.failure_rate:
+            return delay, RuntimeError("fake LLM failure")
+        roll -= self.failure_rate
+        if roll < self.rate_limit_rate:
+            return delay, FakeRateLimitError("429 RESOURCE_EXHAUSTED (fake)")
+        roll -= self.rate_limit_rate
+        if roll < self.malformed_rate:
+            return delay, "ขออภัย ไม่สามารถตอบเป็น JSON ได้"
+        return delay, self._answer("\n".join(str(message.content) for message in messages))
+
+    def _answer(self, prompt: str) -> str:
+        flow_names = MULTI_FLOW_HEADER.findall(prompt)
+        if flow_names:
+            return json.dumps({name.strip(): self._result() for name in flow_names}, ensure_ascii=False)
+        return json.dumps(self._result(), ensure_ascii=False)
+
+    def _result(self) -> dict:
+        return {
+            "risk_level": self.risk_level or self._rng.choice(RISK_LEVELS),
+            "recommendation": "ปฏิบัติตามคำแนะนำทั่วไปหลังผ่าตัด",
+            "reason": "ผลจาก fake LLM สำหรับ benchmark",
+        }
+
+    @staticmethod
+    def _to_result(outcome) -> ChatResult:
+        if isinstance(outcome, Exception):
+            raise outcome
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=outcome))])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        delay, outcome = self._plan(messages)
+        time.sleep(delay)
+        return self._to_result(outcome)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        delay, outcome = self._plan(messages)
+        await asyncio.sleep(delay)
+        return self._to_result(outcome)
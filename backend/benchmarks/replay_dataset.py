@@ -0,0 +1,132 @@
+"""
+Dataset Record / Replay Runs
+Runs the batch pipeline (_process_all_rows) over a bundled dataset with the
+LLM wrapped in a cassette. Record once against the real model, then replay
+offline in seconds to profile the pipeline or diff results between commits.
+
+Usage (from backend/):
+    # record (calls Gemini with GOOGLE_API_KEY, or the fake model)
+    python -m benchmarks.replay_dataset record data/66.csv
+    python -m benchmarks.replay_dataset record data/66.csv --fake-llm
+
+    # replay (no network); exits with status 1 when any prompt was not recorded
+    python -m benchmarks.replay_dataset replay data/66.csv --output replay_66.csv
+
+The result cache and batch checkpoints are disabled so every cell reaches the
+LLM (i.e. the cassette). Excel files need openpyxl.
+
+Replay with the same model as the recording (--fake-llm on both or neither):
+the fake model has no native structured output, so its prompts carry format
+instructions and never match a Gemini recording. Replay refuses a mismatch.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Record or replay LLM outputs for a dataset run")
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("dataset", help="CSV or Excel file (relative paths are resolved from backend/)")
+    parser.add_argument("--cassette", default=None, help="Cassette file (default: LLM_CASSETTE_PATH)")
+    parser.add_argument("--output", default=None, help="Output CSV (default: temp file)")
+    parser.add_argument("--limit", type=int, default=None, help="Only the first N rows")
+    parser.add_argument("--max-concurrent", type=int, default=5)
+    parser.add_argument("--fake-llm", action="store_true", help="Record from BenchmarkChatModel instead of Gemini")
+    parser.add_argument("--no-engine", action="store_true", help="Disable the deterministic flow engine")
+    return parser.parse_args(argv)
+
+
+def resolve(path: str) -> Path:
+    path = Path(path)
+    return path if path.is_absolute() else BACKEND_DIR / path
+
+
+def load_dataset(path: Path, limit: Optional[int] = None):
+    import pandas as pd
+
+    if path.suffix.lower() in (".xlsx", ".xls"):
+        try:
+            df = pd.read_excel(path)
+        except ImportError:
+            raise SystemExit("Reading Excel files requires openpyxl (pip install openpyxl)")
+    else:
+        df = pd.read_csv(path)
+    return df.head(limit) if limit else df
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    dataset = resolve(args.dataset)
+    workdir = Path(tempfile.mkdtemp(prefix="cudentist_replay_"))
+
+    os.environ.setdefault("GOOGLE_API_KEY", "replay")
+    os.environ["CACHE_ENABLED"] = "false"
+    os.environ["CHECKPOINT_ENABLED"] = "false"
+    os.environ["COALESCE_REQUESTS"] = "false"
+    os.environ["TQDM_DISABLE"] = "1"
+    if args.no_engine:
+        os.environ["USE_FLOW_ENGINE"] = "false"
+    sys.path.insert(0, str(BACKEND_DIR))
+
+    from app.core.config import settings
+    from app.services import risk_service as rs
+    from app.services.cassette_service import CassetteMismatchError, wrap_with_cassette
+
+    cassette_path = resolve(args.cassette) if args.cassette else settings.LLM_CASSETTE_PATH
+    output = resolve(args.output) if args.output else workdir / f"{args.mode}_{dataset.stem}.csv"
+    df = rs.add_result_columns(load_dataset(dataset, args.limit))
+
+    if args.fake_llm:
+        from benchmarks.fake_llm import BenchmarkChatModel
+        inner = BenchmarkChatModel(latency=0.01)
+    else:
+        inner = rs.build_llm(settings.GOOGLE_API_KEY, settings.MODEL_NAME)
+    try:
+        llm = wrap_with_cassette(inner, mode=args.mode, path=cassette_path, strict=True)
+    except CassetteMismatchError as e:
+        raise SystemExit(f"{e}\nReplay with the model used to record (--fake-llm on both runs or neither)")
+
+    # dict_as_text เขียน temp.txt ใน working directory: ย้ายไปที่ temp dir
+    os.chdir(workdir)
+    fallbacks = 0
+
+    def on_result(idx, flow_name, result):
+        nonlocal fallbacks
+        fallbacks += result.risk_level == "ไม่สามารถประเมินได้"
+
+    started = time.perf_counter()
+    # Retry messages from risk_service go to stdout; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(rs._process_all_rows(df, llm, str(output), args.max_concurrent, on_result=on_result))
+    wall = time.perf_counter() - started
+
+    stats = llm.cassette.stats()
+    report = {
+        "mode": args.mode,
+        "dataset": str(dataset),
+        "rows": len(df),
+        "seconds": round(wall, 2),
+        "fallbacks": fallbacks,
+        "cassette": stats,
+        "output": str(output),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.mode == "replay" and stats["misses"]:
+        print(f"{stats['misses']} prompt(s) missing from the cassette; record again after prompt/data changes", file=sys.stderr)
+    return report
+
+
+if __name__ == "__main__":
+    report = main()
+    sys.exit(1 if report["mode"] == "replay" and report["cassette"]["misses"] else 0)
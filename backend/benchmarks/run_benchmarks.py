@@ -0,0 +1,465 @@
+"""
+Classification Hot-path Benchmarks
+Runs the classification paths against BenchmarkChatModel (no API calls)
+and writes machine-readable results so commits can be compared offline.
+
+Usage (from backend/):
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --quick --latency 0.02 --failure-rate 0.05
+    python -m benchmarks.run_benchmarks --only micro,classify_risk --output bench.json
+
+Results are written to benchmarks/results/bench_<timestamp>_<commit>.json
+unless --output is given.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+SCENARIOS = ["micro", "classify_risk", "classify_all_flows", "process_all_rows", "log_service", "hedging"]
+
+# ข้อมูลตัวอย่าง: มีทั้งคำตอบแบบตัวเลือกและข้อความอิสระ (ต้องใช้ LLM)
+SAMPLE_PATIENT = {
+    "age": 24,
+    "gender": "หญิง",
+    "hn": "BENCH-0001",
+    "procedures": ["ผ่าตัดขากรรไกรบน", "ผ่าตัดขากรรไกรล่าง"],
+    "surgery_date": "2025-01-10",
+    "pain_score": 6,
+    "pain_medication_effective": "ดีขึ้น",
+    "swelling_status": "บวมเท่าเดิม",
+    "breathing_or_swallowing_difficulty": "ไม่มี",
+    "bleeding_status": "มีเลือดซึมเล็กน้อย",
+    "fever_status": "ไม่มีไข้",
+    "numbness_status": "ชาที่ริมฝีปากล่าง",
+    "suture_status": "ปกติ",
+    "other_symptoms": "ปวดหัวเล็กน้อยตอนกลางคืน",
+    "antibiotic_compliance": "ครบตามแพทย์สั่ง",
+    "compress_type": "ประคบเย็น",
+    "has_imf": "ไม่มี",
+    "walking_status": "เดินได้ปกติ",
+    "brushing_teeth": "แปรงได้",
+    "mouth_rinsing": "บ้วนได้",
+    "feeding_method": "ทานทางปาก",
+    "food_types": ["อาหารเหลว"],
+    "food_amount": "ทานได้น้อยกว่าปกติ",
+    "additional_questions": "สามารถกลับไปทำงานได้เมื่อไหร่",
+}
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the classification hot path with a fake LLM")
+    parser.add_argument("--only", default=",".join(SCENARIOS), help=f"Comma-separated scenarios ({', '.join(SCENARIOS)})")
+    parser.add_argument("--quick", action="store_true", help="Fewer iterations (smoke run)")
+    parser.add_argument("--concurrency", default="1,4,16", help="Concurrency levels, comma-separated")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake LLM mean latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Fake LLM latency jitter (s)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fake LLM generic error rate")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fake LLM 429 error rate")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fake LLM malformed output rate")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Fake LLM slow (tail) response rate (hedging scenario: 0.02 if unset)")
+    parser.add_argument("--slow-latency", type=float, default=1.0, help="Fake LLM slow response latency (s)")
+    parser.add_argument("--seed", type=int, default=0, help="Fake LLM random seed")
+    parser.add_argument("--sheet-latency", type=float, default=0.2, help="Fake Google Sheets append latency (s)")
+    parser.add_argument("--cache", action="store_true", help="Keep the result cache and request coalescing enabled")
+    parser.add_argument("--no-flow-engine", action="store_true", help="Send every flow to the LLM")
+    parser.add_argument("--output", help="Write results JSON to this path")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args: argparse.Namespace, workdir: Path) -> None:
+    """Settings are read at import time, so this must run before importing app modules"""
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    os.environ["CACHE_DB_PATH"] = str(workdir / "cache.sqlite3")
+    os.environ["CHECKPOINT_ENABLED"] = "false"
+    os.environ["SUBMISSION_DB_PATH"] = str(workdir / "submissions.sqlite3")
+    os.environ["TQDM_DISABLE"] = "1"
+    if not args.cache:
+        os.environ["CACHE_ENABLED"] = "false"
+        os.environ["COALESCE_REQUESTS"] = "false"
+    if args.no_flow_engine:
+        os.environ["USE_FLOW_ENGINE"] = "false"
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(name: str, params: Dict[str, Any], latencies: List[float], wall: float, errors: int = 0, units: int = None) -> Dict[str, Any]:
+    """One result record (latencies in ms, throughput in units per second)"""
+    units = len(latencies) if units is None else units
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "name": name,
+        "params": params,
+        "count": units,
+        "errors": errors,
+        "wall_seconds": round(wall, 4),
+        "throughput_per_second": round(units / wall, 2) if wall > 0 else None,
+        "p50_ms": to_ms(percentile(latencies, 50)),
+        "p99_ms": to_ms(percentile(latencies, 99)),
+        "mean_ms": to_ms(statistics.fmean(latencies)) if latencies else None,
+    }
+
+
+def unique_patient(i: int) -> dict:
+    """Sample patient with a per-request free-text change (defeats cache / coalescing)"""
+    return {**SAMPLE_PATIENT, "hn": f"BENCH-{i:04d}", "other_symptoms": f"{SAMPLE_PATIENT['other_symptoms']} ({i})"}
+
+
+def time_loop(func: Callable[[], Any], iterations: int) -> List[float]:
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+# ------------------------------------------------------------
+# Scenarios
+# ------------------------------------------------------------
+def bench_micro(args, make_llm) -> List[Dict[str, Any]]:
+    from app.core.flows import FLOWS
+    from app.services import risk_service as rs
+
+    iterations = 200 if args.quick else 2000
+    flow_name, flow = next(iter(FLOWS.items()))
+    parsed_json = json.dumps({"risk_level": "ความเสี่ยงต่ำ", "recommendation": "r", "reason": "x"}, ensure_ascii=False)
+    llm = make_llm()
+    results = []
+
+    cases = {
+        "dict_as_text": lambda: rs.dict_as_text(SAMPLE_PATIENT),
+        "render_flow_input": lambda: rs.render_flow_input(SAMPLE_PATIENT, flow),
+        "flow_engine": lambda: rs.classify_with_flow_engine(SAMPLE_PATIENT, flow),
+        "output_parse": lambda: rs.RISK_PARSER.parse(parsed_json),
+        "prompt_render": lambda: rs.RISK_PROMPT.format(flow_criteria=flow, result_text="ระดับความปวด: 6"),
+    }
+    for name, func in cases.items():
+        start = time.perf_counter()
+        latencies = time_loop(func, iterations)
+        results.append(summarize(f"micro.{name}", {"iterations": iterations}, latencies, time.perf_counter() - start))
+
+    chain_iterations = max(20, iterations // 10)
+    start = time.perf_counter()
+    latencies = time_loop(lambda: rs.build_risk_chain(llm, flow), chain_iterations)
+    results.append(summarize("micro.build_risk_chain", {"iterations": chain_iterations}, latencies, time.perf_counter() - start))
+    return results
+
+
+def bench_classify_risk(args, make_llm, levels: List[int]) -> List[Dict[str, Any]]:
+    from app.core.flows import FLOWS
+    from app.services import risk_service as rs
+
+    requests = 20 if args.quick else 100
+    # flow แรกที่ gating และ flow engine ตัดสินเองไม่ได้ (ต้องเรียก LLM)
+    flow_name, flow = next(
+        (
+            (name, text) for name, text in FLOWS.items()
+            if rs.classify_with_applicability(SAMPLE_PATIENT, text) is None
+            and rs.classify_with_flow_engine(SAMPLE_PATIENT, text) is None
+        ),
+        next(iter(FLOWS.items()))
+    )
+    results = []
+    for level in levels:
+        llm = make_llm()
+        latencies, errors = [], 0
+
+        def call(i: int):
+            start = time.perf_counter()
+            result = rs.classify_risk(unique_patient(i), flow=flow, llm=llm)
+            return time.perf_counter() - start, result.risk_level == "ไม่สามารถประเมินได้"
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level) as pool:
+            for latency, failed in pool.map(call, range(requests)):
+                latencies.append(latency)
+                errors += failed
+        wall = time.perf_counter() - start
+        results.append(summarize("classify_risk", {"concurrency": level, "flow": flow_name, "llm_calls": llm.calls}, latencies, wall, errors))
+    return results
+
+
+def bench_classify_all_flows(args, make_llm, levels: List[int]) -> List[Dict[str, Any]]:
+    import httpx
+    import main
+    from app.routers import classification
+
+    requests = 8 if args.quick else 40
+    results = []
+
+    async def run(level: int, single_call: bool):
+        llm = make_llm()
+        classification.get_llm = lambda: llm
+        semaphore = asyncio.Semaphore(level)
+        latencies, errors = [], 0
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            async def one(i: int):
+                nonlocal errors
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.post(
+                        "/classify-all-flows", params={"single_call": str(single_call).lower()},
+                        json={"data": unique_patient(i)}
+                    )
+                    latencies.append(time.perf_counter() - start)
+                    if response.status_code != 200 or any(
+                        r.get("risk_level") == "ไม่สามารถประเมินได้" for r in response.json().values()
+                    ):
+                        errors += 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*[one(i) for i in range(requests)])
+            wall = time.perf_counter() - start
+        name = "classify_all_flows.single_call" if single_call else "classify_all_flows"
+        return summarize(name, {"concurrency": level, "llm_calls": llm.calls}, latencies, wall, errors)
+
+    for single_call in (False, True):
+        for level in levels:
+            results.append(asyncio.run(run(level, single_call)))
+    return results
+
+
+def bench_process_all_rows(args, make_llm, levels: List[int], workdir: Path) -> List[Dict[str, Any]]:
+    import pandas as pd
+    from app.core.flows import FLOWS
+    from app.services import risk_service as rs
+
+    rows = 10 if args.quick else 50
+    results = []
+    for level in levels:
+        llm = make_llm()
+        df = rs.add_result_columns(pd.DataFrame([unique_patient(i) for i in range(rows)]))
+        started = time.perf_counter()
+        cell_latencies: List[float] = []
+        errors = 0
+
+        def on_result(idx, flow_name, output):
+            nonlocal errors
+            cell_latencies.append(time.perf_counter() - started)
+            errors += output.risk_level == "ไม่สามารถประเมินได้"
+
+        asyncio.run(rs._process_all_rows(df, llm, str(workdir / "bench_rows.csv"), level, on_result=on_result))
+        wall = time.perf_counter() - started
+        record = summarize(
+            "process_all_rows", {"max_concurrent": level, "rows": rows, "llm_calls": llm.calls},
+            cell_latencies, wall, errors, units=rows
+        )
+        # latency ที่นี่คือเวลาตั้งแต่เริ่ม batch จนแต่ละ cell เสร็จ
+        record["cells_per_second"] = round(rows * len(FLOWS) / wall, 2) if wall > 0 else None
+        results.append(record)
+    return results
+
+
+def bench_hedging(args) -> List[Dict[str, Any]]:
+    """
+    Same all-flows workload with hedging off and on, against a fake LLM with
+    a slow tail, so hedge rate and tail improvement can be tuned offline
+    (HEDGE_PERCENTILE / HEDGE_BUDGET / HEDGE_MIN_SAMPLES)
+    """
+    from benchmarks.fake_llm import BenchmarkChatModel
+    from app.core.config import settings
+    from app.core.flows import FLOWS
+    from app.services import risk_service as rs
+    from app.services.hedge_service import RequestHedger
+
+    requests = 80 if args.quick else 300
+    # ต้องมีประวัติ HEDGE_MIN_SAMPLES ครั้งต่อ flow ก่อนจะเริ่ม hedge: ไม่นับช่วง warm-up ทั้งสองรอบ
+    warmup = settings.HEDGE_MIN_SAMPLES
+    # ต่ำกว่า 1 - percentile เพื่อให้ hedge delay อยู่ในช่วงของคำตอบปกติ
+    slow_rate = args.slow_rate or 0.02
+    results = []
+    for hedge in (False, True):
+        llm = BenchmarkChatModel(
+            latency=args.latency, jitter=args.jitter, slow_rate=slow_rate, slow_latency=args.slow_latency, seed=args.seed
+        )
+        settings.HEDGE_ENABLED = hedge
+        rs.request_hedger = hedger = RequestHedger(
+            percentile=settings.HEDGE_PERCENTILE, budget=settings.HEDGE_BUDGET, min_samples=settings.HEDGE_MIN_SAMPLES
+        )
+        latencies: List[float] = []
+
+        async def run():
+            for i in range(requests):
+                start = time.perf_counter()
+                # หนึ่ง submission = ทุก flow พร้อมกัน (ช้าเท่า flow ที่ช้าที่สุด)
+                await asyncio.gather(*[
+                    rs.aclassify_risk(unique_patient(i), flow, llm, flow_name=name) for name, flow in FLOWS.items()
+                ])
+                if i >= warmup:
+                    latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        asyncio.run(run())
+        record = summarize(
+            "hedging", {"hedge": hedge, "slow_rate": slow_rate, "warmup": warmup, "llm_calls": llm.calls},
+            latencies, time.perf_counter() - started
+        )
+        record.update({f"p{p}_ms": round(percentile(latencies, p) * 1000, 3) for p in (90, 95)})
+        if hedge:
+            stats = hedger.stats()
+            record["hedge"] = {key: stats[key] for key in ("hedged", "hedge_wins", "denied", "hedge_rate", "hedge_win_rate")}
+            baseline = results[0]
+            record["tail_improvement_ms"] = {
+                key: round(baseline[key] - record[key], 3) for key in ("mean_ms", "p90_ms", "p95_ms", "p99_ms")
+            }
+        results.append(record)
+    settings.HEDGE_ENABLED = False
+    return results
+
+
+def bench_log_service(args, workdir: Path) -> List[Dict[str, Any]]:
+    from app.services.log_service import SheetsReplicator, build_result_row
+    from app.services import log_service
+    from app.services.submission_store import SubmissionStore
+    from app.services.risk_service import FORM_COLUMNS
+
+    rows = 100 if args.quick else 1000
+    ai_results = {"อาการปวด": {"risk_level": "ความเสี่ยงต่ำ", "reason": "x", "recommendation": "r"}}
+    results = []
+
+    class FakeSheet:
+        def append_rows(self, batch, value_input_option=None):
+            time.sleep(args.sheet_latency)
+
+    original = log_service.get_sheet_by_name
+    log_service.get_sheet_by_name = lambda name: FakeSheet()
+    try:
+        for batch_size in (1, 50):
+            store = SubmissionStore(workdir / f"log_bench_{batch_size}.sqlite3")
+            replicator = SheetsReplicator(store, batch_size=batch_size)
+
+            start = time.perf_counter()
+            latencies = time_loop(
+                lambda: replicator.submit("input_with_result", build_result_row(SAMPLE_PATIENT, ai_results, FORM_COLUMNS)),
+                rows
+            )
+            results.append(summarize("log_service.submit", {"batch_size": batch_size}, latencies, time.perf_counter() - start))
+
+            start = time.perf_counter()
+            with contextlib.redirect_stderr(io.StringIO()):
+                asyncio.run(replicator.sync_once())
+            wall = time.perf_counter() - start
+            results.append(summarize(
+                "log_service.replicate", {"batch_size": batch_size, "sheet_latency": args.sheet_latency},
+                [], wall, units=rows
+            ))
+    finally:
+        log_service.get_sheet_by_name = original
+    return results
+
+
+# ------------------------------------------------------------
+# Runner
+# ------------------------------------------------------------
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def print_table(results: List[Dict[str, Any]]) -> None:
+    print(f"\n{'benchmark':<36} {'params':<40} {'n':>6} {'err':>4} {'ops/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for r in results:
+        params = ",".join(f"{k}={v}" for k, v in r["params"].items() if k != "llm_calls")
+        fmt = lambda value: f"{value:.3f}" if isinstance(value, float) else "-"
+        print(
+            f"{r['name']:<36} {params[:40]:<40} {r['count']:>6} {r['errors']:>4} "
+            f"{fmt(r['throughput_per_second']):>10} {fmt(r['p50_ms']):>10} {fmt(r['p99_ms']):>10}"
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    selected = [name.strip() for name in args.only.split(",") if name.strip()]
+    unknown = set(selected) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {sorted(unknown)}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    workdir = Path(tempfile.mkdtemp(prefix="cudentist_bench_"))
+    configure_environment(args, workdir)
+    sys.path.insert(0, str(BACKEND_DIR))
+    # dict_as_text เขียน temp.txt ใน working directory: ย้ายไปที่ temp dir
+    os.chdir(workdir)
+
+    from benchmarks.fake_llm import BenchmarkChatModel
+
+    def make_llm():
+        return BenchmarkChatModel(
+            latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+            rate_limit_rate=args.rate_limit_rate, malformed_rate=args.malformed_rate,
+            slow_rate=args.slow_rate, slow_latency=args.slow_latency, seed=args.seed
+        )
+
+    results: List[Dict[str, Any]] = []
+    # Retry messages from risk_service go to stdout; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        if "micro" in selected:
+            results += bench_micro(args, make_llm)
+        if "classify_risk" in selected:
+            results += bench_classify_risk(args, make_llm, levels)
+        if "classify_all_flows" in selected:
+            results += bench_classify_all_flows(args, make_llm, levels)
+        if "process_all_rows" in selected:
+            results += bench_process_all_rows(args, make_llm, levels, workdir)
+        if "log_service" in selected:
+            results += bench_log_service(args, workdir)
+        if "hedging" in selected:
+            results += bench_hedging(args)
+
+    from app.core.config import settings
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {
+            **{key: value for key, value in vars(args).items() if key not in ("output", "only")},
+            "scenarios": selected,
+            "use_flow_engine": settings.USE_FLOW_ENGINE,
+            "cache_enabled": settings.CACHE_ENABLED,
+            "coalesce_requests": settings.COALESCE_REQUESTS,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        output = Path(args.output)
+        if not output.is_absolute():
+            output = BACKEND_DIR / output
+    else:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        output = RESULTS_DIR / f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{report['commit'] or 'nogit'}.json"
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    print_table(results)
+    print(f"\nResults saved to {output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
 from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 import logging
 from dotenv import load_dotenv
 
 from app.core.config import settings
-from app.routers import classification, logs
-from app.services.risk_service import build_llm
+from app.routers import classification, logs, jobs
+from app.services.risk_service import get_chain_registry
+from app.services.log_service import sheets_replicator
+from app.services.job_service import job_manager
+from app.services.cassette_service import wrap_with_cassette
+from app.services.llm_pool import build_pooled_llm
 
 load_dotenv()
 
@@ -16,9 +21,40 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Initialize LLM
+# (one client per API key / model when GOOGLE_API_KEYS or LLM_POOL_MODELS lists several)
+llm = wrap_with_cassette(build_pooled_llm())
+logger.info(f"Initialized LLM with model: {settings.MODEL_NAME} ({settings.LLM_POOL_SIZE} client(s))")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the per-flow chain registry (and optionally warm it up) before serving"""
+    if settings.LOG_WRITE_BEHIND:
+        sheets_replicator.start()
+    job_manager.start_cleanup()
+    
+    registry = get_chain_registry(llm).build_all()
+    logger.info("Chain registry ready")
+    
+    if settings.WARMUP_CHAINS:
+        errors = await registry.warm_up()
+        if errors:
+            logger.warning(f"Chain warm-up failed for flows: {list(errors.keys())}")
+        else:
+            logger.info("Chain warm-up complete")
+    
+    yield
+    
+    # Last sync attempt before shutdown (unsent rows stay in the local store)
+    await sheets_replicator.stop()
+    await job_manager.stop_cleanup()
+
+
 app = FastAPI(
     title=settings.API_TITLE,
-    version=settings.API_VERSION
+    version=settings.API_VERSION,
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -31,11 +67,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize LLM
-# Initialize LLM
-llm = build_llm(settings.GOOGLE_API_KEY, settings.MODEL_NAME)
-logger.info(f"Initialized LLM with model: {settings.MODEL_NAME}")
-
 
 # Dependency for LLM injection
 def get_llm():
@@ -45,11 +76,14 @@ def get_llm():
 
 # Make get_llm available to routers
 classification.get_llm = get_llm
+jobs.get_llm = get_llm
 
 # Include routers
 app.include_router(classification.router)
 app.include_router(logs.router)
+app.include_router(jobs.router)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # หลาย worker (WEB_CONCURRENCY > 1) ต้องส่ง app เป็น import string
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=settings.WORKERS)
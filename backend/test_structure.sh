@@ -11,9 +11,13 @@ echo ""
 echo "1️⃣ Testing imports..."
 python -c "from app.core.config import settings; print('✓ Config module OK')" || exit 1
 python -c "from app.core.flows import FLOWS; print('✓ Flows module OK')" || exit 1
+python -c "from app.core.flow_engine import DECISION_TREES; print('✓ Flow engine OK')" || exit 1
+python -m benchmarks.compact_flows --check > /dev/null && echo "✓ Compact flow criteria equivalent" || exit 1
 python -c "from app.models.schemas import PatientData; print('✓ Models module OK')" || exit 1
 python -c "from app.services.risk_service import classify_risk; print('✓ Risk service OK')" || exit 1
+python -c "from app.services.stream_service import stream_classified_rows; print('✓ Stream service OK')" || exit 1
 python -c "from app.routers import classification; print('✓ Classification router OK')" || exit 1
+python -c "from app.routers import jobs; print('✓ Jobs router OK')" || exit 1
 
 echo ""
 echo "2️⃣ Testing main application..."
@@ -0,0 +1,74 @@
+"""
+Shared pytest setup
+
+Settings are read when app modules are imported, so the environment is set
+here first: SQLite stores go to a temp directory and no real API key or
+network access is needed.
+
+Run from backend/:
+    python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+TEST_DIR = Path(tempfile.mkdtemp(prefix="risk_api_tests_"))
+
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ["CACHE_DB_PATH"] = str(TEST_DIR / "classification_cache.sqlite3")
+os.environ["CHECKPOINT_DB_PATH"] = str(TEST_DIR / "batch_checkpoints.sqlite3")
+os.environ["TQDM_DISABLE"] = "1"
+sys.path.insert(0, str(BACKEND_DIR))
+
+# คำตอบจากฟอร์มจริง (frontend/lib/types/form.types.ts); flow ที่มีคำอธิบายหรือตัวเลือกนอก flowchart ต้องใช้ LLM
+# (เทสต์ใช้ benchmarks.fake_llm.BenchmarkChatModel แทน Gemini)
+PATIENT = {
+    "age": 24,
+    "gender": "หญิง",
+    "hn": "TEST-0001",
+    "procedures": ["ผ่าตัดขากรรไกรบน  (Lefort I)", "ผ่าตัดขากรรไกรล่าง (BSSRO-bilateral sagittal split osteotomy)"],
+    "surgery_date": "2025-01-10",
+    "pain_score": 6,
+    "pain_medication_effective": "ดีขึ้น",
+    "swelling_status": "บวมเท่าเดิม",
+    "breathing_or_swallowing_difficulty": "ไม่มี",
+    "bleeding_status": "เลือดซึม แต่หยุดได้เอง",
+    "bleeding_description": "มีเลือดซึมที่หมอนตอนตื่นนอน",
+    "fever_status": "ไม่มีไข้",
+    "numbness_status": "ยังชาอยู่แต่ชาน้อยลงเรื่อยๆ",
+    "suture_status": "ไหมแน่นดี / ไม่ได้สังเกต",
+    "other_symptoms": ["ปวดหัว", "เวียนหัว"],
+    "antibiotic_compliance": "ครบตามแพทย์สั่ง",
+    "compress_type": "ประคบเย็นอยู่",
+    "has_imf": "ไม่มีการมัดฟัน",
+    "walking_status": "ไม่ได้ทำหัตถการ การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก",
+    "brushing_teeth": "แปรงฟันได้",
+    "mouth_rinsing": "บ้วนปากได้",
+    "feeding_method": "รับประทานอาหารได้ปกติ",
+    "food_types": ["อาหารอ่อน เช่น โจ๊ก ข้าวต้ม ไข่ลวก ผักนึ่ง"],
+    "food_amount": "รับประทานอาหารได้น้อยลง",
+    "additional_questions": "สามารถกลับไปทำงานได้เมื่อไหร่",
+}
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(tmp_path, monkeypatch):
+    """
+    Run each test in its own directory (debug output such as temp.txt goes
+    there) with an empty result cache and no batch checkpoints
+    """
+    from app.services.cache_service import classification_cache
+    from app.services.checkpoint_service import checkpoint_store
+
+    monkeypatch.chdir(tmp_path)
+    classification_cache.clear()
+    checkpoint_store.clear()
+
+
+@pytest.fixture
+def patient():
+    return dict(PATIENT)
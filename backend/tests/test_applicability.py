@@ -0,0 +1,94 @@
+"""
+Flow applicability rules and gating before the LLM call
+"""
+import asyncio
+
+import pytest
+
+from app.core.config import settings
+from app.core.flow_applicability import not_applicable_reason
+from app.core.flows import FLOWS
+from app.services.risk_service import (
+    FIELD_LABELS,
+    NO_DATA_RESULT,
+    NOT_APPLICABLE_LEVEL,
+    aclassify_risk,
+    classify_with_applicability,
+)
+from benchmarks.fake_llm import BenchmarkChatModel
+
+IMF = "หากมีการมัดฟันบนและล่างเข้าด้วยกัน ลวดมัดฟันแน่นดีหรือไม่?"
+HIP_WOUND = "แผลบริเวณสะโพก: การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก"
+WALKING = "การเดิน: การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก"
+NG_TUBE = "ตำแหน่งสายยางให้อาหาร: กรณีในผู้ป่วยที่รับประทานอาหารผ่านทางสายยาง (on NG-nasogastric tube)"
+PHLEBITIS = "บริเวณที่เอาเข็มน้ำเกลือออกที่หลังมือหรือข้อมือ (phlebitis)"
+
+# ตัวเลือกจากฟอร์มจริง (frontend/lib/types/form.types.ts)
+BONE_GRAFT = "การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก (Repair alveolar cleft with Iliac crest bone graft)"
+LEFORT = "ผ่าตัดขากรรไกรบน  (Lefort I)"
+WALKING_NOT_DONE = "ไม่ได้ทำหัตถการ การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก"
+
+
+def test_imf_flow_needs_imf(patient):
+    assert patient["has_imf"] == "ไม่มีการมัดฟัน"
+    assert not_applicable_reason(IMF, patient) is not None
+    assert not_applicable_reason(IMF, dict(patient, has_imf="มีการมัดฟัน")) is None
+    # No answer never rules a flow out
+    assert not_applicable_reason(IMF, dict(patient, has_imf=None)) is None
+
+
+def test_contradicting_answer_goes_to_llm(patient):
+    patient["imf_wire_status"] = "ลวดหลวม"
+    assert not_applicable_reason(IMF, patient) is None
+    assert classify_with_applicability(patient, FLOWS[IMF]) is None
+
+
+@pytest.mark.parametrize("procedures, applies", [
+    ([LEFORT], False),
+    ([BONE_GRAFT], True),
+    ([LEFORT, BONE_GRAFT], True),
+])
+def test_hip_wound_flow_needs_bone_graft(patient, procedures, applies):
+    patient["procedures"] = procedures
+    assert (not_applicable_reason(HIP_WOUND, patient) is None) == applies
+
+
+def test_walking_flow_needs_bone_graft_and_walking_answer(patient):
+    patient["procedures"] = [BONE_GRAFT]
+    assert not_applicable_reason(WALKING, dict(patient, walking_status=WALKING_NOT_DONE)) is not None
+    assert not_applicable_reason(WALKING, dict(patient, walking_status="เดินไม่ถนัด")) is None
+    assert not_applicable_reason(WALKING, dict(patient, procedures=[LEFORT], walking_status=None)) is not None
+    # A walking answer without the procedure contradicts the form: the LLM decides
+    assert not_applicable_reason(WALKING, dict(patient, procedures=[LEFORT], walking_status="เดินไม่ถนัด")) is None
+
+
+@pytest.mark.parametrize("feeding_method, applies", [
+    ("รับประทานอาหารได้ปกติ", False),
+    ("รับประทานอาหารผ่านกระบอกฉีดยา (syringe)", False),
+    ("รับประทานอาหารผ่านสายยาง (nasogastric tube)", True),
+])
+def test_ng_tube_flow_needs_tube_feeding(patient, feeding_method, applies):
+    patient["feeding_method"] = feeding_method
+    assert (not_applicable_reason(NG_TUBE, patient) is None) == applies
+
+
+def test_gated_results(patient):
+    gated = classify_with_applicability(patient, FLOWS[IMF])
+    assert gated.risk_level == NOT_APPLICABLE_LEVEL
+    assert classify_with_applicability(patient, FLOWS[PHLEBITIS]).model_dump() == NO_DATA_RESULT
+
+
+def test_gating_skipped_for_raw_headers_and_when_disabled(patient, monkeypatch):
+    raw = {FIELD_LABELS[key]: value for key, value in patient.items() if key in FIELD_LABELS}
+    assert classify_with_applicability(raw, FLOWS[IMF]) is None
+
+    monkeypatch.setattr(settings, "APPLICABILITY_GATING", False)
+    assert classify_with_applicability(patient, FLOWS[IMF]) is None
+
+
+def test_gated_flows_make_no_llm_call(patient):
+    llm = BenchmarkChatModel(latency=0)
+    for flow_name in (IMF, HIP_WOUND, WALKING, NG_TUBE, PHLEBITIS):
+        result = asyncio.run(aclassify_risk(patient, FLOWS[flow_name], llm, flow_name=flow_name))
+        assert result.risk_level in (NOT_APPLICABLE_LEVEL, NO_DATA_RESULT["risk_level"])
+    assert llm.calls == 0
@@ -0,0 +1,100 @@
+"""
+Classification cache: key isolation and the memory / SQLite tiers
+"""
+import asyncio
+import threading
+import time
+
+from app.core.config import settings
+from app.core.flows import FLOWS
+from app.services import risk_service
+from app.services.cache_service import ClassificationCache, make_cache_key
+from benchmarks.fake_llm import BenchmarkChatModel
+
+PAIN = FLOWS["อาการปวด"]
+FEVER = FLOWS["อาการไข้"]
+TEXT = "ระดับความปวด ณ ปัจจุบัน: 3\nทานยาแก้ปวดแล้วดีขึ้นหรือไม่: ดีขึ้น"
+KEY = "1:parser:test"
+RESULT = {"risk_level": "ความเสี่ยงต่ำ", "reason": "ปวดเล็กน้อย", "recommendation": "ดูแลตามคำแนะนำทั่วไป"}
+
+
+def test_key_ignores_whitespace_only():
+    key = make_cache_key(PAIN, "gemini", TEXT, KEY)
+    assert key == make_cache_key(PAIN, "gemini", "  " + TEXT.replace(" ", "   ") + "\n\n", KEY)
+    assert key != make_cache_key(FEVER, "gemini", TEXT, KEY)
+    assert key != make_cache_key(PAIN, "other-model", TEXT, KEY)
+    assert key != make_cache_key(PAIN, "gemini", TEXT.replace("3", "4"), KEY)
+    assert key != make_cache_key(PAIN, "gemini", TEXT, "1:structured:test")
+
+
+def test_prompt_key_tracks_version_template_and_mode(monkeypatch):
+    parser_key = risk_service.prompt_key(risk_service.RISK_PROMPT, "parser")
+    assert parser_key != risk_service.prompt_key(risk_service.STRUCTURED_RISK_PROMPT, "parser")
+    assert parser_key != risk_service.prompt_key(risk_service.STRUCTURED_RISK_PROMPT, "structured")
+    monkeypatch.setattr(risk_service, "PROMPT_VERSION", "test-bump")
+    assert parser_key != risk_service.prompt_key(risk_service.RISK_PROMPT, "parser")
+
+
+def test_chain_registry_key_follows_structured_output(monkeypatch):
+    llm = BenchmarkChatModel(latency=0)
+    # The fake model has no response schema support: pretend it binds one
+    monkeypatch.setattr(risk_service, "bind_structured_output", lambda llm: llm)
+    monkeypatch.setattr(settings, "STRUCTURED_OUTPUT", True)
+    structured = risk_service.ChainRegistry(llm)
+    monkeypatch.setattr(settings, "STRUCTURED_OUTPUT", False)
+    parser = risk_service.ChainRegistry(llm)
+    assert (structured.mode, parser.mode) == ("structured", "parser")
+    assert structured.prompt_key != parser.prompt_key
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    cache = ClassificationCache(tmp_path / "cache.sqlite3")
+    cache.set(PAIN, "gemini", TEXT, KEY, RESULT)
+    assert cache.get(PAIN, "gemini", TEXT, KEY) == RESULT
+
+    restarted = ClassificationCache(tmp_path / "cache.sqlite3")
+    assert restarted.get(PAIN, "gemini", TEXT, KEY) == RESULT
+    assert restarted.get(PAIN, "other-model", TEXT, KEY) is None
+    assert restarted.stats()["totals"] == {"hits": 0, "disk_hits": 1, "misses": 1}
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = ClassificationCache(tmp_path / "cache.sqlite3", ttl_seconds=0.05)
+    cache.set(PAIN, "gemini", TEXT, KEY, RESULT)
+    time.sleep(0.1)
+    assert cache.get(PAIN, "gemini", TEXT, KEY) is None
+
+
+def test_memory_tier_is_bounded():
+    cache = ClassificationCache(None, max_entries=2)
+    for score in range(3):
+        cache.set(PAIN, "gemini", f"{TEXT} {score}", KEY, RESULT)
+    assert cache.stats()["memory_entries"] == 2
+    assert cache.get(PAIN, "gemini", f"{TEXT} 0", KEY) is None
+    assert cache.get(PAIN, "gemini", f"{TEXT} 2", KEY) == RESULT
+
+
+def test_async_access_keeps_sqlite_off_the_event_loop(tmp_path, monkeypatch):
+    disk_threads = []
+
+    def spy(cache, name):
+        method = getattr(cache, name)
+
+        def wrapper(*args):
+            disk_threads.append(threading.current_thread())
+            return method(*args)
+        monkeypatch.setattr(cache, name, wrapper)
+
+    cache = ClassificationCache(tmp_path / "cache.sqlite3")
+    spy(cache, "_write_disk")
+    asyncio.run(cache.aset(PAIN, "gemini", TEXT, KEY, RESULT))
+
+    restarted = ClassificationCache(tmp_path / "cache.sqlite3")
+    spy(restarted, "_read_disk")
+    assert asyncio.run(restarted.aget(PAIN, "gemini", TEXT, KEY)) == RESULT
+    # The disk hit was promoted: the second lookup is served from memory
+    assert asyncio.run(restarted.aget(PAIN, "gemini", TEXT, KEY)) == RESULT
+
+    assert len(disk_threads) == 2
+    assert threading.main_thread() not in disk_threads
+    assert restarted.stats()["totals"] == {"hits": 1, "disk_hits": 1, "misses": 0}
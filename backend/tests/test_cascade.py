@@ -0,0 +1,81 @@
+"""
+Local-first model cascade: when the local answer is used and when it escalates
+"""
+import asyncio
+
+import pytest
+
+from app.core.config import settings
+from app.core.flows import FLOWS
+from app.core.metrics import REGISTRY
+from app.services import risk_service
+from app.services.cache_service import get_cached_result
+from app.services.cascade_service import ModelCascade
+from app.services.risk_service import aclassify_risk, get_chain_registry, render_flow_input
+from benchmarks.fake_llm import BenchmarkChatModel
+
+BLEEDING = "อาการเลือดซึม/ เลือดออก"
+FEVER = "อาการไข้"
+LOW, HIGH = "ความเสี่ยงต่ำ", "ความเสี่ยงสูง"
+
+
+def enable_cascade(monkeypatch, local):
+    monkeypatch.setattr(settings, "CASCADE_ENABLED", True)
+    monkeypatch.setattr(risk_service, "model_cascade", ModelCascade(lambda: local, escalate_levels=(HIGH,), timeout=5))
+
+
+def classify(patient, flow_name, llm):
+    return asyncio.run(aclassify_risk(patient, FLOWS[flow_name], llm, max_retries=1, flow_name=flow_name))
+
+
+def test_accepted_local_answer_skips_remote(patient, monkeypatch):
+    local, remote = BenchmarkChatModel(latency=0, risk_level=LOW), BenchmarkChatModel(latency=0, seed=1)
+    enable_cascade(monkeypatch, local)
+
+    assert classify(patient, BLEEDING, remote).risk_level == LOW
+    assert (local.calls, remote.calls) == (1, 0)
+    assert risk_service.model_cascade.stats()["totals"]["local"] == 1
+
+
+def test_local_result_is_cached_under_local_model_only(patient, monkeypatch):
+    local, remote = BenchmarkChatModel(latency=0, risk_level=LOW), BenchmarkChatModel(latency=0, seed=1)
+    enable_cascade(monkeypatch, local)
+    classify(patient, BLEEDING, remote)
+
+    text = render_flow_input(patient, FLOWS[BLEEDING])
+    assert get_cached_result(FLOWS[BLEEDING], text, get_chain_registry(local).prompt_key, settings.LOCAL_MODEL_NAME) is not None
+    assert get_cached_result(FLOWS[BLEEDING], text, get_chain_registry(remote).prompt_key) is None
+    assert any(
+        f'model="{settings.LOCAL_MODEL_NAME}"' in line and 'source="llm"' in line
+        for line in REGISTRY.render().splitlines()
+    )
+
+    # Reused while the cascade is on
+    classify(patient, BLEEDING, remote)
+    assert (local.calls, remote.calls) == (1, 0)
+
+    # Cascade off: the local answer must not serve a request for the remote model
+    monkeypatch.setattr(settings, "CASCADE_ENABLED", False)
+    classify(patient, BLEEDING, remote)
+    assert (local.calls, remote.calls) == (1, 1)
+    assert get_cached_result(FLOWS[BLEEDING], text, get_chain_registry(remote).prompt_key) is not None
+
+
+@pytest.mark.parametrize("local_kwargs, flow_name, patch, reason", [
+    ({"risk_level": HIGH}, BLEEDING, {}, "level"),
+    ({"malformed_rate": 1.0}, BLEEDING, {}, "invalid"),
+    ({"failure_rate": 1.0}, BLEEDING, {}, "error"),
+    # Structured answer alone is high risk; the description keeps it away from the engine
+    ({"risk_level": LOW}, FEVER, {"fever_status": "มีไข้ (มากกว่า 38 องศาเซลเซียส)", "fever_description": "ไข้ขึ้นตอนเย็น"}, "check"),
+])
+def test_cascade_escalates_to_remote(patient, monkeypatch, local_kwargs, flow_name, patch, reason):
+    local = BenchmarkChatModel(latency=0, **local_kwargs)
+    remote = BenchmarkChatModel(latency=0, risk_level=HIGH, seed=1)
+    enable_cascade(monkeypatch, local)
+    patient.update(patch)
+
+    assert classify(patient, flow_name, remote).risk_level == HIGH
+    assert (local.calls, remote.calls) == (1, 1)
+    assert risk_service.model_cascade.stats()["totals"][reason] == 1
+    text = render_flow_input(patient, FLOWS[flow_name])
+    assert get_cached_result(FLOWS[flow_name], text, get_chain_registry(local).prompt_key, settings.LOCAL_MODEL_NAME) is None
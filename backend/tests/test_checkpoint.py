@@ -0,0 +1,78 @@
+"""
+Batch checkpoints: a rerun of the same rows only calls the LLM for missing cells
+"""
+import asyncio
+
+import pandas as pd
+
+from app.services.cache_service import classification_cache
+from app.services import checkpoint_service
+from app.services.checkpoint_service import checkpoint_store
+from app.services.risk_service import _process_all_rows, add_result_columns
+from benchmarks.fake_llm import BenchmarkChatModel
+
+FAILED_LEVEL = "ไม่สามารถประเมินได้"
+
+
+def rows(patient):
+    return [dict(patient, hn="CKPT-1"), dict(patient, hn="CKPT-2", pain_score=3)]
+
+
+def run_batch(rows, llm, output_file) -> pd.DataFrame:
+    # Result cache cleared so only checkpoints can spare LLM calls
+    classification_cache.clear()
+    df = add_result_columns(pd.DataFrame(rows))
+    asyncio.run(_process_all_rows(df, llm, str(output_file), max_concurrent=4))
+    return df
+
+
+def risk_levels(df: pd.DataFrame) -> pd.DataFrame:
+    return df.filter(like="_risk_level")
+
+
+def test_rerun_resumes_from_checkpoints(patient, tmp_path):
+    first_llm, second_llm = BenchmarkChatModel(latency=0), BenchmarkChatModel(latency=0)
+    first = run_batch(rows(patient), first_llm, tmp_path / "first.csv")
+    assert first_llm.calls > 0
+    assert checkpoint_store.stats()["stored_cells"] > 0
+
+    second = run_batch(rows(patient), second_llm, tmp_path / "second.csv")
+    assert second_llm.calls == 0
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_changed_row_is_classified_again(patient, tmp_path):
+    run_batch(rows(patient), BenchmarkChatModel(latency=0), tmp_path / "first.csv")
+    llm = BenchmarkChatModel(latency=0)
+    changed = rows(patient)
+    changed[1]["bleeding_description"] = "เลือดซึมมากขึ้นตอนกลางคืน"
+    run_batch(changed, llm, tmp_path / "second.csv")
+    assert llm.calls > 0
+
+
+def test_failed_cells_are_not_checkpointed(patient, tmp_path):
+    df = run_batch(rows(patient), BenchmarkChatModel(latency=0, malformed_rate=1.0), tmp_path / "failed.csv")
+    failed = (risk_levels(df) == FAILED_LEVEL).to_numpy().sum()
+    assert failed > 0
+    assert checkpoint_store.stats()["stored_cells"] == risk_levels(df).size - failed
+
+    # Only the failed cells are classified again
+    df = run_batch(rows(patient), BenchmarkChatModel(latency=0), tmp_path / "retry.csv")
+    assert not (risk_levels(df) == FAILED_LEVEL).to_numpy().any()
+    assert checkpoint_store.stats()["stored_cells"] == risk_levels(df).size
+
+
+def test_prompt_change_invalidates_checkpoints(patient, tmp_path, monkeypatch):
+    run_batch(rows(patient), BenchmarkChatModel(latency=0), tmp_path / "first.csv")
+    monkeypatch.setattr(checkpoint_service, "PROMPT_VERSION", "test-bump")
+    llm = BenchmarkChatModel(latency=0)
+    run_batch(rows(patient), llm, tmp_path / "second.csv")
+    assert llm.calls > 0
+
+
+def test_expired_checkpoints_are_ignored(patient, tmp_path, monkeypatch):
+    run_batch(rows(patient), BenchmarkChatModel(latency=0), tmp_path / "first.csv")
+    monkeypatch.setattr(checkpoint_store, "ttl_seconds", 0)
+    llm = BenchmarkChatModel(latency=0)
+    run_batch(rows(patient), llm, tmp_path / "second.csv")
+    assert llm.calls > 0
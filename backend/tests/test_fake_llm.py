@@ -0,0 +1,33 @@
+"""
+Benchmark fake model: the offline stand-in for Gemini used by the benchmarks and these tests
+"""
+import json
+
+import pytest
+
+from app.services.rate_limiter import is_rate_limit_error
+from benchmarks.fake_llm import BenchmarkChatModel, FakeRateLimitError
+
+
+def answers(llm, prompts):
+    return [llm.invoke(prompt).content for prompt in prompts]
+
+
+def test_same_seed_same_sequence():
+    prompts = ["ping"] * 5
+    assert answers(BenchmarkChatModel(latency=0, seed=7), prompts) == answers(BenchmarkChatModel(latency=0, seed=7), prompts)
+
+
+def test_multi_flow_prompt_gets_one_entry_per_section():
+    llm = BenchmarkChatModel(latency=0, risk_level="ความเสี่ยงกลาง")
+    answer = json.loads(llm.invoke("### อาการปวด\n...\n### อาการไข้\n...").content)
+    assert set(answer) == {"อาการปวด", "อาการไข้"}
+    assert {entry["risk_level"] for entry in answer.values()} == {"ความเสี่ยงกลาง"}
+    assert llm.calls == 1
+
+
+def test_quota_errors_look_like_provider_429s():
+    llm = BenchmarkChatModel(latency=0, rate_limit_rate=1.0)
+    with pytest.raises(FakeRateLimitError) as error:
+        llm.invoke("ping")
+    assert is_rate_limit_error(error.value)
@@ -0,0 +1,197 @@
+"""
+Deterministic flow engine against the options the frontend form sends
+(frontend/lib/types/form.types.ts)
+"""
+import pytest
+
+from app.core.flow_compact import COMPACT_FLOWS, COMPACT_PROBLEMS, check_equivalence
+from app.core.flow_engine import DECISION_TREES, FLOW_DECISION_FIELDS, compile_flow
+from app.core.flows import FLOWS
+from app.services.risk_service import classify_with_flow_engine
+
+LOW, MID, HIGH = "ความเสี่ยงต่ำ", "ความเสี่ยงกลาง", "ความเสี่ยงสูง"
+
+PAIN = "อาการปวด"
+SWELLING = "อาการบวม"
+OTHER = "อาการอื่นๆ (เลือกได้หลายคำตอบ)"
+IMF = "หากมีการมัดฟันบนและล่างเข้าด้วยกัน ลวดมัดฟันแน่นดีหรือไม่?"
+HIP_WOUND = "แผลบริเวณสะโพก: การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก"
+
+# Answers of the other decision nodes on the path to the tested field
+CONTEXT = {
+    "pain_medication_effective": {"pain_score": 3},
+    "swelling_status": {"breathing_or_swallowing_difficulty": "ไม่มี"},
+    "breathing_or_swallowing_difficulty": {"swelling_status": "บวมเท่าเดิม"},
+    "imf_wire_status": {"has_imf": "มีการมัดฟัน"},
+    "has_imf": {"imf_wire_status": "ลวด/ยางมัดฟันแน่นดี"},
+}
+
+# field -> [(form option, risk level; None = not decided by the flowchart)]
+FORM_OPTIONS = {
+    "pain_medication_effective": [("ดีขึ้น", LOW), ("ไม่ดีขึ้น", HIGH), ("ไม่ได้ทานยาแก้ปวด", LOW)],
+    "swelling_status": [
+        ("ปัจจุบันหายบวมแล้ว", LOW),
+        ("บวมลดลง", LOW),
+        ("บวมเท่าเดิม", LOW),
+        ("บวมมากขึ้น", MID),
+        ("บวมมากขึ้นมากๆจนกระทบการใช้ชีวิตประจำวัน", HIGH),
+    ],
+    "breathing_or_swallowing_difficulty": [("ไม่มี", LOW), ("มี", HIGH)],
+    "bleeding_status": [
+        ("ไม่มีเลือดซึมหรือไหลแล้ว", LOW),
+        ("เลือดซึม แต่หยุดได้เอง", LOW),
+        ("เลือดสีแดงสดไหลไม่หยุดปริมาณมาก", HIGH),
+    ],
+    "fever_status": [("ไม่มีไข้", LOW), ("มีไข้ (มากกว่า 38 องศาเซลเซียส)", HIGH)],
+    "phlebitis": [("ไม่มีอาการปวด/บวม/แดง รอบรอยเข็ม", LOW), ("มีอาการปวด/บวม/แดง รอบรอยเข็ม", MID)],
+    "suture_status": [
+        ("ไหมแน่นดี / ไม่ได้สังเกต", LOW),
+        ("ไหมหลุดหายไปบางส่วน แต่ไม่มีเลือดไหล", LOW),
+        ("ไหมหลุดหายไปบางส่วน และมีอาการเลือดสีแดงสดไหล", HIGH),
+    ],
+    "other_symptoms": [
+        (["ปวดหน่วงบริเวณหน้าแก้ม ร่วมกับมีน้ำมูกสีเหลือง/เขียว เหม็นลงคอ"], HIGH),
+        (["คลื่นไส้/อาเจียน"], MID),
+        (["ช้ำบริเวณแผลผ่าตัด"], LOW),
+        (["ปวดหัว"], LOW),
+        (["เวียนหัว"], None),
+        (["น้ำหนักลด"], LOW),
+        (["ท้องเสีย"], LOW),
+        (["คัดแน่นจมูก"], MID),
+        (["มีน้ำมูก"], LOW),
+        (["ไอ"], None),
+        (["เจ็บคอ"], LOW),
+    ],
+    "antibiotic_compliance": [("ครบตามแพทย์สั่ง", LOW), ("ลืมทานบางครั้ง", LOW), ("ไม่ได้ทานเลย", MID)],
+    "compress_type": [("ประคบเย็นอยู่", LOW), ("ประคบอุ่นอยู่", LOW), ("ไม่ได้ประคบอะไรเลย", LOW)],
+    # ไม่มีการมัดฟัน ends on a non-risk node (the flow does not apply)
+    "has_imf": [("ไม่มีการมัดฟัน", None), ("มีการมัดฟัน", LOW)],
+    "imf_wire_status": [
+        ("ลวด/ยางมัดฟันแน่นดี", LOW),
+        ("ลวด/ยางมัดฟันหลวม อ้าปากได้เล็กน้อย", HIGH),
+        ("ยางมัดฟันขาดไปบางเส้น แต่ยังอ้าปากไม่ได้", LOW),
+    ],
+    "walking_status": [
+        ("ไม่ได้ทำหัตถการ การรักษาการแหว่งของสันเหงือกโดยการนำกระดูกสะโพกมาปลูก", None),
+        ("เดินได้ปกติ", LOW),
+        ("เดินไม่ถนัด", LOW),
+    ],
+    "ng_tube_position": [
+        ("สายยางอยู่ในตำแหน่งเดิม,  เทปยึดจมูกกับสายแน่นดี ไม่เลื่อนหลุด", LOW),
+        ("สายยางเลื่อนตำแหน่ง, เทปยึดจมูกกับสายไม่แน่น, เลื่อนหลุด", HIGH),
+    ],
+    "brushing_teeth": [("แปรงฟันได้", LOW), ("แปรงฟันไม่ได้", LOW)],
+    "mouth_rinsing": [("บ้วนปากได้", LOW), ("บ้วนปากไม่ได้", LOW)],
+    "feeding_method": [
+        ("รับประทานอาหารผ่านกระบอกฉีดยา (syringe)", LOW),
+        ("รับประทานอาหารผ่านสายยาง (nasogastric tube)", LOW),
+        ("รับประทานอาหารได้ปกติ", LOW),
+    ],
+    "food_types": [
+        (["อาหารเหลวใสไม่มีกาก เช่น น้ำซุปใส น้ำผลไม้กรอง นม"], LOW),
+        (["อาหารปั่นเหลวมีกาก เช่น โจ๊กปั่นเหลว ไก่ปั่น"], LOW),
+        (["อาหารอ่อน เช่น โจ๊ก ข้าวต้ม ไข่ลวก ผักนึ่ง"], LOW),
+        (["อาหารปกติแต่เว้นอาหารรสจัด เผ็ด ร้อน แข็ง เหนียว"], LOW),
+    ],
+    "food_amount": [("รับประทานอาหารปริมาณปกติ", LOW), ("รับประทานอาหารได้น้อยลง", LOW)],
+}
+
+# Typed answers that only resemble a flowchart option: never decided by the engine
+FREE_TEXT = [
+    ("other_symptoms", ["ปวดหัวรุนแรง ตาพร่ามัว อาเจียนเป็นเลือด"]),
+    ("other_symptoms", ["เจ็บคอมาก กลืนไม่ได้ หายใจลำบาก"]),
+    ("other_symptoms", ["ไม่มีน้ำมูก"]),
+    ("other_symptoms", ["ปวดหัว", "ไม่มีน้ำมูก"]),
+    ("swelling_status", "บวมมากขึ้นเรื่อยๆ หายใจไม่สะดวก"),
+    ("bleeding_status", "เลือดซึม"),
+    ("fever_status", "มีไข้ต่ำๆ"),
+    ("breathing_or_swallowing_difficulty", "มีบ้างตอนกลืน"),
+    ("suture_status", "ไหมหลุด"),
+    ("imf_wire_status", "ลวดหลวม"),
+    ("pain_medication_effective", "ดีขึ้นนิดหน่อย แต่ยังปวดมาก"),
+]
+
+CASES = [
+    (field_name, option, level)
+    for field_name, options in FORM_OPTIONS.items()
+    for option, level in options
+]
+
+
+def tree_for(field_name: str):
+    return next(tree for tree in DECISION_TREES.values() if field_name in tree.fields)
+
+
+def evaluate(field_name: str, value):
+    data = dict(CONTEXT.get(field_name, {}), **{field_name: value})
+    decision = tree_for(field_name).evaluate(data)
+    return decision.risk_level if decision else None
+
+
+@pytest.mark.parametrize("field_name, option, level", CASES, ids=[f"{f}={o}" for f, o, _ in CASES])
+def test_every_form_option(field_name, option, level):
+    assert evaluate(field_name, option) == level
+
+
+@pytest.mark.parametrize("field_name, value", FREE_TEXT, ids=[f"{f}={v}" for f, v in FREE_TEXT])
+def test_free_text_answers_go_to_llm(field_name, value):
+    assert evaluate(field_name, value) is None
+
+
+def test_every_bound_field_is_covered():
+    bound = {name for tree in DECISION_TREES.values() for name in tree.fields}
+    assert bound - {"pain_score"} == set(FORM_OPTIONS)
+
+
+@pytest.mark.parametrize("score, medication, level", [
+    (0, None, LOW),
+    (3, "ดีขึ้น", LOW),
+    (6, "ไม่ดีขึ้น", HIGH),
+    (7, None, HIGH),
+    (10, "ดีขึ้น", HIGH),
+    (3, None, None),
+    ("ไม่ทราบ", None, None),
+])
+def test_pain_score_thresholds(score, medication, level):
+    decision = DECISION_TREES[PAIN].evaluate({"pain_score": score, "pain_medication_effective": medication})
+    assert (decision.risk_level if decision else None) == level
+
+
+def test_multi_select_takes_highest_level():
+    decision = DECISION_TREES[OTHER].evaluate({"other_symptoms": ["ปวดหัว", "คลื่นไส้/อาเจียน"]})
+    assert decision.risk_level == MID
+    # One option the flowchart does not cover leaves the whole answer to the LLM
+    assert DECISION_TREES[OTHER].evaluate({"other_symptoms": ["ปวดหัว", "เวียนหัว"]}) is None
+
+
+def test_missing_answers_and_unbound_flows_are_not_decided():
+    assert DECISION_TREES[SWELLING].evaluate({"swelling_status": "บวมเท่าเดิม"}) is None
+    assert DECISION_TREES[IMF].evaluate({"has_imf": "มีการมัดฟัน"}) is None
+    assert DECISION_TREES[OTHER].evaluate({"other_symptoms": []}) is None
+    assert DECISION_TREES[HIP_WOUND].evaluate({"procedures": ["ถอนฟัน (Extraction)"]}) is None
+
+
+@pytest.mark.parametrize("extra", [
+    {"note": "ผู้ป่วยมีประวัติเลือดออกง่าย"},
+    {"fever_description": "ไข้ขึ้นตอนกลางคืน"},
+])
+def test_note_or_description_goes_to_llm(extra):
+    data = {"fever_status": "ไม่มีไข้"}
+    assert classify_with_flow_engine(data, FLOWS["อาการไข้"]).risk_level == LOW
+    assert classify_with_flow_engine(dict(data, **extra), FLOWS["อาการไข้"]) is None
+
+
+@pytest.mark.parametrize("field_name, option, level", CASES, ids=[f"{f}={o}" for f, o, _ in CASES])
+def test_compact_flowchart_decides_like_the_original(field_name, option, level):
+    name = tree_for(field_name).flow_name
+    compact = compile_flow(name, COMPACT_FLOWS[name], FLOW_DECISION_FIELDS.get(name))
+    data = dict(CONTEXT.get(field_name, {}), **{field_name: option})
+    assert compact.evaluate(data) == tree_for(field_name).evaluate(data)
+
+
+def test_compact_flowchart_keeps_summaries():
+    assert not COMPACT_PROBLEMS
+    assert "สรุป: Pain Score < 7, ทานยาแล้วยังไม่ดีขึ้น → เสี่ยงสูง" in COMPACT_FLOWS[PAIN]
+
+    without_summary = "\n".join(line for line in COMPACT_FLOWS[PAIN].splitlines() if "ยังไม่ดีขึ้น" not in line)
+    assert any(problem.startswith("summaries differ") for problem in check_equivalence(DECISION_TREES[PAIN], without_summary))
@@ -0,0 +1,94 @@
+"""
+Hedged requests: the loser and abandoned calls are cancelled
+"""
+import asyncio
+
+import pytest
+
+from app.services.hedge_service import RequestHedger
+from benchmarks.fake_llm import BenchmarkChatModel
+
+FLOW = "อาการปวด"
+
+
+class ModelCalls:
+    """
+    call() for RequestHedger.run: the n-th call goes to models[n] after
+    queueing `queued` seconds for its rate limiter slot
+    """
+
+    def __init__(self, *latencies: float, queued: float = 0.0):
+        self.models = [BenchmarkChatModel(latency=latency) for latency in latencies]
+        self.queued = queued
+        self.started = 0
+        self.cancelled = []
+
+    async def __call__(self, on_start):
+        number = self.started
+        self.started += 1
+        try:
+            await asyncio.sleep(self.queued)
+            on_start()
+            return await self.models[number].ainvoke("ping")
+        except asyncio.CancelledError:
+            self.cancelled.append(number)
+            raise
+
+
+def hedger(budget=1.0):
+    hedger = RequestHedger(percentile=50, budget=budget, min_samples=1)
+    hedger.record_latency(FLOW, 0.05)
+    return hedger
+
+
+def test_fast_hedge_wins_and_cancels_primary():
+    calls = ModelCalls(5.0, 0.01)
+    policy = hedger()
+
+    async def scenario():
+        result = await asyncio.wait_for(policy.run(FLOW, calls), timeout=2)
+        await asyncio.sleep(0)  # let the cancelled primary unwind
+        return result
+
+    assert asyncio.run(scenario()).content
+    assert calls.cancelled == [0]
+    stats = policy.stats()
+    assert (stats["hedged"], stats["hedge_wins"]) == (1, 1)
+    # The cancelled primary is recorded with the time it had run (at least the hedge delay)
+    assert len(policy._latencies[FLOW]) == 3 and max(policy._latencies[FLOW]) >= 0.05
+
+
+def test_rate_limiter_queue_is_not_hedged_or_timed():
+    calls = ModelCalls(0.01, 0.01, queued=0.3)
+    policy = hedger()
+
+    assert asyncio.run(policy.run(FLOW, calls)).content
+    stats = policy.stats()
+    assert (stats["hedged"], stats["denied"], calls.started) == (0, 0, 1)
+    assert max(policy._latencies[FLOW]) < 0.2
+
+
+def test_caller_cancellation_cancels_both_calls():
+    calls = ModelCalls(5.0, 5.0)
+    policy = hedger()
+
+    async def scenario():
+        task = asyncio.ensure_future(policy.run(FLOW, calls))
+        await asyncio.sleep(0.2)  # past the hedge delay: both calls in flight
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+
+    asyncio.run(asyncio.wait_for(scenario(), timeout=2))
+    assert sorted(calls.cancelled) == [0, 1]
+
+
+def test_no_hedge_without_budget():
+    calls = ModelCalls(0.2, 0.01)
+    policy = hedger(budget=0.0)
+
+    assert asyncio.run(policy.run(FLOW, calls)).content
+    stats = policy.stats()
+    assert (stats["hedged"], stats["denied"]) == (0, 1)
+    assert calls.started == 1 and calls.cancelled == []
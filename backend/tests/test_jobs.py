@@ -0,0 +1,119 @@
+"""
+Background jobs: rows streamed to the result file, shared job state only touched from worker threads
+"""
+import asyncio
+import io
+import threading
+
+import pandas as pd
+
+from app.services import job_service
+from app.services.job_service import JOB_CANCELLED, JOB_COMPLETED, JobManager
+from app.services.shared_state import SharedState
+from benchmarks.fake_llm import BenchmarkChatModel
+
+SHARED_CALLS = ("save_job", "load_job", "list_jobs", "prune_jobs", "request_cancel", "cancel_requested")
+
+
+def upload(patient: dict, rows: int):
+    """(CSV file, row count) as the jobs router passes them to submit"""
+    source = io.BytesIO()
+    pd.DataFrame([dict(patient, hn=f"ROW-{i}") for i in range(rows)]).to_csv(source, index=False)
+    source.seek(0)
+    return source, rows
+
+
+def record_threads(shared: SharedState, monkeypatch) -> list:
+    """Thread of every shared-state call"""
+    threads = []
+    for name in SHARED_CALLS:
+        method = getattr(shared, name)
+
+        def wrapper(*args, _method=method, **kwargs):
+            threads.append(threading.current_thread())
+            return _method(*args, **kwargs)
+        monkeypatch.setattr(shared, name, wrapper)
+    return threads
+
+
+def test_shared_state_stays_off_the_event_loop(patient, tmp_path, monkeypatch):
+    shared = SharedState(tmp_path / "shared.sqlite3")
+    threads = record_threads(shared, monkeypatch)
+    manager = JobManager(tmp_path / "results", shared=shared, ttl_seconds=3600)
+
+    async def scenario():
+        job = manager.submit(*upload(patient, 2), BenchmarkChatModel(latency=0), "upload.csv", 4)
+        await job.task
+        return job.job_id, await manager.statuses(), await manager.cancel(job.job_id)
+
+    job_id, statuses, cancelled = asyncio.run(scenario())
+    assert threads and threading.main_thread() not in threads
+    assert [status["status"] for status in statuses] == [JOB_COMPLETED]
+    assert cancelled["status"] == JOB_COMPLETED
+    # The final status reached the shared state before the job task ended
+    assert shared.load_job(job_id)["status"]["status"] == JOB_COMPLETED
+
+
+def test_reads_do_not_evict_expired_jobs(patient, tmp_path):
+    manager = JobManager(tmp_path / "results", ttl_seconds=0)
+
+    async def scenario():
+        job = manager.submit(*upload(patient, 1), BenchmarkChatModel(latency=0), "upload.csv", 4)
+        await job.task
+        await asyncio.sleep(0.01)
+        assert (await manager.status(job.job_id))["status"] == JOB_COMPLETED
+        assert len(await manager.statuses()) == 1
+        assert job.output_path.exists()
+
+        assert await manager.evict_expired() == 1
+        assert not job.output_path.exists()
+        return await manager.status(job.job_id)
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_cancel_from_another_worker(patient, tmp_path, monkeypatch):
+    monkeypatch.setattr(job_service, "PUBLISH_INTERVAL", 0.05)
+    runner = JobManager(tmp_path / "results", shared=SharedState(tmp_path / "shared.sqlite3"))
+    other = JobManager(tmp_path / "results", shared=SharedState(tmp_path / "shared.sqlite3"))
+
+    async def scenario():
+        job = runner.submit(*upload(patient, 20), BenchmarkChatModel(latency=0.5), "upload.csv", 2)
+        await asyncio.sleep(0.2)
+        assert await other.cancel(job.job_id) is not None
+        await asyncio.wait_for(asyncio.gather(job.task, return_exceptions=True), timeout=5)
+        return job, await other.status(job.job_id)
+
+    job, seen_by_other = asyncio.run(scenario())
+    assert job.status == JOB_CANCELLED
+    assert seen_by_other["status"] == JOB_CANCELLED
+
+
+def test_rows_are_written_in_order_and_kept_on_cancel(patient, tmp_path):
+    manager = JobManager(tmp_path / "results")
+
+    async def scenario():
+        done = manager.submit(*upload(patient, 3), BenchmarkChatModel(latency=0), "upload.csv", 4)
+        await done.task
+        cancelled = manager.submit(*upload(patient, 20), BenchmarkChatModel(latency=0.1), "upload.csv", 2)
+        # Partial results while running: the rows already written
+        while True:
+            result = await manager.result_file(cancelled.job_id)
+            if result is not None and len(pd.read_csv(result[0])) >= 1:
+                break
+            await asyncio.sleep(0.05)
+        await manager.cancel(cancelled.job_id)
+        await asyncio.gather(cancelled.task, return_exceptions=True)
+        return done, cancelled, await manager.result_file(cancelled.job_id)
+
+    done, cancelled, (partial_path, is_partial) = asyncio.run(asyncio.wait_for(scenario(), timeout=10))
+    result = pd.read_csv(done.output_path)
+    assert list(result["hn"]) == ["ROW-0", "ROW-1", "ROW-2"]
+    assert result.filter(like="_risk_level").notna().all().all()
+    assert cancelled.status == JOB_CANCELLED and is_partial
+    # Finished rows in input order; the unfinished file and the upload are gone
+    partial = pd.read_csv(partial_path)
+    assert 1 <= len(partial) < 20
+    assert list(partial["hn"]) == [f"ROW-{i}" for i in range(len(partial))]
+    assert not done.work_path.exists() and not cancelled.work_path.exists()
+    assert cancelled.source is None
@@ -0,0 +1,113 @@
+"""
+LLM client pool: parking after a quota error and failover to the next client
+"""
+import asyncio
+
+import pytest
+
+from app.core.config import settings
+from app.core.flows import FLOWS
+from app.services.cache_service import get_cached_result
+from app.services.llm_pool import LLMClientPool, PooledClient, retry_delay
+from app.services.rate_limiter import AdaptiveRateLimiter
+from app.services.risk_service import aclassify_risk, get_chain_registry, render_flow_input
+from benchmarks.fake_llm import BenchmarkChatModel, FakeRateLimitError
+
+
+def make_pool(*models) -> LLMClientPool:
+    """LLMClientPool over fake models, e.g. make_pool(rate_limited, healthy); client N serves model fake-N"""
+    clients = [
+        PooledClient(f"key{index}/fake", model, AdaptiveRateLimiter(max_concurrency=4), model_name=f"fake-{index}")
+        for index, model in enumerate(models, 1)
+    ]
+    return LLMClientPool(clients=clients, park_seconds=30)
+
+
+def fake(**kwargs) -> BenchmarkChatModel:
+    return BenchmarkChatModel(latency=0, **kwargs)
+
+
+def test_rate_limited_client_is_parked_and_call_fails_over():
+    limited, healthy = fake(rate_limit_rate=1.0), fake()
+    llm = make_pool(limited, healthy)
+
+    assert asyncio.run(llm.ainvoke("ping")).content
+    assert (limited.calls, healthy.calls) == (1, 1)
+    first, second = llm.clients
+    assert not first.healthy and second.healthy
+    assert first.stats()["rate_limited"] == 1
+
+    # Parked client is skipped until it unparks
+    assert llm.invoke("ping").content
+    assert (limited.calls, healthy.calls) == (1, 2)
+    assert llm.stats()["healthy_clients"] == 1
+
+
+def test_all_clients_rate_limited_raises():
+    llm = make_pool(fake(rate_limit_rate=1.0), fake(rate_limit_rate=1.0, seed=1))
+    with pytest.raises(FakeRateLimitError):
+        asyncio.run(llm.ainvoke("ping"))
+    assert llm.stats()["healthy_clients"] == 0
+
+
+def test_other_errors_do_not_fail_over():
+    failing, healthy = fake(failure_rate=1.0), fake()
+    llm = make_pool(failing, healthy)
+    with pytest.raises(RuntimeError, match="fake LLM failure"):
+        asyncio.run(llm.ainvoke("ping"))
+    assert healthy.calls == 0
+    assert llm.clients[0].healthy
+
+
+def test_pool_serves_classification_chain(patient):
+    llm = make_pool(fake(rate_limit_rate=1.0), fake(risk_level="ความเสี่ยงกลาง"))
+    flow_name = "อาการเลือดซึม/ เลือดออก"
+    result = asyncio.run(aclassify_risk(patient, FLOWS[flow_name], llm, max_retries=1, flow_name=flow_name))
+    assert result.risk_level == "ความเสี่ยงกลาง"
+
+
+def test_answering_model_is_cached_and_reported(patient):
+    limited, healthy = fake(rate_limit_rate=1.0), fake(risk_level="ความเสี่ยงกลาง")
+    llm = make_pool(limited, healthy)
+    flow_name = "อาการเลือดซึม/ เลือดออก"
+    flow = FLOWS[flow_name]
+
+    result = asyncio.run(aclassify_risk(patient, flow, llm, max_retries=1, flow_name=flow_name))
+    assert result.answered_by == "fake-2"
+
+    key = get_chain_registry(llm).prompt_key
+    result_text = render_flow_input(patient, flow)
+    assert get_cached_result(flow, result_text, key, "fake-2") is not None
+    assert get_cached_result(flow, result_text, key, settings.MODEL_NAME) is None
+
+    # Served from the cache of the model that answered
+    cached = asyncio.run(aclassify_risk(patient, flow, llm, max_retries=1, flow_name=flow_name))
+    assert (cached.risk_level, cached.answered_by, healthy.calls) == ("ความเสี่ยงกลาง", "fake-2", 1)
+
+
+def test_sync_calls_use_the_client_limiter():
+    llm = make_pool(fake(), fake())
+    first, second = llm.clients
+    second.limiter.record_outcome = lambda *args: pytest.fail("outcome recorded on the wrong client")
+
+    message = llm.invoke("ping")
+    assert message.response_metadata["pool_model"] == "fake-1"
+    assert first.limiter.stats()["acquired"] == 1
+    assert first.limiter._in_flight == 0
+
+
+def test_pick_counts_requests_in_memory():
+    llm = make_pool(fake(), fake())
+    for client in llm.clients:
+        client.limiter.stats = lambda: pytest.fail("pick read the limiter stats")
+    llm.clients[0].limiter._requests.append(0.0)
+    assert llm.pick() is llm.clients[1]
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("429 RESOURCE_EXHAUSTED. Please retry in 17s.", 17.0),
+    ('{"@type": "RetryInfo", "retryDelay": "23.5s"}', 23.5),
+    ("429 RESOURCE_EXHAUSTED", 60.0),
+])
+def test_retry_delay_uses_provider_hint(message, expected):
+    assert retry_delay(Exception(message), 60.0) == expected
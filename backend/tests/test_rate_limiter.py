@@ -0,0 +1,165 @@
+"""
+Adaptive rate limiter: concurrency / RPM budgets and AIMD on quota errors
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.core.flows import FLOWS
+from app.services import risk_service
+from app.services.rate_limiter import AdaptiveRateLimiter, is_rate_limit_error
+from benchmarks.fake_llm import BenchmarkChatModel
+
+QUOTA_ERROR = Exception("429 RESOURCE_EXHAUSTED: quota exceeded")
+
+
+def test_concurrency_is_capped():
+    limiter = AdaptiveRateLimiter(max_concurrency=2)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with limiter.acquire():
+            peak = max(peak, limiter.stats()["in_flight"])
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        await asyncio.gather(*(call() for _ in range(6)))
+
+    asyncio.run(scenario())
+    stats = limiter.stats()
+    assert peak == 2
+    assert (stats["acquired"], stats["in_flight"], stats["queue_depth"]) == (6, 0, 0)
+
+
+def test_requests_wait_for_rpm_budget():
+    limiter = AdaptiveRateLimiter(max_concurrency=10, rpm=2)
+
+    async def scenario():
+        for _ in range(2):
+            async with limiter.acquire():
+                pass
+        async with limiter.acquire():
+            pass
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(scenario(), timeout=0.2))
+    assert limiter.stats()["requests_last_minute"] == 2
+
+
+def test_quota_error_backs_off_and_success_recovers():
+    limiter = AdaptiveRateLimiter(max_concurrency=8, rpm=100)
+    limiter.record_outcome(QUOTA_ERROR)
+    assert (limiter.concurrency_limit, limiter.rpm_limit) == (4.0, 50.0)
+
+    # Other errors leave the limits alone
+    limiter.record_outcome(ValueError("bad JSON"))
+    assert limiter.concurrency_limit == 4.0
+
+    for _ in range(200):
+        limiter.record_outcome()
+    assert (limiter.concurrency_limit, limiter.rpm_limit) == (8.0, 100.0)
+
+
+def test_one_quota_burst_backs_off_once():
+    limiter = AdaptiveRateLimiter(max_concurrency=8)
+
+    async def scenario():
+        # Four calls in flight when the quota runs out: all fail together
+        async with limiter.acquire() as a, limiter.acquire() as b, limiter.acquire() as c, limiter.acquire() as d:
+            started = [a, b, c, d]
+        for started_at in started:
+            limiter.record_outcome(QUOTA_ERROR, started_at)
+        # A call started under the reduced limits decreases them again
+        async with limiter.acquire() as started_at:
+            pass
+        limiter.record_outcome(QUOTA_ERROR, started_at)
+
+    asyncio.run(scenario())
+    assert limiter.concurrency_limit == 2.0
+    assert limiter.stats()["rate_limited_same_burst"] == 3
+
+
+def test_cancelled_waiters_leave_the_limiter_usable():
+    limiter = AdaptiveRateLimiter(max_concurrency=1)
+
+    async def wait_for_slot():
+        async with limiter.acquire():
+            pass
+
+    async def scenario():
+        async with limiter.acquire():
+            waiters = [asyncio.ensure_future(wait_for_slot()) for _ in range(3)]
+            await asyncio.sleep(0.01)
+            # Cancelled twice, as when a hedge loser is cancelled during shutdown
+            for waiter in waiters:
+                waiter.cancel()
+                waiter.cancel()
+            results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, asyncio.CancelledError) for result in results)
+        await wait_for_slot()
+
+    asyncio.run(asyncio.wait_for(scenario(), timeout=2))
+    stats = limiter.stats()
+    assert (stats["in_flight"], stats["queue_depth"], stats["acquired"]) == (0, 0, 2)
+
+
+def test_threads_and_event_loop_share_the_cap():
+    limiter = AdaptiveRateLimiter(max_concurrency=2)
+    peak = 0
+    peak_lock = threading.Lock()
+
+    def track():
+        nonlocal peak
+        with peak_lock:
+            peak = max(peak, limiter._in_flight)
+
+    def blocking_call(_):
+        with limiter.acquire_blocking():
+            track()
+            time.sleep(0.01)
+
+    async def async_call():
+        async with limiter.acquire():
+            track()
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        await asyncio.gather(*(async_call() for _ in range(4)))
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        threads = pool.map(blocking_call, range(8))
+        asyncio.run(asyncio.wait_for(scenario(), timeout=5))
+        list(threads)
+    stats = limiter.stats()
+    assert peak == 2
+    assert (stats["acquired"], stats["in_flight"], stats["queue_depth"]) == (12, 0, 0)
+
+
+def test_sync_classify_risk_goes_through_the_limiter(patient, monkeypatch):
+    limiter = AdaptiveRateLimiter(max_concurrency=1)
+    monkeypatch.setattr(risk_service, "rate_limiter", limiter)
+    llm = BenchmarkChatModel(latency=0, rate_limit_rate=1.0)
+
+    result = risk_service.classify_risk(patient, flow=FLOWS["อาการเลือดซึม/ เลือดออก"], llm=llm, max_retries=1)
+    assert result.risk_level == "ไม่สามารถประเมินได้"
+    assert (limiter.stats()["acquired"], limiter.stats()["rate_limited"]) == (1, 1)
+
+    async def on_loop():
+        risk_service.classify_risk(patient, flow=FLOWS["อาการเลือดซึม/ เลือดออก"], llm=llm)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(on_loop())
+
+
+@pytest.mark.parametrize("error, expected", [
+    (QUOTA_ERROR, True),
+    (Exception("Rate limit reached for requests"), True),
+    (type("ResourceExhausted", (Exception,), {})("quota"), True),
+    (TimeoutError("deadline exceeded"), False),
+])
+def test_rate_limit_errors_are_recognised(error, expected):
+    assert is_rate_limit_error(error) == expected
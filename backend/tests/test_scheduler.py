@@ -0,0 +1,96 @@
+"""
+Batch scheduler: (row, flow) cells are independent work items across rows
+"""
+import asyncio
+
+import pandas as pd
+
+from app.core.flows import FLOWS
+from app.services import risk_service
+from app.services.risk_service import OutputRiskClassification, _process_all_rows, add_result_columns
+from app.services.stream_service import stream_classified_rows
+
+FIRST_FLOW = next(iter(FLOWS))
+
+
+def test_slow_cell_does_not_hold_back_other_rows(patient, tmp_path, monkeypatch):
+    df = add_result_columns(pd.DataFrame([dict(patient, hn=f"ROW-{i}") for i in range(4)]))
+    other_cells = len(df) * len(FLOWS) - 1
+    done = []
+    release = asyncio.Event()
+
+    async def classify_cell(input_data, row_key, flow_name, flow, llm, semaphore):
+        # Row 0's first cell only finishes once every other cell is done
+        if input_data["hn"] == "ROW-0" and flow_name == FIRST_FLOW:
+            await release.wait()
+        output = OutputRiskClassification(risk_level="ความเสี่ยงต่ำ", recommendation="-", reason=input_data["hn"])
+        return flow_name, output
+
+    def on_result(idx, flow_name, output):
+        done.append((idx, flow_name))
+        if len(done) == other_cells:
+            release.set()
+
+    monkeypatch.setattr(risk_service, "classify_batch_cell", classify_cell)
+    asyncio.run(asyncio.wait_for(
+        _process_all_rows(df, None, str(tmp_path / "result.csv"), max_concurrent=2, on_result=on_result),
+        timeout=5,
+    ))
+
+    assert done[-1] == (0, FIRST_FLOW)
+    assert len(set(done)) == len(df) * len(FLOWS)
+    # Results are written back to their own rows
+    assert list(df[f"{FIRST_FLOW}_risk_reason"]) == [f"ROW-{i}" for i in range(4)]
+    assert pd.read_csv(tmp_path / "result.csv").shape == df.shape
+
+
+def test_streamed_rows_share_the_queue_and_keep_input_order(patient, monkeypatch):
+    rows = [dict(patient, hn=f"ROW-{i}") for i in range(4)]
+    other_cells = len(rows) * len(FLOWS) - 1
+    done = []
+    release = asyncio.Event()
+
+    async def classify_cell(input_data, row_key, flow_name, flow, llm, semaphore):
+        if input_data["hn"] == "ROW-0" and flow_name == FIRST_FLOW:
+            await release.wait()
+        done.append((input_data["hn"], flow_name))
+        if len(done) == other_cells:
+            release.set()
+        return flow_name, OutputRiskClassification(risk_level="ความเสี่ยงต่ำ", recommendation="-", reason=input_data["hn"])
+
+    async def source():
+        for row in rows:
+            yield row
+
+    async def scenario():
+        return [row async for row in stream_classified_rows(source(), None, max_concurrent=2, window=4)]
+
+    monkeypatch.setattr(risk_service, "classify_batch_cell", classify_cell)
+    streamed = asyncio.run(asyncio.wait_for(scenario(), timeout=5))
+
+    # Rows 1-3 were classified while row 0 waited, and still come out after it
+    assert done[-1] == ("ROW-0", FIRST_FLOW)
+    assert [row["hn"] for row in streamed] == [f"ROW-{i}" for i in range(4)]
+    assert [row[f"{FIRST_FLOW}_risk_reason"] for row in streamed] == [f"ROW-{i}" for i in range(4)]
+
+
+def test_cancel_stops_all_workers(patient, tmp_path, monkeypatch):
+    df = add_result_columns(pd.DataFrame([patient] * 3))
+    started = []
+
+    async def classify_cell(input_data, row_key, flow_name, flow, llm, semaphore):
+        started.append(flow_name)
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(risk_service, "classify_batch_cell", classify_cell)
+
+    async def scenario():
+        task = asyncio.create_task(_process_all_rows(df, None, str(tmp_path / "result.csv"), max_concurrent=2))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+
+    assert asyncio.run(scenario()) == []
+    assert len(started) == 4  # one cell per worker; the queue was never drained
+    assert not (tmp_path / "result.csv").exists()
@@ -0,0 +1,89 @@
+"""
+Single-flight: identical in-flight classifications share one call
+"""
+import asyncio
+
+import pytest
+
+from app.core.flows import FLOWS
+from app.services.cache_service import SingleFlight
+from app.services.risk_service import aclassify_risk
+from benchmarks.fake_llm import BenchmarkChatModel
+
+BLEEDING = "อาการเลือดซึม/ เลือดออก"
+
+
+async def slow_value(value, started: list, delay: float = 0.05):
+    started.append(value)
+    await asyncio.sleep(delay)
+    return value
+
+
+def test_concurrent_callers_share_one_call():
+    group = SingleFlight()
+    started = []
+
+    async def scenario():
+        return await asyncio.gather(
+            *(group.do("a", lambda: slow_value("A", started)) for _ in range(3)),
+            group.do("b", lambda: slow_value("B", started)),
+        )
+
+    assert asyncio.run(scenario()) == ["A", "A", "A", "B"]
+    assert started == ["A", "B"]
+    assert group.stats() == {"in_flight": 0, "calls": 2, "coalesced": 2}
+
+
+def test_error_reaches_every_caller_and_is_not_remembered():
+    group = SingleFlight()
+    started = []
+
+    async def failing():
+        started.append("x")
+        await asyncio.sleep(0.01)
+        raise RuntimeError("quota")
+
+    async def scenario():
+        results = await asyncio.gather(group.do("k", failing), group.do("k", failing), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        # The failed call is forgotten: the next caller starts a new one
+        return await group.do("k", lambda: slow_value("ok", started))
+
+    assert asyncio.run(scenario()) == "ok"
+    assert started == ["x", "ok"]
+
+
+def test_shared_call_survives_until_last_caller_cancels():
+    group = SingleFlight()
+    started = []
+
+    async def scenario():
+        first = asyncio.ensure_future(group.do("k", lambda: slow_value("A", started, delay=0.1)))
+        second = asyncio.ensure_future(group.do("k", lambda: slow_value("A", started, delay=0.1)))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == "A"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+        third = asyncio.ensure_future(group.do("j", lambda: slow_value("B", started, delay=10)))
+        await asyncio.sleep(0.01)
+        third.cancel()
+        await asyncio.gather(third, return_exceptions=True)
+        await asyncio.sleep(0)
+        return group.stats()["in_flight"]
+
+    assert asyncio.run(scenario()) == 0
+    assert started == ["A", "B"]
+
+
+def test_identical_classifications_make_one_llm_call(patient):
+    llm = BenchmarkChatModel(latency=0)
+
+    async def scenario():
+        flow = FLOWS[BLEEDING]
+        return await asyncio.gather(*(aclassify_risk(patient, flow, llm, flow_name=BLEEDING) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert llm.calls == 1
+    assert len({result.model_dump_json() for result in results}) == 1
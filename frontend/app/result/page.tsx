@@ -14,6 +14,7 @@ export default function ResultPage() {
   const [showDataPreview, setShowDataPreview] = useState(false);
   const [isProcessing, setIsProcessing] = useState(false);
   const [processingProgress, setProcessingProgress] = useState({ current: 0, total: 0, flowName: '' });
+  const [partialResult, setPartialResult] = useState<AllFlowsResult>({});
   const [error, setError] = useState<string | null>(null);
 
   useEffect(() => {
@@ -83,9 +84,12 @@ export default function ResultPage() {
         // Import api dynamically to avoid circular dependencies
         const { api, logApi } = await import('@/lib');
         
-        // Classify patient data
-        const classificationResult: AllFlowsResult = await api.classifyPatient(
+        // Classify patient data (each flow is shown as soon as it finishes)
+        const classificationResult: AllFlowsResult = await api.classifyPatientStream(
           patientFormData,
+          (flowName, flowResult) => {
+            setPartialResult(prev => ({ ...prev, [flowName]: flowResult }));
+          },
           (current, total, flowName) => {
             setProcessingProgress({ current, total, flowName });
           }
@@ -266,6 +270,18 @@ export default function ResultPage() {
             </p>
           </div>
 
+          {/* Flows finished so far */}
+          {Object.keys(partialResult).length > 0 && (
+            <div className="mb-8 space-y-4">
+              <h2 className="text-xl font-bold text-gray-800">
+                ผลที่ประเมินเสร็จแล้ว ({Object.keys(partialResult).length} ด้าน)
+              </h2>
+              {Object.entries(partialResult).map(([flowName, flowResult]) => (
+                <RiskResult key={flowName} flowName={flowName} result={flowResult} />
+              ))}
+            </div>
+          )}
+
           {/* Show patient data while waiting */}
           {patientData && (
             <div className="bg-white rounded-lg shadow-md overflow-hidden">
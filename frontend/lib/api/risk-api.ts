@@ -11,6 +11,7 @@ import type {
 } from '../types';
 import type {
   ProgressCallback,
+  FlowResultCallback,
   UploadProgressCallback,
 } from '../types/api.types';
 
@@ -81,6 +82,83 @@ export const riskApi = {
     }
   },
 
+  /**
+   * Classify patient risk across all flows, receiving each flow as soon as it finishes
+   * (server-sent events from /classify-all-flows/stream)
+   */
+  classifyPatientStream: async (
+    data: PatientFormData,
+    onFlowResult?: FlowResultCallback,
+    onProgress?: ProgressCallback
+  ): Promise<AllFlowsResult> => {
+    // Get list of flows first (for progress)
+    const totalFlows = (await riskApi.getFlows()).length;
+
+    const response = await fetch(`${API_URL}/classify-all-flows/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ data }),
+    });
+
+    if (!response.ok || !response.body) {
+      let detail = 'Failed to classify patient data';
+      try {
+        const body: ApiError = await response.json();
+        detail = body.detail || detail;
+      } catch {
+        // Non-JSON error body
+      }
+      throw new Error(detail);
+    }
+
+    const results: AllFlowsResult = {};
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let finished = false;
+
+    const handleEvent = (raw: string) => {
+      let event = 'message';
+      let payload = '';
+      for (const line of raw.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) payload += line.slice(5).trim();
+      }
+      if (!payload) return;
+
+      const parsed = JSON.parse(payload);
+      if (event === 'flow') {
+        const { flow_name: flowName, ...result } = parsed;
+        results[flowName] = result;
+        onFlowResult?.(flowName, result);
+        onProgress?.(Object.keys(results).length, totalFlows, flowName);
+      } else if (event === 'done') {
+        finished = true;
+        if (Object.keys(results).length === 0 && Object.keys(parsed.errors || {}).length > 0) {
+          throw new Error(`All flows failed. Errors: ${JSON.stringify(parsed.errors)}`);
+        }
+      }
+    };
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary = buffer.indexOf('\n\n');
+      while (boundary !== -1) {
+        handleEvent(buffer.slice(0, boundary));
+        buffer = buffer.slice(boundary + 2);
+        boundary = buffer.indexOf('\n\n');
+      }
+    }
+
+    if (!finished) {
+      throw new Error('Classification stream ended unexpectedly');
+    }
+    return results;
+  },
+
   /**
    * Upload CSV file and get processed results
    */
@@ -13,6 +13,7 @@ import type {
 } from './types';
 import type {
   ProgressCallback,
+  FlowResultCallback,
   UploadProgressCallback,
 } from './types/api.types';
 
@@ -27,6 +28,7 @@ export type {
   AllFlowsResult,
   ApiError,
   ProgressCallback,
+  FlowResultCallback,
   UploadProgressCallback,
 };
 
@@ -10,6 +10,7 @@ export interface RiskAssessmentResult {
   risk_level: string;
   recommendation: string;
   reason: string;
+  model?: string | null;
 }
 
 /**
@@ -37,6 +38,14 @@ export type ProgressCallback = (
   flowName: string
 ) => void;
 
+/**
+ * Called with each flow's result as soon as it is streamed from the server
+ */
+export type FlowResultCallback = (
+  flowName: string,
+  result: RiskAssessmentResult
+) => void;
+
 /**
  * Upload progress callback
  */
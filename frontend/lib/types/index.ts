@@ -33,5 +33,6 @@ export type {
   AllFlowsResult,
   ApiError,
   ProgressCallback,
+  FlowResultCallback,
   UploadProgressCallback,
 } from './api.types';